@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time the sync diff phase for growing numbers of users and groups
+
+Run with ``python benchmarks/sync_diff.py``. Half of the local records already exist remotely, so every size
+exercises both the create and the remove side of the diff.
+"""
+import timeit
+
+from jccli import sync_plan
+
+SIZES = (1000, 3000, 10000, 30000)
+
+
+def make_users(start, count):
+    return [{'id': str(i), 'username': f"user{i}", 'email': f"user{i}@example.org"}
+            for i in range(start, start + count)]
+
+
+def make_groups(start, count):
+    return [{'id': str(i), 'name': f"group{i}", 'type': 'user_group' if i % 2 else 'system_group'}
+            for i in range(start, start + count)]
+
+
+def main():
+    print(f"{'records':>8} {'users (s)':>10} {'groups (s)':>11}")
+    for size in SIZES:
+        local_users, remote_users = make_users(0, size), make_users(size // 2, size)
+        local_groups, remote_groups = make_groups(0, size), make_groups(size // 2, size)
+        users_time = min(timeit.repeat(lambda: sync_plan.diff_users(local_users, remote_users), number=1, repeat=3))
+        groups_time = min(timeit.repeat(lambda: sync_plan.diff_groups(local_groups, remote_groups), number=1,
+                                        repeat=3))
+        print(f"{size:>8} {users_time:>10.4f} {groups_time:>11.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.__main__.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+Run jccli with `python -m jccli`
+"""
+from jccli.cli import cli
+
+if __name__ == '__main__':
+    cli(prog_name='jccli')  # pylint: disable=no-value-for-parameter,unexpected-keyword-arg
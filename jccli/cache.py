@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.cache.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+Lookup indexes over the jumpcloud directory
+
+Indexes are kept per process and per API key, so a directory is fetched once no matter how many api wrappers are
+created. They can optionally be backed by a :class:`DirectoryCache`, which keeps directory records on disk between
+runs.
+
+The cache is shared by every jccli process using the same profile. SQLite keeps it consistent, and each snapshot is
+replaced in a single transaction, so readers see either the old or the new snapshot of a kind, never a mix. An expired
+snapshot is refreshed by one process at a time, under an advisory file lock; the others wait for it and use its
+result rather than fetching the directory themselves.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from jccli.helpers import file_lock
+
+
+# Seconds for which cached directory records are used before being fetched again
+DEFAULT_TTL = 900
+
+_LOCK = threading.Lock()
+_USER_INDEXES = {}
+_GROUP_INDEXES = {}
+
+
+class DirectoryCache:
+    """
+    On-disk cache of jumpcloud directory records, stored in a SQLite database. Records are grouped by kind
+    (e.g. 'users') and keyed by their id. The records of a kind are a snapshot, refreshed as a whole, and are only used
+    while the snapshot is younger than the cache's time to live. A snapshot brought up to date incrementally, with
+    `merge_records`, keeps the age of its last full refresh: records changed outside of jccli are only seen again by a
+    full refresh, so it is the full refresh that expires.
+
+    With a `max_age`, an expired snapshot is still used until it is `max_age` seconds old (stale-while-revalidate):
+    `on_stale` is called the first time it is, so that it can be refreshed in the background without keeping the
+    caller waiting.
+    """
+    def __init__(self, path, ttl=None, max_age=None, on_stale=None):
+        """
+        :param path: path of the SQLite database file, created if it does not exist
+        :param ttl: seconds for which a snapshot is used, or None to use snapshots however old they are
+        :param max_age: seconds for which an expired snapshot is still used while it is refreshed, or None not to use
+                        expired snapshots
+        :param on_stale: a function called with the kind of record the first time an expired snapshot of that kind is
+                         used
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_age = max_age
+        self.on_stale = on_stale
+        self._stale_kinds = set()
+        self._stale_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        with self._transaction() as connection:
+            # Readers are not blocked by a process writing a new snapshot, and see the previous one until it commits
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS records '
+                               '(kind TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (kind, id))')
+            connection.execute('CREATE TABLE IF NOT EXISTS snapshots '
+                               '(kind TEXT PRIMARY KEY, refreshed_at REAL NOT NULL, '
+                               'full_refresh_at REAL NOT NULL DEFAULT 0)')
+            columns = {column[1] for column in connection.execute('PRAGMA table_info(snapshots)')}
+            if 'full_refresh_at' not in columns:
+                # Caches written before full refreshes were told apart expire at once
+                connection.execute('ALTER TABLE snapshots ADD COLUMN full_refresh_at REAL NOT NULL DEFAULT 0')
+
+    @contextmanager
+    def _transaction(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def refresh_lock(self, kind, blocking=True):
+        """
+        Hold the lock of a kind of record, which processes refreshing its snapshot share, for the duration of a with
+        block
+        :param kind: the kind of record, e.g. 'users'
+        :param blocking: wait for the lock if another process holds it
+        :return: whether the lock was taken, as the target of the with statement
+        """
+        lock_name = hashlib.sha256(kind.encode()).hexdigest()[:16] + '.lock'
+        return file_lock(os.path.join(self.path + '.locks', lock_name), blocking=blocking)
+
+    def get_or_refresh(self, kind, refresh):
+        """
+        Get the cached records of a kind, refreshing its snapshot if it has expired. However many processes find the
+        snapshot expired at once, only one of them refreshes it; the others wait for it and use the new snapshot.
+        :param kind: the kind of record, e.g. 'users'
+        :param refresh: a function which fetches the records of the kind, caches them with `set_records` and returns
+                        them
+        :return: a tuple `(records, refreshed)` of the list of records and whether this call fetched them
+        """
+        records = self.get_records(kind)
+        if records is not None:
+            return records, False
+        with self.refresh_lock(kind):
+            # Another process may have refreshed the snapshot while this one waited for the lock
+            records = self.get_records(kind)
+            if records is not None:
+                return records, False
+            return refresh(), True
+
+    def snapshot_age(self, kind):
+        """
+        :param kind: the kind of record, e.g. 'users'
+        :return: the age in seconds of the last full refresh of the snapshot of a kind, against which it expires, or
+                 None if nothing has been cached for this kind
+        """
+        with self._transaction() as connection:
+            row = connection.execute('SELECT full_refresh_at FROM snapshots WHERE kind = ?', (kind,)).fetchone()
+        return None if row is None else time.time() - row[0]
+
+    def get_records(self, kind):
+        """
+        Get the cached records of a kind
+        :param kind: the kind of record, e.g. 'users'
+        :return: a list of records, or None if nothing has been cached for this kind or the snapshot has expired
+        """
+        with self._transaction() as connection:
+            if not self._is_fresh(connection, kind):
+                return None
+            rows = connection.execute('SELECT data FROM records WHERE kind = ? ORDER BY rowid', (kind,))
+            return [json.loads(data) for (data,) in rows]
+
+    def find_records(self, kind, **fields):
+        """
+        Find cached records of a kind by the values of their fields, without loading the other records
+        :param kind: the kind of record, e.g. 'users'
+        :param fields: the values to look for, e.g. `username='jsmith'`
+        :return: a list of the matching records, or None if nothing has been cached for this kind or the snapshot has
+                 expired
+        """
+        query = 'SELECT data FROM records WHERE kind = ?'
+        parameters = [kind]
+        for field, value in fields.items():
+            if field == 'id':
+                query += ' AND id = ?'
+            else:
+                query += ' AND json_extract(data, ?) = ?'
+                parameters.append('$.' + field)
+            parameters.append(value)
+        with self._transaction() as connection:
+            if not self._is_fresh(connection, kind):
+                return None
+            return [json.loads(data) for (data,) in connection.execute(query + ' ORDER BY rowid', parameters)]
+
+    def get_snapshot_ids(self, kind):
+        """
+        Get the ids of the cached records of a kind and the time their snapshot was last brought up to date, fully or
+        incrementally, however old it is
+        :param kind: the kind of record, e.g. 'users'
+        :return: a tuple `(ids, refreshed_at)` of a set of ids and a time in seconds since the epoch, or None if nothing
+                 has been cached for this kind
+        """
+        with self._transaction() as connection:
+            row = connection.execute('SELECT refreshed_at FROM snapshots WHERE kind = ?', (kind,)).fetchone()
+            if row is None:
+                return None
+            ids = {id for (id,) in connection.execute('SELECT id FROM records WHERE kind = ?', (kind,))}
+            return ids, row[0]
+
+    def merge_records(self, kind, records, removed_ids, refreshed_at):
+        """
+        Bring the snapshot of a kind up to date with changes fetched since it was taken, in one transaction. The
+        snapshot still expires with its last full refresh, since the records it already held were not fetched again.
+        :param kind: the kind of record, e.g. 'users'
+        :param records: records to add or update
+        :param removed_ids: ids of the records to remove
+        :param refreshed_at: the time, in seconds since the epoch, at which the changes started being fetched
+        """
+        with self._transaction() as connection:
+            connection.executemany('INSERT OR REPLACE INTO records (kind, id, data) VALUES (?, ?, ?)',
+                                   [(kind, record['id'], json.dumps(record, default=str)) for record in records])
+            connection.executemany('DELETE FROM records WHERE kind = ? AND id = ?', [(kind, id) for id in removed_ids])
+            connection.execute('UPDATE snapshots SET refreshed_at = ? WHERE kind = ?', (refreshed_at, kind))
+
+    def forget(self, kind):
+        """
+        Remove the cached records and snapshot of a kind
+        :param kind: the kind of record, e.g. 'users'
+        """
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM records WHERE kind = ?', (kind,))
+            connection.execute('DELETE FROM snapshots WHERE kind = ?', (kind,))
+
+    def get_kinds(self, prefix=''):
+        """
+        :param prefix: the start of the kinds to list, e.g. 'group_members/'
+        :return: the kinds of record which have been cached, however old their snapshot is
+        """
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT kind FROM snapshots WHERE substr(kind, 1, ?) = ? ORDER BY kind',
+                                      (len(prefix), prefix))
+            return [kind for (kind,) in rows]
+
+    def _is_fresh(self, connection, kind):
+        row = connection.execute('SELECT full_refresh_at FROM snapshots WHERE kind = ?', (kind,)).fetchone()
+        if row is None:
+            return False
+        age = time.time() - row[0]
+        if self.ttl is None or age < self.ttl:
+            return True
+        if self.max_age is None or age >= self.max_age:
+            return False
+        self._revalidate(kind)
+        return True
+
+    def _revalidate(self, kind):
+        """
+        Call `on_stale` for a kind whose expired snapshot is being used, once per kind
+        """
+        with self._stale_lock:
+            if kind in self._stale_kinds:
+                return
+            self._stale_kinds.add(kind)
+        if self.on_stale is not None:
+            self.on_stale(kind)
+
+    def set_records(self, kind, records):
+        """
+        Replace all cached records of a kind
+        :param kind: the kind of record, e.g. 'users'
+        :param records: the complete list of records
+        """
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM records WHERE kind = ?', (kind,))
+            connection.executemany('INSERT OR REPLACE INTO records (kind, id, data) VALUES (?, ?, ?)',
+                                   [(kind, record['id'], json.dumps(record, default=str)) for record in records])
+            now = time.time()
+            connection.execute('INSERT OR REPLACE INTO snapshots (kind, refreshed_at, full_refresh_at) '
+                               'VALUES (?, ?, ?)', (kind, now, now))
+
+    def put_records(self, kind, records):
+        """
+        Add or update cached records of a kind
+        :param kind: the kind of record, e.g. 'users'
+        :param records: records to add or update
+        """
+        with self._transaction() as connection:
+            connection.executemany('INSERT OR REPLACE INTO records (kind, id, data) VALUES (?, ?, ?)',
+                                   [(kind, record['id'], json.dumps(record, default=str)) for record in records])
+
+    def delete_records(self, kind, ids):
+        """
+        Remove cached records of a kind
+        :param kind: the kind of record, e.g. 'users'
+        :param ids: ids of the records to remove
+        """
+        with self._transaction() as connection:
+            connection.executemany('DELETE FROM records WHERE kind = ? AND id = ?', [(kind, id) for id in ids])
+
+
+class UserIndex:
+    """
+    Index of jumpcloud user ids by username
+    """
+    def __init__(self):
+        self.loaded = False
+        self.refreshed = False
+        self._lock = threading.Lock()
+        self._ids_by_username = {}
+        self._usernames_by_id = {}
+
+    def load(self, users, refreshed=False):
+        """
+        Replace the contents of the index
+        :param users: a list of user dicts, with at least 'id' and 'username'
+        :param refreshed: whether `users` was just fetched from the API (as opposed to a local cache)
+        """
+        with self._lock:
+            self._ids_by_username.clear()
+            self._usernames_by_id.clear()
+            for user in users:
+                self._add(user)
+            self.loaded = True
+            self.refreshed = self.refreshed or refreshed
+
+    def add(self, user):
+        """
+        Add or update a user
+        :param user: a user dict, with at least 'id' and 'username'
+        """
+        with self._lock:
+            self._remove(user.get('id'))
+            self._add(user)
+
+    def remove(self, user_id):
+        """
+        Remove a user
+        :param user_id: the jumpcloud id of the user
+        """
+        with self._lock:
+            self._remove(user_id)
+
+    def id_for_username(self, username):
+        """
+        :return: the id of the user with this username, or None
+        """
+        return self._ids_by_username.get(username)
+
+    def _add(self, user):
+        user_id = user.get('id')
+        if user_id is None:
+            return
+        self._usernames_by_id[user_id] = user.get('username')
+        if user.get('username') is not None:
+            self._ids_by_username[user['username']] = user_id
+
+    def _remove(self, user_id):
+        username = self._usernames_by_id.pop(user_id, None)
+        if self._ids_by_username.get(username) == user_id:
+            del self._ids_by_username[username]
+
+
+class GroupIndex:
+    """
+    Index of jumpcloud groups by name and type
+    """
+    def __init__(self):
+        self.loaded = False
+        self.refreshed = False
+        self._lock = threading.Lock()
+        self._groups = {}
+
+    def load(self, groups, refreshed=False):
+        """
+        Replace the contents of the index
+        :param groups: a list of group dicts, with at least 'id', 'name' and 'type'
+        :param refreshed: whether `groups` is a complete listing just fetched from the API (as opposed to a local
+                          cache)
+        """
+        with self._lock:
+            self._groups = {(group['name'], group['type']): group for group in groups}
+            self.loaded = True
+            self.refreshed = self.refreshed or refreshed
+
+    def add(self, group):
+        """
+        Add or update a group
+        :param group: a group dict, with at least 'id', 'name' and 'type'
+        """
+        with self._lock:
+            self._groups[(group['name'], group['type'])] = group
+
+    def remove(self, group_id):
+        """
+        Remove a group
+        :param group_id: the jumpcloud id of the group
+        """
+        with self._lock:
+            self._groups = {key: group for key, group in self._groups.items() if group['id'] != group_id}
+
+    def get(self, name, type):
+        """
+        :return: the group with this name and type, or None
+        """
+        return self._groups.get((name, type))
+
+
+def cache_path(cache_dir, profile, api_key):
+    """
+    :param cache_dir: the directory of jccli caches
+    :param profile: the name of the profile in use
+    :param api_key: JumpCloud API key
+    :return: the path of the directory cache of a profile and API key, which does not reveal the key
+    """
+    key_hash = hashlib.sha256((api_key or '').encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{profile}-{key_hash}.sqlite")
+
+
+def get_user_index(api_key):
+    """
+    Get the process-wide user index for an API key
+    :param api_key: JumpCloud API key
+    :return: a UserIndex, which is empty and not loaded the first time
+    """
+    with _LOCK:
+        return _USER_INDEXES.setdefault(api_key, UserIndex())
+
+
+def get_group_index(api_key):
+    """
+    Get the process-wide group index for an API key
+    :param api_key: JumpCloud API key
+    :return: a GroupIndex, which is empty and not loaded the first time
+    """
+    with _LOCK:
+        return _GROUP_INDEXES.setdefault(api_key, GroupIndex())
+
+
+def reset_indexes():
+    """
+    Discard all process-wide indexes
+    """
+    with _LOCK:
+        _USER_INDEXES.clear()
+        _GROUP_INDEXES.clear()
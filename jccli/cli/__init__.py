@@ -9,12 +9,14 @@ import logging
 import sys
 import click
 import click_log
+from .cache import cache, refresh_in_background
 from .group import group
 from .sync import sync
 from .system import system
 from .user import user
 from ..__init__ import __version__
-from ..config import load_config
+from ..cache import DEFAULT_TTL, DirectoryCache, cache_path
+from ..config import CACHE_DIR, load_config
 
 
 LOGGER = logging.getLogger(__name__)
@@ -27,10 +29,20 @@ click_log.basic_config(LOGGER)
               envvar='JC_API_KEY')
 @click.option('--profile', '-p', help='A user profile, as specified in the config file', default='DEFAULT',
               show_default=True)
+@click.option('--cache-ttl', type=int, envvar='JC_CACHE_TTL',
+              help='Seconds for which the local cache of the directory is used (can also be set in config file or use '
+                   'environmental variable: JC_CACHE_TTL) [default: %d]' % (DEFAULT_TTL,))
+@click.option('--cache-max-age', type=int, envvar='JC_CACHE_MAX_AGE',
+              help='Seconds for which the local cache of the directory is still used once it has expired, while it '
+                   'is refreshed in the background (can also be set in config file or use environmental variable: '
+                   'JC_CACHE_MAX_AGE)')
+@click.option('--no-cache', is_flag=True, help='Do not use the local cache of the directory')
+@click.option('--refresh', is_flag=True, help='Refresh the local cache of the directory from JumpCloud')
 @click_log.simple_verbosity_option(LOGGER)
 @click.version_option(version=__version__)
 @click.pass_context
-def cli(ctx, key, profile):
+def cli(ctx, key, profile, cache_ttl, cache_max_age, no_cache, refresh):
+    # pylint: disable-msg=too-many-arguments
     """
     Run jccli.
     """
@@ -43,8 +55,24 @@ def cli(ctx, key, profile):
     if not key and 'key' in config:
         key = config['key']
 
+    # Try to get the cache TTL from CLI, then from config
+    if cache_ttl is None:
+        cache_ttl = int(config.get('cache_ttl', DEFAULT_TTL))
+    if cache_max_age is None and 'cache_max_age' in config:
+        cache_max_age = int(config['cache_max_age'])
+
+    cache = None
+    if not no_cache:
+        # With --refresh, every cached snapshot is expired, so it is fetched again and rewritten
+        if refresh:
+            cache = DirectoryCache(cache_path(CACHE_DIR, profile, key), ttl=0)
+        else:
+            cache = DirectoryCache(cache_path(CACHE_DIR, profile, key), ttl=cache_ttl, max_age=cache_max_age)
+            cache.on_stale = refresh_in_background(cache, profile, key)
+
     ctx.obj = {
         'key': key,
+        'cache': cache,
         'logger': LOGGER
     }
 
@@ -53,3 +81,4 @@ cli.add_command(user)
 cli.add_command(group)
 cli.add_command(sync)
 cli.add_command(system)
+cli.add_command(cache)
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import click
+from jccli.jc_api_v1 import JumpcloudApiV1
+from jccli.jc_api_v2 import JumpcloudApiV2
+
+# The lock held by `jccli cache refresh`, so that one refresh of a cache runs at a time
+REFRESH_LOCK = 'directory'
+
+
+@click.group()
+@click.pass_context
+def cache(ctx):
+    """
+    Command set for the local cache of the directory.
+    """
+    pass
+
+
+@cache.command('refresh')
+@click.option('--full', is_flag=True, help='Fetch every record again, rather than only the records created since the '
+                                           'last refresh')
+@click.option('--if-stale', is_flag=True, help='Only refresh a cache which has expired, fetching every record again, '
+                                               'and do nothing while another refresh is running')
+@click.pass_context
+def refresh_cache(ctx, full, if_stale):
+    """
+    Bring the local cache of the directory up to date with JumpCloud.
+    """
+    dir_cache = ctx.obj.get('cache')
+    if dir_cache is None:
+        ctx.obj.get('logger').error("the cache is disabled, there is nothing to refresh")
+        sys.exit(1)
+
+    with dir_cache.refresh_lock(REFRESH_LOCK, blocking=not if_stale) as locked:
+        if not locked:
+            click.echo("another refresh is running")
+            return
+        if if_stale and not is_stale(dir_cache):
+            click.echo("the cache is fresh")
+            return
+        api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=dir_cache)
+        api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=dir_cache)
+        # A cache expires with its last full refresh, which an incremental refresh would not renew
+        results = api1.refresh_cache(full=full or if_stale)
+        results.update(api2.refresh_cache())
+    for kind, result in results.items():
+        click.echo(f"{kind}: {result['fetched']} fetched, {result['removed']} removed"
+                   f"{' (full refresh)' if result['full'] else ''}")
+
+
+def is_stale(dir_cache):
+    """
+    :param dir_cache: a DirectoryCache
+    :return: whether any snapshot of the cache has expired
+    """
+    if dir_cache.ttl is None:
+        return False
+    return any(dir_cache.snapshot_age(kind) >= dir_cache.ttl for kind in dir_cache.get_kinds())
+
+
+def refresh_in_background(dir_cache, profile, key):
+    """
+    Make a function which starts `jccli cache refresh --if-stale` in a detached process, the first time it is called,
+    unless a refresh is already running. It is meant as the `on_stale` function of a `jccli.cache.DirectoryCache`: the
+    refresh outlives the command which found the cache stale, so that command answers at once and the next one finds
+    the cache fresh. When many processes find the cache stale at once, the refreshes they start elect one of them by
+    its lock, and the others exit straight away.
+    :param dir_cache: the DirectoryCache to refresh
+    :param profile: the profile in use
+    :param key: JumpCloud API key, passed to the process in its environment rather than on its command line
+    :return: a function taking the kind of record found stale
+    """
+    started = []
+
+    def refresh(kind):
+        if started:
+            return
+        started.append(kind)
+        with dir_cache.refresh_lock(REFRESH_LOCK, blocking=False) as locked:
+            if not locked:
+                return
+        env = dict(os.environ)
+        if key:
+            env['JC_API_KEY'] = key
+        options = ['--profile', profile]
+        if dir_cache.ttl is not None:
+            options += ['--cache-ttl', str(dir_cache.ttl)]
+        subprocess.Popen([sys.executable, '-m', 'jccli'] + options + ['cache', 'refresh', '--if-stale'], env=env,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+
+    return refresh
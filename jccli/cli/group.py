@@ -7,6 +7,7 @@ from jcapiv2 import GroupType
 from jcapiv2.rest import ApiException
 
 from jccli.errors import SystemUserNotFoundError
+from jccli.helpers import iter_json_list
 from jccli.jc_api_v1 import JumpcloudApiV1
 from jccli.jc_api_v2 import JumpcloudApiV2
 
@@ -29,7 +30,7 @@ def create_group(ctx, name, type):
     """
     Create a group
     """
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger: Logger = ctx.obj.get('logger')
     if type is None:
         logger.error('groups must have a type (either "user" or "system")')
@@ -51,7 +52,7 @@ def get_group(ctx, name, type):
     """
     Get detail view of a group
     """
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger = ctx.obj.get('logger')
     if type is None:
         logger.error('groups must have a type (either "user" or "system")')
@@ -72,11 +73,11 @@ def list_groups(ctx, type):
     """
     List groups
     """
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger: Logger = ctx.obj.get('logger')
-    response = api2.get_groups(type=type)
-    serialized_response = json.dumps(response, indent=2)
-    click.echo(f"{serialized_response}")
+    for chunk in iter_json_list(api2.iter_groups(type=type)):
+        click.echo(chunk, nl=False)
+    click.echo()
 
 
 @group.command('delete')
@@ -92,7 +93,7 @@ def delete_group(ctx, name, type):
     if type is None:
         logger.error('groups must have a type (either "user" or "system")')
         sys.exit(1)
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     group = api2.get_group(group_name=name, group_type=type)
     if group is None:
         logger.error(f"no group found of type '{type}', name '{name}'")
@@ -111,8 +112,8 @@ def add_user(ctx, name, username):
     """
     logger = ctx.obj.get('logger')
 
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     try:
         user_id = api1.get_user_id(username)
     except SystemUserNotFoundError:
@@ -137,8 +138,8 @@ def list_users(ctx, name):
     """
     List users in a JumpCloud 'user' group
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger = ctx.obj.get('logger')
     group = api2.get_group(group_name=name, group_type=GroupType.USER_GROUP)
     if group:
@@ -160,8 +161,8 @@ def remove_user(ctx, name, username):
     """
     Remove a user from a JumpCloud 'user' group
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
-    api2 = JumpcloudApiV2(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger = ctx.obj.get('logger')
     try:
         user_id = api1.get_user_id(username)
@@ -1,193 +1,250 @@
+import hashlib
 import logging
+import os
+import sys
 import click
+import yaml
 
 from jccli import helpers as jccli_helpers
+from jccli import sync_plan
+from jccli.config import CACHE_DIR
 from jccli.jc_api_v1 import JumpcloudApiV1
+from jccli.journal import SyncJournal
 from jccli.jc_api_v2 import JumpcloudApiV2
 
 
-def abort_if_false(ctx, param, value):
-    # pylint: disable=unused-argument
-    """
-    A click handler for user prompts
-    """
-    if not value:
-        ctx.abort()
-
-
-@click.command()
-@click.option('--data', "-d", required=True, type=click.Path(exists=True),
-              help='The JC data file')
-@click.option('--yes', "-y", is_flag=True, callback=abort_if_false,
-              expose_value=False,
-              prompt='Do you want to continue?',
+@click.group(invoke_without_command=True)
+@click.option('--data', "-d", type=click.Path(exists=True),
+              help='The JC data file (YAML, JSON, JSON Lines or CSV)')
+@click.option('--yes', "-y", is_flag=True,
               help='Assume yes to all questions')
 @click.option('--dry-run', is_flag=True,
               help='Do not do anything, only show what will happen')
+@click.option('--resume', is_flag=True,
+              help='Carry on with an interrupted sync of the same data file, without fetching the directory again')
 @click.pass_context
-def sync(ctx, dry_run, data):
-    # pylint: disable-msg=too-many-locals
-    # pylint: disable-msg=too-many-branches
+def sync(ctx, data, yes, dry_run, resume):
     """
     Sync Jumpcloud with a data file
+
+    Without a command, plan and apply the changes in one go. Use `sync plan` and `sync apply` to review the changes
+    before applying them.
     """
-    logger = ctx.obj.get('logger')
+    if ctx.invoked_subcommand is not None:
+        return
+    if not data:
+        raise click.UsageError("Missing option '--data' / '-d'.")
 
+    logger = ctx.obj.get('logger')
     if dry_run:
         logger.setLevel(logging.DEBUG)
+    elif not yes:
+        click.confirm('Do you want to continue?', abort=True)
+
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    path = journal_path(ctx, data)
+    if resume:
+        journal = resume_journal(ctx, path)
+        if dry_run:
+            journal.close()
+            for operation in remaining_operations(journal):
+                click.echo(sync_plan.describe(operation))
+            return
+    else:
+        plan = make_plan(ctx, api1, api2, data, fingerprint=False)
+        if dry_run:
+            for operation in plan['operations']:
+                click.echo(sync_plan.describe(operation))
+            return
+        journal = start_journal(ctx, path, plan)
+    apply(ctx, api1, api2, journal)
+
+
+@sync.command('plan')
+@click.option('--data', "-d", required=True, type=click.Path(exists=True),
+              help='The JC data file (YAML, JSON, JSON Lines or CSV)')
+@click.option('--out', "-o", type=click.File('w'), default='-',
+              help='File to write the plan to (default: standard output)')
+@click.pass_context
+def plan_sync(ctx, data, out):
+    """
+    Work out the changes needed to sync Jumpcloud with a data file, and save them to a plan
+    """
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    plan = make_plan(ctx, api1, api2, data)
+    for operation in plan['operations']:
+        click.echo(sync_plan.describe(operation), err=True)
+    sync_plan.save_plan(plan, out)
 
-    logger.debug("--- sync groups ----")
-    groups = jccli_helpers.get_groups_from_file(data)
-    sync_groups(ctx, groups)
-    logger.debug("--- sync users ----")
-    users = jccli_helpers.get_users_from_file(data)
-    sync_users(ctx, users)
+
+@sync.command('apply')
+@click.argument('plan_file', metavar='PLAN', type=click.File('r'))
+@click.option('--yes', "-y", is_flag=True,
+              help='Assume yes to all questions')
+@click.option('--force', is_flag=True,
+              help='Apply the plan even if Jumpcloud has changed since it was made')
+@click.option('--resume', is_flag=True,
+              help='Carry on with an interrupted apply of the same plan')
+@click.pass_context
+def apply_sync(ctx, plan_file, yes, force, resume):
+    """
+    Apply a plan saved by `sync plan`, without fetching the directory again
+    """
+    logger = ctx.obj.get('logger')
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    path = journal_path(ctx, plan_file.name)
+    if resume:
+        # The plan has been partly applied, so Jumpcloud has changed since it was made
+        journal = resume_journal(ctx, path)
+        if not yes:
+            for operation in remaining_operations(journal):
+                click.echo(sync_plan.describe(operation))
+            try:
+                click.confirm('Do you want to continue?', abort=True)
+            except click.Abort:
+                journal.close()
+                raise
+        apply(ctx, api1, api2, journal)
+        return
+
+    try:
+        plan = sync_plan.load_plan(plan_file)
+    except ValueError as error:
+        logger.error(f"cannot read plan: {error}")
+        sys.exit(1)
+
+    fingerprint = sync_plan.get_fingerprint(api1, api2)
+    # A count the API did not give cannot tell whether that part of Jumpcloud has changed
+    unknown = sorted(kind for kind in fingerprint if fingerprint[kind] is None or plan['fingerprint'].get(kind) is None)
+    if unknown and not force:
+        logger.error(f"cannot tell whether Jumpcloud has changed since the plan was made, as the number of "
+                     f"{' and '.join(unknown)} is unknown, make a new plan or use --force")
+        sys.exit(1)
+    if fingerprint != plan['fingerprint'] and not force:
+        logger.error(f"Jumpcloud has changed since the plan was made ({plan['fingerprint']} then, {fingerprint} now), "
+                     f"make a new plan or use --force")
+        sys.exit(1)
+
+    if not plan['operations']:
+        click.echo("nothing to do")
+        return
+    if not yes:
+        for operation in plan['operations']:
+            click.echo(sync_plan.describe(operation))
+        click.confirm('Do you want to continue?', abort=True)
+    apply(ctx, api1, api2, start_journal(ctx, path, plan))
+
+
+def apply(ctx, api1, api2, journal):
+    """
+    Apply the plan of a journal, and exit with an error if any of its operations did not succeed. The journal is kept
+    until the whole plan has been applied, so that the sync can be resumed.
+    :param ctx: Click context
+    :param api1: a JumpcloudApiV1
+    :param api2: a JumpcloudApiV2
+    :param journal: a SyncJournal
+    """
+    try:
+        results = sync_plan.apply_plan(journal.plan, api1, api2, echo=click.echo, journal=journal)
+    finally:
+        journal.close()
+    if any(result['status'] != 'finished' for result in results):
+        ctx.obj.get('logger').error("some operations did not succeed, use --resume to retry them")
+        sys.exit(1)
+    journal.remove()
 
 
-def sync_groups(ctx, groups):
-    # pylint: disable-msg=too-many-locals
-    # pylint: disable-msg=too-many-branches
+def journal_path(ctx, name):
     """
-    Sync Jumpcloud groups with definition in data file
     :param ctx: Click context
-    :param groups: groups from data file
-    :return:
+    :param name: the data file or plan file being synced
+    :return: the path of the journal of the sync of a file with an API key
     """
-    key = ctx.obj.get('key')
-    logger = ctx.obj.get('logger')
-    dry_run = ctx.params.get('dry_run')
-
-    local_groups = groups
-
-    api2 = JumpcloudApiV2(key)
-    jc_group_names = []
-    jc_groups_request = api2.get_groups()
-    if jc_groups_request:
-        for jc_group in jc_groups_request:
-            jc_group_names.append(jc_group['_name'])
-
-    logger.debug(f"jumpcloud groups: {jc_group_names}")
-
-    # create new groups
-    added_groups = []
-    for group in local_groups:
-        do_create_group = False
-        try:
-            group_name = group['name']
-            group_type = group['type']
-            if group_name not in jc_group_names:
-                do_create_group = True
-            else:
-                logger.debug(f"{group_name} group already exists")
-        except KeyError as error:
-            raise error
-
-        if do_create_group:
-            added_groups.append(group_name)
-            new_group = {}
-            new_group['name'] = group_name
-            new_group['type'] = group_type
-            click.echo(f"create {' '.join(group_type.split('_'))}: {group_name}")
-            if not dry_run:
-                response = api2.create_group(group_name, group_type)
-
-    # remove groups that do not exist in the users file
-    local_group_names = []
-    for group in local_groups:
-        local_group_names.append(group['name'])
-
-    removed_groups = []
-    for jc_group in jc_groups_request:
-        jc_group_type = jc_group['_type']
-        jc_group_name = jc_group['_name']
-        do_remove_group = False
-        if jc_group_name not in local_group_names:
-            do_remove_group = True
-
-        if do_remove_group:
-            removed_groups.append(jc_group)
-            click.echo(f"remove {' '.join(jc_group_type.split('_'))}: {jc_group_name}")
-            if not dry_run:
-                response = api2.delete_group(jc_group_name)
-
-
-def sync_users(ctx, users):
-    # pylint: disable-msg=too-many-locals
-    # pylint: disable-msg=too-many-branches
-    # pylint: disable-msg=too-many-statements
-    """
-    Sync Jumpcloud users with definition in data file
+    journal_id = hashlib.sha256(f"{ctx.obj.get('key')}:{os.path.abspath(name)}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, 'journals', journal_id + '.jsonl')
+
+
+def start_journal(ctx, path, plan):
+    """
+    Start the journal of a sync, or exit with an error if another sync of the same file is running
+    :param ctx: Click context
+    :param path: the journal file
+    :param plan: the plan about to be applied
+    :return: a SyncJournal
+    """
+    try:
+        return SyncJournal.start(path, plan)
+    except ValueError as error:
+        ctx.obj.get('logger').error(f"cannot sync: {error}")
+        sys.exit(1)
+
+
+def resume_journal(ctx, path):
+    """
+    Open the journal of an interrupted sync, or exit with an error if there is none
     :param ctx: Click context
-    :param users: users from data file
-    :return:
+    :param path: the journal file
+    :return: a SyncJournal
+    """
+    try:
+        return SyncJournal.resume(path)
+    except FileNotFoundError:
+        ctx.obj.get('logger').error("there is no interrupted sync to resume")
+        sys.exit(1)
+    except ValueError as error:
+        ctx.obj.get('logger').error(f"cannot resume: {error}")
+        sys.exit(1)
+
+
+def remaining_operations(journal):
+    """
+    :param journal: a SyncJournal
+    :return: the operations of the journal's plan which have not been applied yet
+    """
+    return [operation for index, operation in enumerate(journal.plan['operations']) if index not in journal.applied]
+
+
+def make_plan(ctx, api1, api2, data, fingerprint=True):
+    """
+    Fetch users and groups from Jumpcloud and work out the changes needed to sync them with a data file
+    :param ctx: Click context
+    :param api1: a JumpcloudApiV1
+    :param api2: a JumpcloudApiV2
+    :param data: the data file
+    :param fingerprint: whether to record the state fingerprint of Jumpcloud in the plan
+    :return: the plan
     """
-    local_users = users
-    key = ctx.obj.get('key')
     logger = ctx.obj.get('logger')
-    dry_run = ctx.params.get('dry_run')
-
-    api1 = JumpcloudApiV1(key)
-    jc_usernames = []
-    jc_emails = []
-    jc_users = []
-    jc_users_request = api1.search_users()
-    if jc_users_request:
-        for jc_user in jc_users_request:
-            jc_usernames.append(jc_user['username'])
-            jc_emails.append(jc_user['email'])
-            jc_users.append({'username': jc_user['username'], 'email': jc_user['email']})
-
-    logger.debug(f"jumpcloud users: {jc_usernames}")
-
-    # create new users
-    api2 = JumpcloudApiV2(key)
-    added_users = []
-    for user in local_users:
-        do_create_user = False
-        try:
-            user_name = user['username']
-            user_email = user['email']
-            if (user_name not in jc_usernames) and (user_email not in jc_emails):
-                do_create_user = True
-            else:
-                logger.debug(f"{user_name} user already exists")
-        except KeyError as error:
-            raise error
-
-        if do_create_user:
-            added_users.append({'username': user_name, 'email': user_email})
-            new_user = {}
-            new_user['username'] = user_name
-            new_user['email'] = user_email
-            new_user['firstname'] = user['firstname']
-            new_user['firstname'] = user['lastname']
-            click.echo(f"create user: {user_name}")
-            if not dry_run:
-                response = api1.create_user(new_user)
-                group_id, group_type = api2.get_group("staff")
-                if group_id:
-                    user_id = api1.get_user_id(user_name)
-                    click.echo(f"bind {user_id} to group: {group_id}")
-                    if not dry_run:
-                        api2.bind_user_to_group(user_id, group_id)
-
-    # remove users that do not exist in the users file
-    local_usernames = []
-    local_emails = []
-    for user in users:
-        local_usernames.append(user['username'])
-        local_emails.append(user['email'])
-
-    removed_users = []
-    for jc_user in jc_users:
-        do_remove_user = False
-        user_name = jc_user['username']
-        user_email = jc_user['email']
-        if (user_name not in local_usernames) and (user_email not in local_emails):
-            do_remove_user = True
-
-        if do_remove_user:
-            removed_users.append(jc_user)
-            click.echo(f"remove user: {user_name}")
-            if not dry_run:
-                response = api1.delete_user(username=user_name)
+
+    # The fingerprint is taken before the fetch, so that changes made during the fetch make the plan stale
+    state = sync_plan.get_fingerprint(api1, api2) if fingerprint else None
+
+    try:
+        content = jccli_helpers.load_data_file(data, cache_dir=CACHE_DIR)
+    except (ValueError, yaml.YAMLError) as error:
+        logger.error(f"invalid data file: {error}")
+        sys.exit(1)
+    groups = content.get('groups') or []
+    users = content.get('users') or []
+
+    logger.debug("--- sync groups ----")
+    jc_groups = api2.get_groups()
+    logger.debug(f"jumpcloud groups: {[jc_group['name'] for jc_group in jc_groups]}")
+
+    logger.debug("--- sync users ----")
+    jc_users = api1.search_users()
+    logger.debug(f"jumpcloud users: {[jc_user['username'] for jc_user in jc_users]}")
+
+    # Only the groups which list their members in the data file need their current members fetched
+    members_groups = {sync_plan.group_key(group) for group in groups if 'members' in group}
+    jc_members = api2.list_groups_users(
+        [jc_group['id'] for jc_group in jc_groups if sync_plan.group_key(jc_group) in members_groups], use_cache=False)
+
+    try:
+        return sync_plan.make_plan(groups, users, jc_groups, jc_users, remote_members=jc_members, fingerprint=state)
+    except ValueError as error:
+        logger.error(f"invalid data file: {error}")
+        sys.exit(1)
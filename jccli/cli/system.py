@@ -1,5 +1,6 @@
 import json
 import click
+from jccli.helpers import iter_json_list
 from jccli.jc_api_v1 import JumpcloudApiV1
 
 
@@ -19,7 +20,7 @@ def get_system(ctx, system_id):
     """
     Detail view of system.
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     response = api1.get_system(system_id=system_id)
     serialized_response = json.dumps(response, indent=2)
     click.echo(f"{serialized_response}")
@@ -42,10 +43,10 @@ def list_systems(ctx, **kwargs):
         if value is not None:
             filter[field_name] = value
 
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
-    response = api1.search_systems(filter)
-    serialized_response = json.dumps(response, indent=2)
-    click.echo(f"{serialized_response}")
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    for chunk in iter_json_list(api1.iter_systems(filter)):
+        click.echo(chunk, nl=False)
+    click.echo()
 
 
 @system.command('set')
@@ -60,7 +61,7 @@ def set_system(ctx, system_id, **kwargs):
     """
     Set attributes for system with given ID.
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
 
     attributes = {key: value for key, value in kwargs.items() if value is not None and value != (None,)}
 
@@ -75,6 +76,6 @@ def delete_system(ctx, system_id):
     """
     Delete a system.
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     response = api1.delete_system(system_id=system_id)
     click.echo(f"successfully deleted system {system_id}")
@@ -1,7 +1,12 @@
 import json
+import sys
 import click
 
+from jccli import helpers as jccli_helpers
+from jccli.helpers import iter_json_list
 from jccli.jc_api_v1 import JumpcloudApiV1
+from jccli.errors import JcCliError, SystemUserNotFoundError
+from jccli.jc_api_v2 import JumpcloudApiV2, BULK_CREATE_FIELDS, BULK_UPDATE_FIELDS
 
 
 @click.group()
@@ -28,7 +33,7 @@ def create_user(ctx, username, email, firstname, lastname, allow_public_key, lda
     """
     Create a new user
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger = ctx.obj.get('logger')
     systemuser = {
         'username': username,
@@ -44,6 +49,31 @@ def create_user(ctx, username, email, firstname, lastname, allow_public_key, lda
     click.echo(f"{response}")
 
 
+@user.command('create-bulk')
+@click.option('--data', "-d", required=True, type=click.Path(exists=True),
+              help='A data file listing the users to create (same format as for sync)')
+@click.pass_context
+def create_users(ctx, data):
+    """
+    Create many users. Users with only a username, email, name and custom attributes are created with one bulk job;
+    other users are created with one request per user.
+    """
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    users = jccli_helpers.get_users_from_file(data)
+    bulk_users = [user for user in users if all(field in BULK_CREATE_FIELDS for field in user)]
+    single_users = [user for user in users if not all(field in BULK_CREATE_FIELDS for field in user)]
+
+    results = []
+    if bulk_users:
+        results.extend(api1.fill_user_ids(api2.bulk_create_users(bulk_users)))
+    if single_users:
+        results.extend(api1.create_users(single_users))
+    click.echo(json.dumps(results, indent=2))
+    if any(result['status'] != 'finished' for result in results):
+        sys.exit(1)
+
+
 @user.command("get")
 @click.option('--username', '-u', required=True, type=str)
 @click.pass_context
@@ -51,7 +81,7 @@ def get_user(ctx, username):
     """
     Detail view of user, outputted in JSON.
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger = ctx.obj.get('logger')
     response = api1.get_user(username=username)
     serialized_response = json.dumps(response, indent=2)
@@ -71,11 +101,11 @@ def list_users(ctx, **kwargs):
         if value:
             filter[field_name] = value
 
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     logger = ctx.obj.get('logger')
-    response = api1.search_users(filter)
-    serialized_response = json.dumps(response, indent=2)
-    click.echo(f"{serialized_response}")
+    for chunk in iter_json_list(api1.iter_users(filter)):
+        click.echo(chunk, nl=False)
+    click.echo()
 
 
 @user.command('set')
@@ -88,7 +118,7 @@ def set_user(ctx, username, email, firstname, lastname):
     """
     Set user attributes
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
 
     attributes = {}
     if email is not None:
@@ -103,6 +133,48 @@ def set_user(ctx, username, email, firstname, lastname):
     click.echo(f'{response}')
 
 
+@user.command('set-bulk')
+@click.argument('changes', type=click.File('r'), default='-')
+@click.pass_context
+def set_users(ctx, changes):
+    """
+    Set attributes of many users. CHANGES is a JSON or YAML file (or '-' for stdin) mapping usernames to attributes.
+    Changes to email, name and custom attributes are sent as one bulk job; other changes are sent as one request per
+    user.
+    """
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    api2 = JumpcloudApiV2(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
+    logger = ctx.obj.get('logger')
+    attributes_by_username = jccli_helpers.get_user_changes_from_file(changes)
+
+    results = []
+    bulk_updates = []
+    single_updates = {}
+    for username, attributes in attributes_by_username.items():
+        try:
+            user_id = api1.get_user_id(username)
+        except SystemUserNotFoundError as error:
+            results.append({'username': username, 'id': None, 'status': 'failed', 'status_msg': str(error)})
+            continue
+        if all(field in BULK_UPDATE_FIELDS for field in attributes):
+            bulk_updates.append({'id': user_id, 'username': username, 'changes': attributes})
+        else:
+            single_updates[username] = attributes
+
+    if bulk_updates:
+        try:
+            results.extend(api2.bulk_update_users(bulk_updates))
+        except JcCliError as error:
+            logger.warning(f"bulk update failed, updating users one at a time: {error}")
+            single_updates.update({update['username']: update['changes'] for update in bulk_updates})
+    if single_updates:
+        results.extend(api1.set_users(single_updates))
+
+    click.echo(json.dumps(results, indent=2))
+    if any(result['status'] != 'finished' for result in results):
+        sys.exit(1)
+
+
 @user.command("delete")
 @click.option('--username', "-u", required=True, type=str)
 @click.pass_context
@@ -110,5 +182,5 @@ def delete_user(ctx, username):
     """
     Delete a user
     """
-    api1 = JumpcloudApiV1(ctx.obj.get('key'))
+    api1 = JumpcloudApiV1(ctx.obj.get('key'), cache=ctx.obj.get('cache'))
     response = api1.delete_user(username=username)
@@ -7,6 +7,7 @@ from pathlib import Path
 DEFAULT_SECTION = 'DEFAULT'
 CONFIG_FILE_PATH = str(Path.home().joinpath('.jccli.ini'))
 CONFIG_DEFAULTS = {}
+CACHE_DIR = str(Path(os.environ.get('XDG_CACHE_HOME') or Path.home().joinpath('.cache')).joinpath('jccli'))
 
 
 def load_config(profile=DEFAULT_SECTION):
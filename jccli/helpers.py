@@ -8,13 +8,53 @@ This is a set of helper methods
 
 """
 
+import csv
+import hashlib
 import json
+import os
+import pickle
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from distutils.util import strtobool
+from functools import lru_cache
+from itertools import count, islice
+
 import yaml
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import fcntl
+except ImportError:
+    # Advisory file locks are not available on Windows
+    fcntl = None
+
+
+# Conversions from strings to the scalar types of the generated models, by swagger type
+SCALAR_CONVERTERS = {
+    'bool': lambda value: bool(strtobool(value)),
+    'int': int,
+    'float': float
+}
+
+# The C implementation of the YAML loader, when PyYAML was built with libyaml
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Extensions of the data file formats which are read one record at a time
+RECORDS_FORMATS = ('.jsonl', '.ndjson', '.csv')
 
 # Total number of results to allow in one API request
 PAGE_LIMIT = 100
 
+# Default number of pages to request concurrently
+MAX_WORKERS = 8
+
 
 def class_to_dict(class_object):
     """
@@ -41,24 +81,156 @@ def make_query_filter(filter):
     return query_filter
 
 
+def iter_pages(fetch_page, max_workers=MAX_WORKERS, limit=PAGE_LIMIT):
+    """
+    Iterate over the pages of a paginated listing, in order. The first page is requested on its own to learn the total
+    number of results; after that up to `max_workers` pages are kept in flight, so the next pages are being fetched
+    while the caller handles the current one.
+
+    If the total is not known (`total_count` is None), pages are requested speculatively until a page comes back
+    short, so no request is spent on a trailing empty page when the last page is not full.
+    :param fetch_page: a function taking a `skip` offset and returning a tuple `(results, total_count)`
+    :param max_workers: maximum number of pages to request at once
+    :param limit: the page size requested by `fetch_page`
+    :return: a generator of lists of results
+    """
+    results, total_count = fetch_page(0)
+    yield list(results)
+    page_size = len(results)
+
+    if total_count is not None:
+        if page_size == 0 or page_size >= total_count:
+            return
+        skips = iter(range(page_size, total_count, page_size))
+    else:
+        if page_size < limit:
+            return
+        skips = count(page_size, page_size)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(fetch_page, skip) for skip in islice(skips, max_workers))
+        try:
+            while pending:
+                page, _ = pending.popleft().result()
+                yield list(page)
+                if total_count is None and len(page) < page_size:
+                    return
+                skip = next(skips, None)
+                if skip is not None:
+                    pending.append(executor.submit(fetch_page, skip))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def get_pages(fetch_page, max_workers=MAX_WORKERS, limit=PAGE_LIMIT):
+    """
+    Fetch every page of a paginated listing (see `iter_pages`)
+    :return: a list of all results
+    """
+    return [result for page in iter_pages(fetch_page, max_workers, limit) for result in page]
+
+
+def unique_by_id(records):
+    """
+    Drop records whose `id` has already been seen, keeping the first occurrence. Records can shift between pages
+    while a listing is being fetched concurrently, so the same record may appear twice.
+    :return: a generator of records
+    """
+    seen = set()
+    for record in records:
+        record_id = record.get('id')
+        if record_id is None or record_id not in seen:
+            seen.add(record_id)
+            yield record
+
+
+def iter_json_list(items, indent=2):
+    """
+    Serialize a list as JSON piece by piece, so output can start before the last item is available. The
+    concatenated pieces are identical to `json.dumps(list(items), indent=indent)`.
+    :param items: an iterable of JSON-serializable items
+    :return: a generator of strings
+    """
+    prefix = ' ' * indent
+    separator = '[\n'
+    for item in items:
+        yield separator + '\n'.join(prefix + line for line in json.dumps(item, indent=indent).split('\n'))
+        separator = ',\n'
+    yield '[]' if separator == '[\n' else '\n]'
+
+
+def read_json(response):
+    """
+    Decode the JSON body of an API response requested with `_preload_content=False`, and release its connection back
+    to the pool. A faster decoder (orjson) is used when it is installed.
+    :param response: a urllib3 response
+    :return: the decoded JSON
+    """
+    try:
+        return json_loads(response.data)
+    finally:
+        response.release_conn()
+
+
+def json_to_dict(data, model_class, api_module):
+    """
+    Convert decoded JSON into the dict `model_class` would give from `to_dict()`, without building any model objects.
+    Keys are renamed with the model's attribute map, recursively; values are otherwise left as decoded (e.g. dates
+    stay strings).
+    :param data: decoded JSON for one `model_class` object
+    :param model_class: a generated model class, e.g. `jcapiv1.Systemuserslist`
+    :param api_module: the generated api package the model belongs to, `jcapiv1` or `jcapiv2`
+    :return: a dict
+    """
+    if data is None:
+        return None
+    return {attribute: _convert_json(data.get(json_key), swagger_type, api_module)
+            for attribute, json_key, swagger_type in _model_fields(model_class)}
+
+
+@lru_cache(maxsize=None)
+def _model_fields(model_class):
+    return tuple((attribute, model_class.attribute_map[attribute], swagger_type)
+                 for attribute, swagger_type in model_class.swagger_types.items())
+
+
+def _convert_json(value, swagger_type, api_module):
+    if value is None:
+        return None
+    match = re.match(r'list\[(.*)\]$', swagger_type)
+    if match:
+        return [_convert_json(item, match.group(1), api_module) for item in value]
+    match = re.match(r'dict\(([^,]*), (.*)\)$', swagger_type)
+    if match:
+        return {key: _convert_json(item, match.group(2), api_module) for key, item in value.items()}
+    model_class = getattr(api_module, swagger_type, None)
+    if isinstance(value, dict) and hasattr(model_class, 'swagger_types'):
+        return json_to_dict(value, model_class, api_module)
+    return value
+
+
+def convert_scalar(value, swagger_type):
+    """
+    Convert a string, e.g. from a CSV cell or a quoted YAML value, to a scalar type of a generated model
+    :param value: the value to convert
+    :param swagger_type: the type of the model attribute, e.g. 'bool' or 'int'
+    :return: the converted value; values which are not strings, and values of other types, are returned as they are
+    :raises ValueError: if the string does not hold a value of the type
+    """
+    converter = SCALAR_CONVERTERS.get(swagger_type)
+    if converter is None or not isinstance(value, str):
+        return value
+    return converter(value.strip())
+
+
 def get_users_from_file(data_file):
     """
     Get users from a data file
     :param data_file:
     :return: a list of SystemUsers
     """
-    users = []
-    try:
-        with open(data_file, 'r') as file:
-            jc_config = yaml.safe_load(file)
-            users = jc_config['users']
-
-    except (KeyError) as error:
-        pass
-    except Exception as error:
-        raise error
-
-    return users
+    return load_data_file(data_file).get('users') or []
 
 
 def get_groups_from_file(data_file):
@@ -67,18 +239,182 @@ def get_groups_from_file(data_file):
     :param data_file: data file
     :return: a list of jumpcloud groups
     """
-    groups = []
+    return load_data_file(data_file).get('groups') or []
+
+
+def load_data_file(data_file, cache_dir=None):
+    """
+    Parse a data file, for both its users and its groups. JSON files are parsed with the JSON parser, which is much
+    faster than a YAML loader, JSON Lines (.jsonl, .ndjson) and CSV (.csv) files one record at a time (see
+    `iter_data_records`), and other files with the C YAML loader when PyYAML has it.
+
+    With a `cache_dir`, the parsed data is kept there and reused while the file keeps the same modification time and
+    size, or the same content hash, so that repeated runs against a large file skip the parse.
+    :param data_file: the path to a JSON or YAML data file
+    :param cache_dir: a directory to cache parsed data files in
+    :return: the parsed data, a dict
+    """
+    stat = os.stat(data_file)
+    cache_file = None
+    content_hash = None
+    data = None
+    if cache_dir is not None:
+        path_hash = hashlib.sha256(os.path.abspath(data_file).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, 'parsed', path_hash + '.pickle')
+        cached = _read_parse_cache(cache_file)
+        if cached is not None and (cached['mtime_ns'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+            return cached['data']
+        content_hash = _hash_file(data_file)
+        if cached is not None and cached['sha256'] == content_hash:
+            data = cached['data']
+
+    if data is None:
+        data = _parse_data_file(data_file)
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            raise ValueError("a data file must map 'users' and 'groups' to lists")
+
+    if cache_file is not None:
+        _write_parse_cache(cache_file, {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': content_hash,
+            'data': data
+        })
+    return data
+
+
+def _parse_data_file(data_file):
+    """
+    Parse a data file according to its extension (see `load_data_file`)
+    """
+    data_format = os.path.splitext(data_file)[1].lower()
+    if data_format in RECORDS_FORMATS:
+        data = {'users': [], 'groups': []}
+        with open(data_file, 'r', encoding='utf-8-sig', newline='') as file:
+            for kind, record in iter_data_records(file, data_format):
+                data[kind + 's'].append(record)
+        return data
+    with open(data_file, 'rb') as file:
+        if data_format == '.json':
+            return json_loads(file.read())
+        return yaml.load(file, Loader=YAML_LOADER)
+
+
+def _hash_file(path):
+    """
+    :return: the sha256 hex digest of the content of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_data_records(lines, data_format):
+    """
+    Iterate over the records of a JSON Lines or CSV data file, one line at a time. A record is a user if it has a
+    'username', and a group if it has a 'name' and a 'type'; an optional 'kind' field ('user' or 'group') says which
+    explicitly. The 'members' of a group are a list in JSON Lines and are separated by ';' in CSV. Empty CSV cells are
+    left out of the records, so users and groups can share the columns of one file.
+    :param lines: an iterable of the lines of the file
+    :param data_format: the extension of the file: '.jsonl', '.ndjson' or '.csv'
+    :return: a generator of ('user' or 'group', record dict) pairs
+    """
+    if data_format == '.csv':
+        records = ({field: value for field, value in row.items() if field and value not in (None, '')}
+                   for row in csv.DictReader(lines))
+    else:
+        records = (json_loads(line) for line in lines if line.strip())
+
+    for number, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            raise ValueError(f"record {number}: not an object")
+        kind = record.pop('kind', None)
+        if kind is None:
+            if 'username' in record:
+                kind = 'user'
+            elif 'name' in record and 'type' in record:
+                kind = 'group'
+        if kind not in ('user', 'group'):
+            raise ValueError(f"record {number}: neither a user nor a group")
+        if isinstance(record.get('members'), str):
+            record['members'] = [member.strip() for member in record['members'].split(';') if member.strip()]
+        yield kind, record
+
+
+def _read_parse_cache(cache_file):
+    """
+    :return: an entry of the parse cache, or None if there is none (or it cannot be read)
+    """
     try:
-        with open(data_file, 'r') as file:
-            jc_config = yaml.safe_load(file)
-            groups = jc_config['groups']
+        with open(cache_file, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.PickleError):
+        return None
 
-    except (KeyError) as error:
-        pass
-    except Exception as error:
-        raise error
 
-    return groups
+def _write_parse_cache(cache_file, entry):
+    """
+    Write an entry of the parse cache, through a temporary file so that readers never see half an entry
+    """
+    os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+    descriptor, temp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+def lock_file(file, blocking=True):
+    """
+    Take an exclusive advisory lock on an open file, shared with other processes. The lock is released when the file
+    is closed. Where file locks are not available, this does nothing.
+    :param file: an open file
+    :param blocking: wait for the lock if another process holds it
+    :return: whether the lock was taken, which is only False if `blocking` is False
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Hold an exclusive advisory lock on a lock file, created if needed, for the duration of a with block
+    :param path: the lock file
+    :param blocking: wait for the lock if another process holds it
+    :return: whether the lock was taken, as the target of the with statement
+    """
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    with open(path, 'a') as file:
+        yield lock_file(file, blocking=blocking)
+
+
+def get_user_changes_from_file(changes_file):
+    """
+    Get user attribute changes from a JSON or YAML file
+    example:
+     jsmith:
+       email: jsmith@sagebase.org
+       lastname: Smith
+    :param changes_file: an open file
+    :return: a dict of dicts of attributes, by username
+    """
+    changes = yaml.load(changes_file, Loader=YAML_LOADER) or {}
+    if not isinstance(changes, dict) or not all(isinstance(value, dict) for value in changes.values()):
+        raise ValueError("user changes must map usernames to attributes")
+    return changes
 
 
 def get_user_from_term(input):
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.jc_api_async.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+This is an asyncio library for the jumpcloud version 1 and version 2 apis
+
+Every operation is a coroutine and all requests go through one aiohttp session, with at most `max_concurrency`
+requests in flight at a time. Requests follow the same retry and rate limiting policy (:mod:`jccli.retry`) as the
+synchronous wrappers, and records are returned as the same dicts the synchronous wrappers return.
+
+.. note::
+
+    This module requires aiohttp, which can be installed with `pip install jccli[async]`.
+"""
+import asyncio
+from urllib.parse import quote
+
+import jcapiv1
+import jcapiv2
+
+from jccli.errors import SystemUserNotFoundError, JcApiException
+from jccli.helpers import make_query_filter, json_to_dict, json_loads, unique_by_id, PAGE_LIMIT, MAX_WORKERS
+from jccli.jc_api_client import MAX_POOL_SIZE
+from jccli.jc_api_v1 import new_user_properties
+from jccli.jc_api_v2 import get_total_count
+from jccli.retry import get_limiter, get_policy
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+V1_URL = 'https://console.jumpcloud.com/api'
+V2_URL = 'https://console.jumpcloud.com/api/v2'
+
+
+class AsyncJumpcloudApi:
+    """
+        Asyncio wrapper for Jumpcloud API v1 and v2
+    """
+    def __init__(self, api_key, max_concurrency=MAX_WORKERS):
+        """
+        :param api_key: JumpCloud API key
+        :param max_concurrency: maximum number of requests in flight at a time
+        """
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the HTTP session
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if aiohttp is None:
+            raise ImportError("AsyncJumpcloudApi requires aiohttp (pip install jccli[async])")
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=MAX_POOL_SIZE),
+                headers={
+                    'x-api-key': self.api_key,
+                    'Content-Type': 'application/json',
+                    'Accept': 'application/json'
+                }
+            )
+        return self._session
+
+    async def _request(self, method, url, body=None, params=None, missing_ok=False):
+        """
+        Make one API request, retrying it according to the retry policy
+        :param missing_ok: return no data instead of raising an exception if the API responds with 404
+        :return: a tuple of the decoded JSON body (None if the body is empty) and the response headers
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        attempt = 0
+        while True:
+            limiter = get_limiter(self.api_key)
+            if limiter is not None:
+                await asyncio.sleep(limiter.reserve())
+            async with self._semaphore:
+                async with self._get_session().request(method, url, json=body, params=params) as response:
+                    data = await response.read()
+                    status, headers = response.status, response.headers
+            if status == 404 and missing_ok:
+                return None, headers
+            if status < 400:
+                return (json_loads(data) if data else None), headers
+
+            policy = get_policy()
+            if not policy.should_retry(method, url, status, attempt):
+                raise JcApiException("%s %s returned %s: %s" % (method, url, status, data))
+            await asyncio.sleep(policy.delay(attempt, headers.get('Retry-After')))
+            attempt += 1
+
+    async def _get_pages(self, fetch_page):
+        """
+        Fetch every page of a paginated listing. After the first page, the remaining pages are requested
+        concurrently; if the total is unknown they are requested in windows of `max_concurrency` pages until one comes
+        back short.
+        :param fetch_page: a coroutine function taking a `skip` offset and returning `(results, total_count)`
+        :return: a list of all results
+        """
+        results, total_count = await fetch_page(0)
+        page_size = len(results)
+        if total_count is not None:
+            if page_size == 0 or page_size >= total_count:
+                return results
+            pages = await asyncio.gather(*[fetch_page(skip) for skip in range(page_size, total_count, page_size)])
+            return results + [result for page, _ in pages for result in page]
+
+        if page_size < PAGE_LIMIT:
+            return results
+        skip = page_size
+        while True:
+            window = [skip + i * page_size for i in range(self.max_concurrency)]
+            for page, _ in await asyncio.gather(*[fetch_page(skip) for skip in window]):
+                results.extend(page)
+                if len(page) < page_size:
+                    return results
+            skip += self.max_concurrency * page_size
+
+    async def _search(self, path, filter, model_class):
+        query_filter = make_query_filter(filter)
+
+        async def fetch_page(skip):
+            data, _ = await self._request('POST', V1_URL + path, body={
+                'filter': query_filter,
+                'limit': PAGE_LIMIT,
+                'skip': skip
+            })
+            data = json_to_dict(data, model_class, jcapiv1)
+            return data['results'], data['total_count']
+
+        return list(unique_by_id(await self._get_pages(fetch_page)))
+
+    async def search_users(self, filter={}):
+        """
+        Search for users on JumpCloud. `filter` can contain values for multiple fields, which will be combined with an
+        AND operator.
+        :param filter: (dict) an object used to filter search results for various fields
+        :return: a list of user dicts
+        """
+        return await self._search('/search/systemusers', filter, jcapiv1.Systemuserslist)
+
+    async def get_user_id(self, username):
+        """
+        Get the jumpcloud user id from the user name
+        :param username
+        :return:  the user id
+        """
+        return (await self.get_user(username))['id']
+
+    async def get_user(self, username):
+        """
+        Get detail view of a user object.
+        :param username:
+        :return: user properties dict
+        """
+        for user in await self.search_users({'username': username}):
+            if user['username'] == username:
+                return user
+        raise SystemUserNotFoundError('No user found for username: %s' % (username,))
+
+    async def retrieve_users(self, user_ids=[]):
+        """
+        Retrieve a list of users corresponding to ids. Ids that do not match a user are skipped.
+        """
+        async def fetch_user(user_id):
+            data, _ = await self._request('GET', V1_URL + '/systemusers/' + quote(user_id), missing_ok=True)
+            return json_to_dict(data, jcapiv1.Systemuserreturn, jcapiv1)
+
+        users = await asyncio.gather(*[fetch_user(user_id) for user_id in dict.fromkeys(user_ids)])
+        return [user for user in users if user is not None]
+
+    async def create_user(self, systemuser):
+        """
+        Create a new user in jumpcloud
+        :param systemuser: a dictionary of Systemuser properties, as for `JumpcloudApiV1.create_user`
+        :return: the created user
+        """
+        body = {jcapiv1.Systemuserputpost.attribute_map[key]: value
+                for key, value in new_user_properties(systemuser).items()}
+        data, _ = await self._request('POST', V1_URL + '/systemusers', body=body)
+        return json_to_dict(data, jcapiv1.Systemuserreturn, jcapiv1)
+
+    async def set_user(self, username, attributes):
+        """
+        Set attributes of a user
+        :param username: the user name
+        :param attributes: dictionary of Systemuserput attributes to be updated
+        :return: the updated user
+        """
+        user_id = await self.get_user_id(username)
+        body = {jcapiv1.Systemuserput.attribute_map[key]: value for key, value in attributes.items()}
+        data, _ = await self._request('PUT', V1_URL + '/systemusers/' + quote(user_id), body=body)
+        return json_to_dict(data, jcapiv1.Systemuserreturn, jcapiv1)
+
+    async def delete_user(self, username):
+        """
+        Delete a user from jumpcloud
+        :param username: the user name
+        :return: the deleted user
+        """
+        user_id = await self.get_user_id(username)
+        data, _ = await self._request('DELETE', V1_URL + '/systemusers/' + quote(user_id))
+        return json_to_dict(data, jcapiv1.Systemuserreturn, jcapiv1)
+
+    async def search_systems(self, filter={}):
+        """
+        Search for systems on JumpCloud. `filter` can contain values for multiple fields, which will be combined with
+        an AND operator.
+        :param filter: (dict) an object used to filter search results for various fields
+        :return: a list of system dicts
+        """
+        return await self._search('/search/systems', filter, jcapiv1.Systemslist)
+
+    async def get_system(self, system_id):
+        """
+        Get detail view of a system.
+        :param system_id: the id of the system
+        :return: system properties dict
+        """
+        data, _ = await self._request('GET', V1_URL + '/systems/' + quote(system_id))
+        return json_to_dict(data, jcapiv1.System, jcapiv1)
+
+    async def set_system(self, system_id, attributes):
+        """
+        Set attributes of system with the given system ID.
+        :param system_id: the id of the system
+        :param attributes: dictionary of Systemput attributes to be updated
+        :return: system properties dict
+        """
+        body = {jcapiv1.Systemput.attribute_map[key]: value for key, value in attributes.items()}
+        data, _ = await self._request('PUT', V1_URL + '/systems/' + quote(system_id), body=body)
+        return json_to_dict(data, jcapiv1.System, jcapiv1)
+
+    async def delete_system(self, system_id):
+        """
+        Delete a system with the given ID.
+        :param system_id: the id of the system
+        :return: system properties dict of the deleted system
+        """
+        data, _ = await self._request('DELETE', V1_URL + '/systems/' + quote(system_id))
+        return json_to_dict(data, jcapiv1.System, jcapiv1)
+
+    async def get_groups(self, type=None):
+        """
+        Get all jumpcloud groups
+        :param type: optionally, only get groups of this type
+        :return: A list of jumpcloud groups
+        """
+        params = {'limit': PAGE_LIMIT}
+        if type:
+            params['filter'] = 'type:eq:%s' % (type,)
+
+        async def fetch_page(skip):
+            data, headers = await self._request('GET', V2_URL + '/groups', params=dict(params, skip=skip))
+            return [json_to_dict(group, jcapiv2.Group, jcapiv2) for group in data], get_total_count(headers)
+
+        return list(unique_by_id(await self._get_pages(fetch_page)))
+
+    async def get_group(self, group_name, group_type):
+        """
+        Get the jumpcloud group info from a Jumpcloud group name
+        :param group_name: name of the JC group
+        :param group_type: type of the JC group
+        :return:  The jumpcloud group, None if the group is not found
+        """
+        data, _ = await self._request('GET', V2_URL + '/groups', params={
+            'filter': 'name:eq:%s' % (group_name,),
+            'limit': PAGE_LIMIT
+        })
+        for group in data:
+            group = json_to_dict(group, jcapiv2.Group, jcapiv2)
+            if group['name'] == group_name and group['type'] == group_type:
+                return group
+        return None
+
+    async def create_group(self, name, type):
+        """
+        Create a Jumpcloud group
+        :param name: The group name
+        :param type: The group type, user_group or system_group
+        :return: the created group
+        """
+        data, _ = await self._request('POST', V2_URL + self._group_path(type), body={'name': name})
+        return json_to_dict(data, jcapiv2.Group, jcapiv2)
+
+    async def delete_group(self, group_id, group_type):
+        """
+        Delete a Jumpcloud group
+        :param group_id: The group id
+        :param group_type: The group type, user_group or system_group
+        """
+        await self._request('DELETE', V2_URL + self._group_path(group_type) + '/' + quote(group_id))
+
+    async def bind_user_to_group(self, user_id, group_id):
+        """
+        Associates a Jumpcloud user to a Jumpcloud user group
+        """
+        await self._request('POST', V2_URL + '/usergroups/%s/members' % (quote(group_id),),
+                            body={'id': user_id, 'op': 'add', 'type': 'user'})
+
+    async def unbind_user_from_group(self, user_id, group_id):
+        """
+        Removes a Jumpcloud user from a Jumpcloud user group
+        """
+        await self._request('POST', V2_URL + '/usergroups/%s/members' % (quote(group_id),),
+                            body={'id': user_id, 'op': 'remove', 'type': 'user'})
+
+    async def list_group_users(self, group_id):
+        """Return a list of user IDs associated with the group ID
+        """
+        async def fetch_page(skip):
+            data, headers = await self._request('GET', V2_URL + '/usergroups/%s/members' % (quote(group_id),),
+                                                params={'limit': PAGE_LIMIT, 'skip': skip})
+            return [connection['to']['id'] for connection in data], get_total_count(headers)
+
+        return list(dict.fromkeys(await self._get_pages(fetch_page)))
+
+    @staticmethod
+    def _group_path(group_type):
+        if group_type == jcapiv2.GroupType.SYSTEM_GROUP:
+            return '/systemgroups'
+        if group_type == jcapiv2.GroupType.USER_GROUP:
+            return '/usergroups'
+        raise ValueError("group type must be system or user")
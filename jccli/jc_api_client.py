@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.jc_api_client.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+Process-wide API clients shared by the jumpcloud version 1 and version 2 api wrappers
+
+Every wrapper gets its api clients from here, so all of them send their requests through one connection pool and
+keep-alive connections are reused across the search, systems, graph and groups apis. Their requests are also rate
+limited and retried according to :mod:`jccli.retry`.
+"""
+import threading
+
+from jccli.retry import with_retries
+
+
+# Default maximum number of connections kept open to the JumpCloud API
+MAX_POOL_SIZE = 32
+
+_LOCK = threading.Lock()
+_API_CLIENTS = {}
+_POOL_MANAGER = None
+_MAX_POOL_SIZE = MAX_POOL_SIZE
+
+
+def set_max_pool_size(max_pool_size):
+    """
+    Set the maximum number of connections kept open to the JumpCloud API. This should be at least as large as the
+    number of concurrent requests the wrappers are allowed to make. Clients created before the call are discarded.
+    :param max_pool_size: maximum number of connections in the shared pool
+    """
+    global _MAX_POOL_SIZE
+    with _LOCK:
+        _MAX_POOL_SIZE = max_pool_size
+        _reset()
+
+
+def reset_api_clients():
+    """
+    Discard all shared api clients and their connection pool
+    """
+    with _LOCK:
+        _reset()
+
+
+def _reset():
+    global _POOL_MANAGER
+    _API_CLIENTS.clear()
+    _POOL_MANAGER = None
+
+
+def get_api_client(api_module, api_key):
+    """
+    Get the shared api client for an api module and key, creating it on first use
+    :param api_module: the generated api package, `jcapiv1` or `jcapiv2`
+    :param api_key: JumpCloud API key
+    :return: an `ApiClient` of `api_module`
+    """
+    global _POOL_MANAGER
+    with _LOCK:
+        api_client = _API_CLIENTS.get((api_module.__name__, api_key))
+        if api_client is None:
+            configuration = api_module.Configuration()
+            configuration.api_key['x-api-key'] = api_key
+            configuration.connection_pool_maxsize = _MAX_POOL_SIZE
+            api_client = api_module.ApiClient(configuration)
+            api_client.rest_client.request = with_retries(api_client.rest_client.request, api_key)
+            # Both api versions live on the same host, so one pool manager can serve every client
+            if _POOL_MANAGER is None:
+                _POOL_MANAGER = api_client.rest_client.pool_manager
+            else:
+                api_client.rest_client.pool_manager = _POOL_MANAGER
+            _API_CLIENTS[(api_module.__name__, api_key)] = api_client
+        return api_client
@@ -11,13 +11,44 @@ This is a utility library for the jumpcloud version 1 api
     To learn more about the jumpcloud api 1
     `project website <https://github.com/TheJumpCloud/jcapi-python/tree/master/jcapiv1>`_.
 """
-from distutils.util import strtobool
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import jcapiv1
 from jcapiv1 import Systemuserput, Systemput
 from jcapiv1.rest import ApiException
-from jccli.errors import SystemUserNotFoundError, JcApiException
-from jccli.helpers import class_to_dict, make_query_filter, PAGE_LIMIT
+from jccli.cache import get_user_index
+from jccli.errors import SystemUserNotFoundError, JcApiException, JcCliError
+from jccli.jc_api_client import get_api_client
+from jccli.helpers import class_to_dict, convert_scalar, make_query_filter, iter_pages, unique_by_id, read_json, \
+    json_to_dict, PAGE_LIMIT, MAX_WORKERS
+
+# Seconds by which incremental cache refreshes overlap the previous refresh, so that records created while it was
+# running, or stamped by a server clock a little behind the local one, are not missed
+REFRESH_OVERLAP = 300
+
+
+def new_user_properties(systemuser):
+    """
+    Get the properties of a new user, with the defaults jccli gives the properties it is not given
+    :param systemuser: a dictionary of Systemuser properties; flags and numbers may be given as strings such as "True"
+                       or "5001", and properties a new user cannot have are left out
+    :return: a dict of Systemuserputpost attributes
+    """
+    properties = {
+        'firstname': '',
+        'lastname': '',
+        'allow_public_key': True,
+        'ldap_binding_user': False,
+        'passwordless_sudo': False,
+        'sudo': False
+    }
+    for field, value in systemuser.items():
+        field_type = jcapiv1.Systemuserputpost.swagger_types.get(field)
+        if field_type is not None:
+            properties[field] = convert_scalar(value, field_type)
+    return properties
 
 
 # pylint: disable=too-many-arguments
@@ -25,86 +56,197 @@ class JumpcloudApiV1:
     """
         Wrapper for Jumpcloud API v1
     """
-    def __init__(self, api_key):
-        configuration = jcapiv1.Configuration()
-        configuration.api_key['x-api-key'] = api_key
-        self.system_users_api = jcapiv1.SystemusersApi(jcapiv1.ApiClient(configuration))
-        self.systems_api = jcapiv1.SystemsApi(jcapiv1.ApiClient(configuration))
-        self.search_api = jcapiv1.SearchApi(jcapiv1.ApiClient(configuration))
+    def __init__(self, api_key, max_workers=MAX_WORKERS, cache=None):
+        """
+        :param api_key: JumpCloud API key
+        :param max_workers: maximum number of pages to request concurrently when paginating
+        :param cache: an optional `jccli.cache.DirectoryCache` which keeps users and systems between runs
+        """
+        self.max_workers = max_workers
+        self.cache = cache
+        self.user_index = get_user_index(api_key)
+        api_client = get_api_client(jcapiv1, api_key)
+        self.system_users_api = jcapiv1.SystemusersApi(api_client)
+        self.systems_api = jcapiv1.SystemsApi(api_client)
+        self.search_api = jcapiv1.SearchApi(api_client)
 
     def retrieve_users(self, user_ids=[]):
         """
-        Retrieve a list of users corresponding to ids
+        Retrieve a list of users corresponding to ids. Ids that do not match a user are skipped.
         """
-        # FIXME: This is not an ideal way to do this, but search_systemusers_post doesn't seem to allow filtering on ID
-        all_users = self.search_users()
-        return [user for user in all_users if user['id'] in user_ids]
+        user_ids = list(dict.fromkeys(user_ids))
+        # search_systemusers_post doesn't allow filtering on ID, so the users are either fetched by ID, `max_workers`
+        # at a time, or picked out of a scan of the directory, whichever takes fewer requests
+        if len(user_ids) > 1 and len(user_ids) > -(-self.count_users() // PAGE_LIMIT):
+            wanted = set(user_ids)
+            users = {user['id']: user for user in self.iter_users() if user['id'] in wanted}
+            return [users[user_id] for user_id in user_ids if user_id in users]
 
-    def search_users(self, filter={}):
+        def fetch_user(user_id):
+            try:
+                return self.system_users_api.systemusers_get(
+                    id=user_id,
+                    content_type='application/json',
+                    accept='application/json'
+                ).to_dict()
+            except ApiException as error:
+                if error.status == 404:
+                    return None
+                raise
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                users = list(executor.map(fetch_user, user_ids))
+        except ApiException as error:
+            raise JcApiException("Exception when calling SystemusersApi:\n") from error
+        return [user for user in users if user is not None]
+
+    def search_users(self, filter={}, raw=False):
         """
         Search for users on JumpCloud. `filter` can contain values for multiple fields, which will be combined with an
         AND operator.
 
         :param filter: (dict) an object used to filter search results for various fields. E.g.: `{"firstname": "David",
                        "lastname": "Smith"}` will search for a user with first name "David" and last name "Smith".
+        :param raw: decode the JSON responses straight into dicts, skipping the generated model objects
         :return: List[SystemUser]
         """
+        return list(self.iter_users(filter, raw=raw))
+
+    def iter_users(self, filter={}, raw=False):
+        """
+        Iterate over the users on JumpCloud matching `filter` (see `search_users`). Users are yielded page by page
+        while the next pages are being fetched, so the whole directory is never held in memory.
+
+        :param filter: (dict) an object used to filter search results for various fields
+        :param raw: decode the JSON responses straight into dicts, skipping the generated model objects
+        :return: a generator of user dicts
+        """
         query_filter = make_query_filter(filter)
 
+        def fetch_page(skip):
+            api_response = self.search_api.search_systemusers_post(
+                content_type='application/json',
+                accept='application/json',
+                body={
+                    'filter': query_filter,
+                    'limit': PAGE_LIMIT,
+                    'skip': skip
+                },
+                _preload_content=not raw
+            )
+            if raw:
+                api_response = json_to_dict(read_json(api_response), jcapiv1.Systemuserslist, jcapiv1)
+                return api_response['results'], api_response['total_count']
+            return [user.to_dict() for user in api_response.results], api_response.total_count
+
         try:
-            # Cycle through "limited" (paginated) API responses
-            users = []
-            while True:
-                api_response = self.search_api.search_systemusers_post(
-                    content_type='application/json',
-                    accept='application/json',
-                    body={
-                        'filter': query_filter,
-                        'limit': PAGE_LIMIT,
-                        'skip': len(users)
-                    }
-                )
-                users.extend([user.to_dict() for user in api_response.results])
-                if len(users) == api_response.total_count:
-                    return users
+            pages = iter_pages(fetch_page, max_workers=self.max_workers)
+            yield from unique_by_id(user for page in pages for user in page)
+        except ApiException as error:
+            raise JcApiException("Exception when calling SearchApi:\n") from error
+
+    def count_users(self):
+        """
+        Count the users on JumpCloud with a single one-record search
+        :return: the number of users
+        """
+        return self._count(self.search_api.search_systemusers_post)
+
+    def _count(self, search):
+        """
+        :param search: a search method of the SearchApi
+        :return: the total number of records it finds without a filter
+        """
+        try:
+            api_response = search(
+                content_type='application/json',
+                accept='application/json',
+                body={
+                    'filter': make_query_filter({}),
+                    'limit': 1,
+                    'skip': 0
+                }
+            )
+        except ApiException as error:
+            raise JcApiException("Exception when calling SearchApi:\n") from error
+        return api_response.total_count
+
+    def _search_ids(self, search):
+        """
+        Get the ids of all the records a search method finds, asking for no other field so that pages stay small
+        :param search: a search method of the SearchApi
+        :return: a set of ids
+        """
+        def fetch_page(skip):
+            api_response = search(
+                content_type='application/json',
+                accept='application/json',
+                body={
+                    'filter': make_query_filter({}),
+                    'fields': 'id',
+                    'limit': PAGE_LIMIT,
+                    'skip': skip
+                }
+            )
+            return [record.id for record in api_response.results], api_response.total_count
+
+        try:
+            return {record_id for page in iter_pages(fetch_page, max_workers=self.max_workers) for record_id in page}
         except ApiException as error:
             raise JcApiException("Exception when calling SearchApi:\n") from error
 
     def create_user(self, systemuser):
         """
         Create a new user in jumpcloud
-        :param systemuser: a dictoionary of Systemuser properties
+        :param systemuser: a dictoionary of Systemuser properties; flags and numbers may be given as strings such as
+               "True" or "5001"
                https://github.com/TheJumpCloud/jcapi-java/blob/master/jcapiv1/docs/Systemuser.md
         :return: The api response
         """
-        body = jcapiv1.Systemuserputpost(username=systemuser['username'],
-                                         email=systemuser['email'],
-                                         firstname=systemuser.get('firstname', ''),
-                                         lastname=systemuser.get('lastname', ''),
-                                         allow_public_key=strtobool(
-                                             systemuser.get('allow_public_key', 'True')),
-                                         ldap_binding_user=strtobool(
-                                             systemuser.get('ldap_binding_user', 'False')),
-                                         passwordless_sudo=strtobool(
-                                             systemuser.get('passwordless_sudo', 'False')),
-                                         sudo=strtobool(systemuser.get('sudo', 'False')))
+        body = jcapiv1.Systemuserputpost(**new_user_properties(systemuser))
         try:
             api_response = self.system_users_api.systemusers_post(content_type='application/json',
                                                                   accept='application/json',
                                                                   body=body,
                                                                   x_org_id='')
-            return api_response.to_dict()
         except ApiException as error:
             # FIXME: What should this behavior actually be?
             raise JcApiException("Exception when calling SystemusersApi->systemusers_post: %s\n" % error)
 
-    def delete_user(self, username):
+        user = api_response.to_dict()
+        self._index_user(user)
+        return user
+
+    def create_users(self, systemusers):
+        """
+        Create many users, one request per user and `max_workers` requests at a time
+        :param systemusers: a list of dictionaries of Systemuser properties (see `create_user`)
+        :return: a list with, for each user, a dict with its 'username', 'email', 'id' and a 'status' ('finished' or
+                 'failed', like the work results of a bulk job) and 'status_msg'
+        """
+        def create(systemuser):
+            result = {'username': systemuser['username'], 'email': systemuser['email'], 'id': None,
+                      'status': 'finished', 'status_msg': None}
+            try:
+                result['id'] = self.create_user(systemuser)['id']
+            except (JcCliError, ValueError, TypeError) as error:
+                result['status'] = 'failed'
+                result['status_msg'] = str(error)
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(create, systemusers))
+
+    def delete_user(self, username, user_id=None):
         """
         Delete a user from jumpcloud
-        :param id: The jumpcloud id of the user
+        :param username: The user name
+        :param user_id: The jumpcloud id of the user, if already known
         :return:
         """
-        user_id = self.get_user_id(username)
+        if user_id is None:
+            user_id = self.get_user_id(username)
         if user_id is None:
             raise SystemUserNotFoundError(f"System user {username} not found")
 
@@ -113,30 +255,123 @@ class JumpcloudApiV1:
                                                                     content_type='application/json',
                                                                     accept='application/json',
                                                                     x_org_id='')
-            return api_response
         except ApiException as error:
             raise JcApiException("Exception when calling SystemusersApi\n") from error
 
+        self.user_index.remove(user_id)
+        if self.cache is not None:
+            self.cache.delete_records('users', [user_id])
+        return api_response
+
     def get_user_id(self, username):
         """
-        Get the jumpcloud user id from the user name
+        Get the jumpcloud user id from the user name. The whole directory is fetched once to build an index of user
+        ids, after which lookups are answered from the index.
         :param username
         :return:  the user id
         """
+        self._load_user_index()
+        user_id = self.user_index.id_for_username(username)
+        if user_id is None and not self.user_index.refreshed:
+            # The index was loaded from the local cache, which may not know about users created since
+            self.refresh_user_index()
+            user_id = self.user_index.id_for_username(username)
+
+        if user_id is None:
+            raise SystemUserNotFoundError('No user found for username: %s' % (username,))
+        return user_id
+
+    def _load_user_index(self):
+        """
+        Load the user index from the local cache if there is one, otherwise from the API
+        """
+        if self.user_index.loaded:
+            return
+        if self.cache is not None:
+            users, refreshed = self.cache.get_or_refresh('users', self.refresh_user_index)
+            if not refreshed:
+                self.user_index.load(users)
+            return
+        self.refresh_user_index()
+
+    def refresh_user_index(self):
+        """
+        Rebuild the user index from one fetch of the whole directory
+        :return: the list of users fetched
+        """
         users = self.search_users()
+        self.user_index.load(users, refreshed=True)
+        if self.cache is not None:
+            self.cache.set_records('users', users)
+        return users
+
+    def fill_user_ids(self, users):
+        """
+        Fill in the 'id' of user dicts which lack one (e.g. results of a bulk job), by searching for those users by
+        username rather than fetching the whole directory
+        :param users: a list of dicts with a 'username'
+        :return: `users`
+        """
+        missing = [user['username'] for user in users if user.get('id') is None]
+        if missing:
+            user_ids = {user['username']: user['id'] for user in self.find_users(missing)}
+            for user in users:
+                if user.get('id') is None:
+                    user['id'] = user_ids.get(user['username'])
+        return users
+
+    def find_users(self, usernames):
+        """
+        Fetch the users with the given usernames, and add them to the user index and local cache (e.g. after they were
+        created by a bulk job). Usernames are unique, so `PAGE_LIMIT` usernames are looked up with one search request,
+        `max_workers` requests at a time.
+        :param usernames: a list of usernames
+        :return: a list of the users found, as dicts
+        """
+        usernames = list(dict.fromkeys(usernames))
+
+        def search(chunk):
+            return self.search_api.search_systemusers_post(
+                content_type='application/json',
+                accept='application/json',
+                body={
+                    'filter': {'or': [{'username': username} for username in chunk]},
+                    'limit': PAGE_LIMIT,
+                    'skip': 0
+                }
+            ).results
 
+        chunks = [usernames[i:i + PAGE_LIMIT] for i in range(0, len(usernames), PAGE_LIMIT)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                users = [user.to_dict() for results in executor.map(search, chunks) for user in results]
+        except ApiException as error:
+            raise JcApiException("Exception when calling SearchApi:\n") from error
         for user in users:
-            if user['username'] == username:
-                return user['id']
+            self.user_index.add(user)
+        if self.cache is not None:
+            self.cache.put_records('users', users)
+        return users
 
-        raise SystemUserNotFoundError('No user found for username: %s' % (username,))
+    def _index_user(self, user):
+        """
+        Add a created or updated user to the user index and local cache
+        """
+        self.user_index.add(user)
+        if self.cache is not None:
+            self.cache.put_records('users', [user])
 
     def get_user(self, username):
         """
-        Get detail view of a user object.
-        :param user_id:
+        Get detail view of a user object, from the local cache when it knows the user.
+        :param username: the user name
         :return: user properties dict
         """
+        if self.cache is not None:
+            users = self.cache.find_records('users', username=username)
+            if users:
+                return users[0]
+
         # FIXME: As soon as we figure out how the `filter` parameter works on systemusers_list(), we should start
         #  filtering based on username
         users = self.system_users_api.systemusers_list(
@@ -146,21 +381,55 @@ class JumpcloudApiV1:
 
         for user in users:
             if user.username == username:
-                return user.to_dict()
+                user = user.to_dict()
+                self._index_user(user)
+                return user
 
         raise SystemUserNotFoundError('No user found for username: %s' % (username,))
 
-    def set_user(self, username, attributes):
-        user_id = self.get_user_id(username)
-        api_response = self.system_users_api.systemusers_put(
-            accept='application/json',
-            content_type='application/json',
-            id=user_id,
-            body=Systemuserput(**attributes)
-        )
-        return api_response.to_dict()
+    def set_user(self, username, attributes, user_id=None):
+        """
+        Set attributes of a user
+        :param username: the user name
+        :param attributes: dictionary of attributes to be updated
+        :param user_id: the jumpcloud id of the user, if already known
+        :return: user properties dict
+        """
+        if user_id is None:
+            user_id = self.get_user_id(username)
+        try:
+            api_response = self.system_users_api.systemusers_put(
+                accept='application/json',
+                content_type='application/json',
+                id=user_id,
+                body=Systemuserput(**attributes)
+            )
+        except ApiException as error:
+            raise JcApiException("Exception when calling SystemusersApi:\n") from error
+        user = api_response.to_dict()
+        self._index_user(user)
+        return user
 
-    def search_systems(self, filter={}):
+    def set_users(self, attributes_by_username):
+        """
+        Set attributes of many users, one request per user and `max_workers` requests at a time
+        :param attributes_by_username: a dict of dicts of attributes to be updated, by username
+        :return: a list with, for each user, a dict with its 'username' and 'id', and a 'status' ('finished' or
+                 'failed', like the work results of a bulk job) and 'status_msg'
+        """
+        def update(username):
+            result = {'username': username, 'id': None, 'status': 'finished', 'status_msg': None}
+            try:
+                result['id'] = self.set_user(username, attributes_by_username[username])['id']
+            except (JcCliError, ApiException, TypeError) as error:
+                result['status'] = 'failed'
+                result['status_msg'] = str(error)
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(update, attributes_by_username))
+
+    def search_systems(self, filter={}, raw=False):
         """
         Search for systems on JumpCloud. `filter` can contain values for multiple fields, which will be combined with an
         AND operator.
@@ -168,41 +437,120 @@ class JumpcloudApiV1:
         :param filter: (dict) an object used to filter search results for various fields. E.g.: `{"active":
                        True, "os": "ubuntu-20.04"}` will search for a system that is active and has the operating system
                        "ubuntu-20.04".
+        :param raw: decode the JSON responses straight into dicts, skipping the generated model objects
         :return: List[System]
         """
+        systems = list(self.iter_systems(filter, raw=raw))
+        if not filter and self.cache is not None:
+            self.cache.set_records('systems', systems)
+        return systems
+
+    def iter_systems(self, filter={}, raw=False):
+        """
+        Iterate over the systems on JumpCloud matching `filter` (see `search_systems`). Systems are yielded page by
+        page while the next pages are being fetched.
+
+        :param filter: (dict) an object used to filter search results for various fields
+        :param raw: decode the JSON responses straight into dicts, skipping the generated model objects
+        :return: a generator of system dicts
+        """
         query_filter = make_query_filter(filter)
 
+        def fetch_page(skip):
+            api_response = self.search_api.search_systems_post(
+                content_type='application/json',
+                accept='application/json',
+                body={
+                    'filter': query_filter,
+                    'limit': PAGE_LIMIT,
+                    'skip': skip
+                },
+                _preload_content=not raw
+            )
+            if raw:
+                api_response = json_to_dict(read_json(api_response), jcapiv1.Systemslist, jcapiv1)
+                return api_response['results'], api_response['total_count']
+            return [system.to_dict() for system in api_response.results], api_response.total_count
+
         try:
-            systems = []
-            while True:
-                api_response = self.search_api.search_systems_post(
-                    content_type='application/json',
-                    accept='application/json',
-                    body={
-                        'filter': query_filter,
-                        'limit': PAGE_LIMIT,
-                        'skip': len(systems)
-                    }
-                )
-                systems.extend([system.to_dict() for system in api_response.results])
-                if len(systems) == api_response.total_count:
-                    return systems
+            pages = iter_pages(fetch_page, max_workers=self.max_workers)
+            yield from unique_by_id(system for page in pages for system in page)
         except ApiException as error:
             raise JcApiException("Exception when calling SearchApi:\n") from error
 
+    def refresh_cache(self, full=False):
+        """
+        Bring the cached users and systems up to date with JumpCloud. Only the records created since the last refresh
+        are fetched, and deletions are found by comparing counts, so that a directory which changes little costs a few
+        requests. Records have no modification time, so changes to existing records made outside of jccli are only
+        picked up by a full refresh, and the cached records still expire with the last full refresh.
+        :param full: fetch every record again instead
+        :return: a dict with, for 'users' and 'systems', a dict of the number of records 'fetched' and 'removed', and
+                 whether the refresh was 'full'
+        """
+        if self.cache is None:
+            raise JcCliError("there is no local cache to refresh")
+        return {
+            'users': self._refresh_cached('users', self.search_api.search_systemusers_post, self.iter_users,
+                                          self.refresh_user_index, full),
+            'systems': self._refresh_cached('systems', self.search_api.search_systems_post, self.iter_systems,
+                                            self.search_systems, full)
+        }
+
+    def _refresh_cached(self, kind, search, iter_records, fetch_all, full):
+        """
+        Refresh the cached records of a kind, incrementally if it has been cached before (see `refresh_cache`)
+        :param kind: the kind of record, 'users' or 'systems'
+        :param search: the SearchApi method for the kind
+        :param iter_records: the method iterating over the records of the kind matching a filter
+        :param fetch_all: the method fetching every record of the kind and caching it
+        :param full: whether to fetch every record again anyway
+        """
+        snapshot = None if full else self.cache.get_snapshot_ids(kind)
+        if snapshot is None:
+            return {'fetched': len(fetch_all()), 'removed': 0, 'full': True}
+
+        cached_ids, refreshed_at = snapshot
+        started_at = time.time()
+        since = datetime.fromtimestamp(refreshed_at - REFRESH_OVERLAP, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        created = list(iter_records({'created': {'$gt': since}}))
+        known_ids = cached_ids | {record['id'] for record in created}
+
+        removed_ids = set()
+        if self._count(search) != len(known_ids):
+            remote_ids = self._search_ids(search)
+            if not remote_ids <= known_ids:
+                # Records created before the last refresh are missing, so the snapshot cannot be trusted
+                return self._refresh_cached(kind, search, iter_records, fetch_all, full=True)
+            removed_ids = known_ids - remote_ids
+
+        self.cache.merge_records(kind, created, removed_ids, started_at)
+        if kind == 'users' and self.user_index.loaded:
+            for user in created:
+                self.user_index.add(user)
+            for user_id in removed_ids:
+                self.user_index.remove(user_id)
+        return {'fetched': len(created), 'removed': len(removed_ids), 'full': False}
+
     def get_system(self, system_id):
         """
         Get detail view of a system.
         :param system_id: the id of the system
         :return: system properties dict
         """
+        if self.cache is not None:
+            systems = self.cache.find_records('systems', id=system_id)
+            if systems:
+                return systems[0]
+
         system = self.systems_api.systems_get(
             content_type='application/json',
             accept='application/json',
             id=system_id
-        )
-
-        return system.to_dict()
+        ).to_dict()
+        if self.cache is not None:
+            self.cache.put_records('systems', [system])
+        return system
 
     def set_system(self, system_id, attributes):
         """
@@ -217,7 +565,10 @@ class JumpcloudApiV1:
             content_type='application/json',
             body=Systemput(**attributes)
         )
-        return response.to_dict()
+        system = response.to_dict()
+        if self.cache is not None:
+            self.cache.put_records('systems', [system])
+        return system
 
     def delete_system(self, system_id):
         """
@@ -231,6 +582,8 @@ class JumpcloudApiV1:
                 accept='application/json',
                 content_type='application/json'
             )
-            return response
         except ApiException as error:
             raise JcApiException("Exception when calling SystemApi:\n") from error
+        if self.cache is not None:
+            self.cache.delete_records('systems', [system_id])
+        return response
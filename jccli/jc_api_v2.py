@@ -11,28 +11,67 @@ This is a utility library for the jumpcloud version 2 api
     To learn more about the jumpcloud api 2
     `project website <https://github.com/TheJumpCloud/jcapi-python/tree/master/jcapiv2>`_.
 """
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import jcapiv2
 from jcapiv2 import Group, GraphConnection
 from jcapiv2.rest import ApiException
 
-from jccli.errors import GroupNotFoundError, JcApiException
-from jccli.helpers import PAGE_LIMIT
+from jccli.cache import get_group_index, get_user_index
+from jccli.errors import GroupNotFoundError, JcApiException, JcCliError
+from jccli.jc_api_client import get_api_client
+from jccli.helpers import iter_pages, unique_by_id, read_json, json_to_dict, PAGE_LIMIT, MAX_WORKERS
+
+
+# Statuses of a bulk job which has stopped running
+JOB_DONE_STATUSES = ('finished', 'failed', 'cancelled')
+# User properties which can be set by a bulk create job
+BULK_CREATE_FIELDS = ('username', 'email', 'firstname', 'lastname', 'attributes')
+# User properties which can be changed by a bulk update job
+BULK_UPDATE_FIELDS = ('email', 'firstname', 'lastname', 'username', 'attributes')
+# Start of the kinds under which the members of groups are kept in a `jccli.cache.DirectoryCache`
+MEMBERS_KIND_PREFIX = 'group_members/'
+
+
+def members_kind(group_id):
+    """
+    :return: the kind under which the members of a group are kept in a `jccli.cache.DirectoryCache`
+    """
+    return MEMBERS_KIND_PREFIX + group_id
+
+
+def get_total_count(headers):
+    """
+    Read the total number of results of a v2 listing from its response headers
+    :param headers: response headers
+    :return: the total count, or None if the API did not send one
+    """
+    total_count = headers.get('x-total-count') if headers else None
+    return int(total_count) if total_count is not None else None
 
 
 class JumpcloudApiV2:
     """
         Wrapper for Jumpcloud API v2
     """
-    def __init__(self, api_key):
-        configuration = jcapiv2.Configuration()
-        configuration.api_key['x-api-key'] = api_key
-        self.graph_api = jcapiv2.GraphApi(jcapiv2.ApiClient(configuration))
-        self.groups_api = jcapiv2.GroupsApi(jcapiv2.ApiClient(configuration))
-        self.user_groups_api = jcapiv2.UserGroupsApi(jcapiv2.ApiClient(configuration))
-        self.system_groups_api = jcapiv2.SystemGroupsApi(jcapiv2.ApiClient(configuration))
-        self.bulk_job_requests_api = jcapiv2.BulkJobRequestsApi(jcapiv2.ApiClient(configuration))
+    def __init__(self, api_key, max_workers=MAX_WORKERS, cache=None):
+        """
+        :param api_key: JumpCloud API key
+        :param max_workers: maximum number of pages to request concurrently when paginating
+        :param cache: an optional `jccli.cache.DirectoryCache` which keeps groups and their members between runs
+        """
+        self.max_workers = max_workers
+        self.cache = cache
+        self.group_index = get_group_index(api_key)
+        self.user_index = get_user_index(api_key)
+        api_client = get_api_client(jcapiv2, api_key)
+        self.graph_api = jcapiv2.GraphApi(api_client)
+        self.groups_api = jcapiv2.GroupsApi(api_client)
+        self.user_groups_api = jcapiv2.UserGroupsApi(api_client)
+        self.system_groups_api = jcapiv2.SystemGroupsApi(api_client)
+        self.bulk_job_requests_api = jcapiv2.BulkJobRequestsApi(api_client)
 
     def create_group(self, name, type):
         """
@@ -52,7 +91,6 @@ class JumpcloudApiV2:
                                                               accept='application/json',
                                                               body=body,
                                                               x_org_id='')
-                return api_response
             except ApiException as error:
                 raise JcApiException("Exception when calling SystemGroupsApi:\n") from error
         elif group_type == jcapiv2.GroupType.USER_GROUP:
@@ -63,12 +101,14 @@ class JumpcloudApiV2:
                                                           accept='application/json',
                                                           body=body,
                                                           x_org_id='')
-                return api_response
             except ApiException as error:
                 raise JcApiException("Exception when calling UserGroupsApi:\n") from error
         else:
             raise ValueError("group type must be system or user")
 
+        self._index_group({'id': api_response.id, 'name': group_name, 'type': group_type})
+        return api_response
+
     def delete_group(self, group_id, group_type):
         """
         Delete a Jumpcloud group
@@ -82,7 +122,6 @@ class JumpcloudApiV2:
                                                                 content_type='application/json',
                                                                 accept='application/json',
                                                                 x_org_id='')
-                return api_response
             except ApiException as error:
                 raise JcApiException("Exception when calling SystemGroupsApi:\n") from error
         elif group_type == 'user_group':
@@ -92,9 +131,16 @@ class JumpcloudApiV2:
                                                             content_type='application/json',
                                                             accept='application/json',
                                                             x_org_id='')
-                return api_response
             except ApiException as error:
                 raise JcApiException("Exception when calling UserGroupsApi:\n") from error
+        else:
+            return None
+
+        self.group_index.remove(group_id)
+        if self.cache is not None:
+            self.cache.delete_records('groups', [group_id])
+            self.cache.forget(members_kind(group_id))
+        return api_response
 
     def bind_user_to_group(self, user_id, group_id):
         """
@@ -113,9 +159,11 @@ class JumpcloudApiV2:
                                                              accept='application/json',
                                                              body=body,
                                                              x_org_id='')
-            return api_response
         except ApiException as error:
             raise JcApiException("Exception when calling GraphApi:\n") from error
+        if self.cache is not None:
+            self.cache.put_records(members_kind(group_id), [{'id': user_id}])
+        return api_response
 
     def unbind_user_from_group(self, user_id, group_id):
         body = jcapiv2.UserGroupMembersReq(id=user_id,
@@ -128,9 +176,11 @@ class JumpcloudApiV2:
                                                              accept='application/json',
                                                              body=body,
                                                              x_org_id='')
-            return api_response
         except ApiException as error:
             raise JcApiException("Exception when calling GraphApi:\n") from error
+        if self.cache is not None:
+            self.cache.delete_records(members_kind(group_id), [user_id])
+        return api_response
 
     def bind_ldap_to_user(self, ldap_id):
         """
@@ -151,27 +201,251 @@ class JumpcloudApiV2:
         except ApiException as error:
             raise JcApiException("Exception when calling GraphApi-:\n") from error
 
+    def bulk_create_users(self, users, poll_interval=2, timeout=600):
+        """
+        Create many users with one bulk job, and wait for the job to finish. Only the properties in
+        `BULK_CREATE_FIELDS` can be set this way.
+        :param users: a list of dicts of BulkUserCreate properties (username, email, firstname, lastname, attributes)
+        :param poll_interval: seconds to wait between checks of the job status
+        :param timeout: seconds to wait for the job to finish
+        :return: a list with, for each user, a dict with its 'username', 'email', 'id' (None if the job results do not
+                 tell) and the 'status' and 'status_msg' of its work result (None if the job results do not tell)
+        """
+        for user in users:
+            fields = sorted(field for field in user if field not in BULK_CREATE_FIELDS)
+            if fields:
+                raise ValueError(f"a bulk job cannot set {', '.join(fields)} of user {user['username']}")
+        body = [jcapiv2.BulkUserCreate(username=user['username'],
+                                       email=user['email'],
+                                       firstname=user.get('firstname', ''),
+                                       lastname=user.get('lastname', ''),
+                                       attributes=user.get('attributes'))
+                for user in users]
+        try:
+            job = self.bulk_job_requests_api.bulk_users_create(content_type='application/json',
+                                                               accept='application/json',
+                                                               body=body,
+                                                               x_org_id='')
+        except ApiException as error:
+            raise JcApiException("Exception when calling BulkJobRequestsApi:\n") from error
+
+        work_results = {}
+        for work_result in self.wait_for_job(job.job_id, poll_interval=poll_interval, timeout=timeout):
+            persisted_fields = work_result.get('persisted_fields') or {}
+            work_results[persisted_fields.get('username')] = work_result
+
+        results = []
+        for user in users:
+            work_result = work_results.get(user['username'], {})
+            result = {
+                'username': user['username'],
+                'email': user['email'],
+                'id': (work_result.get('meta') or {}).get('systemUser'),
+                'status': work_result.get('status'),
+                'status_msg': work_result.get('status_msg')
+            }
+            if result['id'] is not None:
+                self.user_index.add(result)
+            results.append(result)
+        return results
+
+    def bulk_update_users(self, updates, poll_interval=2, timeout=600):
+        """
+        Update many users with one bulk job, and wait for the job to finish. Only the properties in
+        `BULK_UPDATE_FIELDS` can be updated this way.
+        :param updates: a list of dicts with the 'id' and current 'username' of a user, and the 'changes' to make (a
+                        dict of BulkUserUpdate properties)
+        :param poll_interval: seconds to wait between checks of the job status
+        :param timeout: seconds to wait for the job to finish
+        :return: a list with, for each update, a dict with the user's 'username' and 'id' and the 'status' and
+                 'status_msg' of its work result (None if the job results do not tell)
+        """
+        body = [jcapiv2.BulkUserUpdate(id=update['id'], **update['changes']) for update in updates]
+        try:
+            job = self.bulk_job_requests_api.bulk_users_update(content_type='application/json',
+                                                               accept='application/json',
+                                                               body=body,
+                                                               x_org_id='')
+        except ApiException as error:
+            raise JcApiException("Exception when calling BulkJobRequestsApi:\n") from error
+
+        work_results = {}
+        for work_result in self.wait_for_job(job.job_id, poll_interval=poll_interval, timeout=timeout):
+            persisted_fields = work_result.get('persisted_fields') or {}
+            work_results[persisted_fields.get('id') or persisted_fields.get('username')] = work_result
+
+        results = []
+        for update in updates:
+            work_result = work_results.get(update['id']) or \
+                work_results.get(update['changes'].get('username', update['username']), {})
+            results.append({
+                'username': update['username'],
+                'id': update['id'],
+                'status': work_result.get('status'),
+                'status_msg': work_result.get('status_msg')
+            })
+
+        for update, result in zip(updates, results):
+            if result['status'] == 'finished':
+                self.user_index.add({'id': update['id'],
+                                     'username': update['changes'].get('username', update['username'])})
+        # The job results do not hold the updated users, so they are dropped from the local cache, to be fetched again
+        # when next needed
+        if self.cache is not None:
+            self.cache.delete_records('users', [update['id'] for update in updates])
+        return results
+
+    def wait_for_job(self, job_id, poll_interval=2, timeout=600):
+        """
+        Wait for a bulk job to finish
+        :param job_id: the id of the bulk job
+        :param poll_interval: seconds to wait between checks of the job status
+        :param timeout: seconds to wait for the job to finish
+        :return: the work results of the job, as a list of dicts
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                job = self.bulk_job_requests_api.jobs_get(id=job_id,
+                                                          content_type='application/json',
+                                                          accept='application/json',
+                                                          x_org_id='')
+                if job.status in JOB_DONE_STATUSES:
+                    break
+                if time.monotonic() > deadline:
+                    raise JcApiException("Bulk job %s did not finish within %s seconds" % (job_id, timeout))
+                time.sleep(poll_interval)
+
+            def fetch_page(skip):
+                results = self.bulk_job_requests_api.jobs_results(id=job_id,
+                                                                  content_type='application/json',
+                                                                  accept='application/json',
+                                                                  limit=PAGE_LIMIT,
+                                                                  skip=skip,
+                                                                  x_org_id='')
+                return [result.to_dict() for result in results], None
+
+            return [result for page in iter_pages(fetch_page, max_workers=self.max_workers) for result in page]
+        except ApiException as error:
+            raise JcApiException("Exception when calling BulkJobRequestsApi:\n") from error
+
     def get_group(self, group_name, group_type, limit=100, skip=0, sort='', fields='', filter='') -> dict:
         # pylint: disable-msg=too-many-locals
         # pylint: disable-msg=too-many-arguments
         """
-        Get the jumpcloud group info from a Jumpcloud group name
+        Get the jumpcloud group info from a Jumpcloud group name. Groups are answered from the group index when it
+        has been loaded by a complete listing (or from the local cache); otherwise only groups with the given name are
+        requested from the API.
         :param group_name: name of the JC group
         :return:  The jumpcloud group id and type, NONE group is not found
         """
-        groups = self.get_groups()
-        for group in groups:
+        self._load_group_index()
+        group = self.group_index.get(group_name, group_type)
+        if group is not None or self.group_index.refreshed:
+            return group
+
+        try:
+            results: List[Group] = self.groups_api.groups_list(
+                content_type='application/json',
+                accept='application/json',
+                filter=['name:eq:%s' % (group_name,)],
+                limit=PAGE_LIMIT,
+                skip=0
+            )
+        except ApiException as error:
+            raise JcApiException("Exception when calling GroupsApi:\n") from error
+
+        for result in results:
+            group = result.to_dict()
             if group['name'] == group_name and group['type'] == group_type:
+                self._index_group(group)
                 return group
+        return None
+
+    def _load_group_index(self):
+        """
+        Load the group index from the local cache, if there is one and the index is not loaded yet
+        """
+        if self.group_index.loaded or self.cache is None:
+            return
+        groups = self.cache.get_records('groups')
+        if groups is not None:
+            self.group_index.load(groups)
+
+    def _index_group(self, group):
+        """
+        Add a created or fetched group to the group index and local cache
+        """
+        self.group_index.add(group)
+        if self.cache is not None:
+            self.cache.put_records('groups', [group])
 
-    def get_groups(self, type=None) -> List[Group]:
+    def get_groups(self, type=None, raw=False) -> List[Group]:
         # pylint: disable-msg=too-many-locals
         # pylint: disable-msg=too-many-arguments
         """
         Get all jumpcloud groups
         :param group_name: name of the JC group
+        :param raw: decode the JSON responses straight into dicts, skipping the generated model objects
         :return: A list of jumpcloud groups
         """
+        groups = list(self.iter_groups(type=type, raw=raw))
+        if not type:
+            # A complete listing is all the group index needs
+            self.group_index.load(groups, refreshed=True)
+            if self.cache is not None:
+                self.cache.set_records('groups', groups)
+        return groups
+
+    def refresh_cache(self):
+        """
+        Bring the cached groups, and the member lists of the groups which have been cached, up to date with JumpCloud.
+        Groups have no creation time, so they are always listed in full.
+        :return: a dict with, for 'groups' and 'group_members', a dict of the number of records 'fetched' and 'removed',
+                 and whether the refresh was 'full'
+        """
+        if self.cache is None:
+            raise JcCliError("there is no local cache to refresh")
+        snapshot = self.cache.get_snapshot_ids('groups')
+        groups = self.get_groups()
+        group_ids = {group['id'] for group in groups}
+
+        cached_members = [kind[len(MEMBERS_KIND_PREFIX):] for kind in self.cache.get_kinds(MEMBERS_KIND_PREFIX)]
+        removed_members = [group_id for group_id in cached_members if group_id not in group_ids]
+        for group_id in removed_members:
+            self.cache.forget(members_kind(group_id))
+        members = self.list_groups_users([group_id for group_id in cached_members if group_id in group_ids],
+                                         use_cache=False)
+        return {
+            'groups': {'fetched': len(groups), 'removed': len(snapshot[0] - group_ids) if snapshot else 0,
+                       'full': True},
+            'group_members': {'fetched': len(members), 'removed': len(removed_members), 'full': True}
+        }
+
+    def count_groups(self):
+        """
+        Count the jumpcloud groups with a single one-record listing
+        :return: the number of groups, or None if the API does not tell
+        """
+        try:
+            results, _, headers = self.groups_api.groups_list_with_http_info(
+                content_type='application/json',
+                accept='application/json',
+                filter='',
+                limit=1,
+                skip=0
+            )
+        except ApiException as error:
+            raise JcApiException("Exception when calling GroupsApi:\n") from error
+        return get_total_count(headers)
+
+    def iter_groups(self, type=None, raw=False):
+        """
+        Iterate over jumpcloud groups. Groups are yielded page by page while the next pages are being fetched.
+        :param type: optionally, only iterate over groups of this type
+        :param raw: decode the JSON responses straight into dicts, skipping the generated model objects
+        :return: a generator of group dicts
+        """
         if type:
             # `filter` is poorly-documented (see https://github.com/TheJumpCloud/jcapi-python/issues/46) and possibly
             # not generalizable, but as long as the only thing we are filtering on is type, I suppose this will work
@@ -179,37 +453,85 @@ class JumpcloudApiV2:
             filter = ['type:eq:%s' % (type,)]
         else:
             filter = ''
+
+        def fetch_page(skip):
+            results, _, headers = self.groups_api.groups_list_with_http_info(
+                content_type='application/json',
+                accept='application/json',
+                filter=filter,
+                limit=PAGE_LIMIT,
+                skip=skip,
+                _preload_content=not raw
+            )
+            if raw:
+                return [json_to_dict(group, Group, jcapiv2) for group in read_json(results)], get_total_count(headers)
+            return [group.to_dict() for group in results], get_total_count(headers)
+
         try:
-            # Iteratively make API calls until the API response is empty
-            groups = []
-            while True:
-                results: List[Group] = self.groups_api.groups_list(
-                    content_type='application/json',
-                    accept='application/json',
-                    filter=filter,
-                    limit=PAGE_LIMIT,
-                    skip=len(groups)
-                )
-                if len(results) == 0:
-                    return groups
-                groups.extend([group.to_dict() for group in results])
+            pages = iter_pages(fetch_page, max_workers=self.max_workers)
+            yield from unique_by_id(group for page in pages for group in page)
         except ApiException as error:
             raise JcApiException("Exception when calling GroupsApi:\n") from error
 
-    def list_group_users(self, group_id):
+    def list_group_users(self, group_id, use_cache=True, max_workers=None):
         """Return a list of user IDs associated with the group ID
+
+        :param group_id: the jumpcloud id of a user group
+        :param use_cache: answer from the local cache, if it has a fresh list of the group's members
+        :param max_workers: maximum number of pages to request concurrently (default: `self.max_workers`)
+        """
+        def fetch_members():
+            members = [{'id': user_id} for user_id in self.iter_group_members(group_id, max_workers=max_workers)]
+            if self.cache is not None:
+                self.cache.set_records(members_kind(group_id), members)
+            return members
+
+        if use_cache and self.cache is not None:
+            members, _ = self.cache.get_or_refresh(members_kind(group_id), fetch_members)
+        else:
+            members = fetch_members()
+        return [member['id'] for member in members]
+
+    def list_groups_users(self, group_ids, use_cache=True):
+        """
+        List the users of many groups, `max_workers` groups at a time. The pages of each group are requested one at a
+        time, so that no more than `max_workers` requests are in flight.
+        :param group_ids: a list of user group IDs
+        :param use_cache: answer from the local cache, for the groups whose members it has a fresh list of
+        :return: a dict of the lists of user IDs associated with each group ID
+        """
+        group_ids = list(dict.fromkeys(group_ids))
+
+        def list_users(group_id):
+            return self.list_group_users(group_id, use_cache=use_cache, max_workers=1)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return dict(zip(group_ids, executor.map(list_users, group_ids)))
+        except ApiException as error:
+            raise JcApiException("Exception when calling UserGroupsApi:\n") from error
+
+    def iter_group_members(self, group_id, max_workers=None):
+        """
+        Iterate over the IDs of the users associated with the group ID. IDs are yielded page by page while the next
+        pages are being fetched.
+        :param group_id: the jumpcloud id of a user group
+        :param max_workers: maximum number of pages to request concurrently (default: `self.max_workers`)
+        :return: a generator of user IDs
         """
-        user_ids = []
-        while True:
-            results: List[GraphConnection] = self.user_groups_api.graph_user_group_members_list(
+        def fetch_page(skip):
+            results, _, headers = self.user_groups_api.graph_user_group_members_list_with_http_info(
                 group_id=group_id,
                 content_type='application/json',
                 accept='application/json',
                 limit=PAGE_LIMIT,
-                skip=len(user_ids)
+                skip=skip
             )
-            if len(results) == 0:
-                break
-            user_ids.extend([result.to_dict()['to']['id'] for result in results])
+            return [result.to_dict()['to']['id'] for result in results], get_total_count(headers)
 
-        return user_ids
+        seen = set()
+        for page in iter_pages(fetch_page, max_workers=max_workers or self.max_workers):
+            for user_id in page:
+                if user_id not in seen:
+                    seen.add(user_id)
+                    yield user_id
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.journal.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+A journal of the progress of a sync, so that an interrupted sync can be resumed
+
+The journal is a JSON Lines file. Its first line holds the plan being applied, which includes the remote state the plan
+was made from, and each following line records one operation of the plan which has been applied. Lines are only ever
+appended, and the file is synced to disk every few records, so that at most the last few records are lost in a crash.
+A journal is locked while a sync uses it, so that two syncs of the same file cannot apply its plan at once.
+"""
+import json
+import os
+import time
+
+from jccli.helpers import lock_file
+
+# Sync the journal to disk after this many records...
+FSYNC_EVERY = 50
+# ...or after this many seconds, whichever comes first
+FSYNC_INTERVAL = 1.0
+
+
+class SyncJournal:
+    """
+    The journal of the operations of a sync plan which have been applied
+    """
+    def __init__(self, path, plan, applied, file):
+        """
+        Use `SyncJournal.start` or `SyncJournal.resume` rather than this constructor
+        """
+        self.path = path
+        self.plan = plan
+        self.applied = applied
+        self._file = file
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    @classmethod
+    def start(cls, path, plan):
+        """
+        Start a new journal for a plan, replacing any previous journal at `path`
+        :param path: the journal file
+        :param plan: the plan about to be applied
+        :return: a SyncJournal
+        """
+        os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+        file = _open_locked(path, 'ab')
+        file.truncate(0)
+        file.write((json.dumps({'plan': plan}) + '\n').encode())
+        file.flush()
+        os.fsync(file.fileno())
+        return cls(path, plan, {}, file)
+
+    @classmethod
+    def resume(cls, path):
+        """
+        Open an existing journal to carry on applying its plan
+        :param path: the journal file
+        :return: a SyncJournal, whose `applied` dict holds the details recorded for each applied operation, by index
+        """
+        file = _open_locked(path, 'r+b')
+        try:
+            # Anything after the last newline is a record cut short by a crash
+            lines = file.read().split(b'\n')[:-1]
+            try:
+                plan = json.loads(lines[0])['plan']
+            except (ValueError, KeyError, TypeError, IndexError) as error:
+                raise ValueError(f"{path} is not a sync journal") from error
+            applied = {}
+            end = len(lines[0]) + 1
+            for line in lines[1:]:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                applied[record.pop('index')] = record
+                end += len(line) + 1
+            # New records are appended after the last complete one
+            file.truncate(end)
+            file.seek(end)
+        except BaseException:
+            file.close()
+            raise
+        return cls(path, plan, applied, file)
+
+    def record(self, index, **details):
+        """
+        Record that an operation of the plan has been applied
+        :param index: the index of the operation in the plan
+        :param details: what later operations need to know about it, e.g. the id of a created user
+        """
+        self.applied[index] = details
+        self._file.write((json.dumps(dict(details, index=index)) + '\n').encode())
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= FSYNC_EVERY or time.monotonic() - self._synced_at >= FSYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """
+        Sync the journal to disk
+        """
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        """
+        Sync and close the journal
+        """
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def remove(self):
+        """
+        Close and delete the journal, once its plan has been applied completely
+        """
+        # The journal is deleted before its lock is released, so that no other sync takes over a deleted file
+        os.unlink(self.path)
+        self.close()
+
+
+def _open_locked(path, mode):
+    """
+    Open a journal file and lock it
+    :param path: the journal file
+    :param mode: the mode to open it in
+    :return: the open file
+    """
+    while True:
+        file = open(path, mode)
+        if not lock_file(file, blocking=False):
+            file.close()
+            raise ValueError(f"{path} is in use by another sync")
+        try:
+            if os.fstat(file.fileno()).st_ino == os.stat(path).st_ino:
+                return file
+        except FileNotFoundError:
+            pass
+        # The sync which held the lock deleted the journal before this one took it
+        file.close()
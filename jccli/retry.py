@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.retry.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+Retry and rate limiting policy shared by all API calls
+
+Requests rejected with a rate limit (429) or transient server error (5xx) are retried with exponential backoff and
+jitter, honoring the `Retry-After` header. Optionally, requests are also spaced out by a token bucket per API key.
+"""
+import email.utils
+import functools
+import random
+import threading
+import time
+
+
+# HTTP statuses worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# HTTP methods which can be repeated safely after a server error
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+_LOCK = threading.Lock()
+_LIMITERS = {}
+
+
+class RetryPolicy:
+    """
+    When and how long to wait before retrying a failed request
+    """
+    def __init__(self, max_retries=5, backoff_base=0.5, backoff_max=30.0, rate=None, burst=None):
+        """
+        :param max_retries: maximum number of retries of one request
+        :param backoff_base: upper bound of the first backoff delay, in seconds; it doubles with every retry
+        :param backoff_max: maximum backoff delay, in seconds
+        :param rate: if set, maximum number of requests per second per API key
+        :param burst: number of requests which can be sent at once before `rate` applies (defaults to `rate`)
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate = rate
+        self.burst = burst
+
+    def should_retry(self, method, url, status, attempt):
+        """
+        :param method: HTTP method of the failed request
+        :param url: URL of the failed request
+        :param status: HTTP status of the response
+        :param attempt: number of retries already made
+        :return: whether the request should be retried
+        """
+        if attempt >= self.max_retries or status not in RETRY_STATUSES:
+            return False
+        # A rate limited request was not processed, but a server error might have happened after a write
+        return status == 429 or method.upper() in IDEMPOTENT_METHODS or '/search/' in url
+
+    def delay(self, attempt, retry_after=None):
+        """
+        :param attempt: number of retries already made
+        :param retry_after: value of the `Retry-After` response header, if any
+        :return: seconds to wait before the next retry
+        """
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            # "Full jitter": spread retries of concurrent requests over the whole backoff window
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return min(delay, self.backoff_max)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: allows `burst` requests at once and `rate` requests per second on average
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, possibly one that has not been refilled yet
+        :return: seconds the caller has to wait before making its request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        """
+        Wait until a request can be made
+        """
+        time.sleep(self.reserve())
+
+
+_POLICY = RetryPolicy()
+
+
+def configure(**kwargs):
+    """
+    Replace the retry policy used by all API calls. Takes the arguments of `RetryPolicy`.
+    """
+    global _POLICY
+    with _LOCK:
+        _POLICY = RetryPolicy(**kwargs)
+        _LIMITERS.clear()
+
+
+def get_policy():
+    """
+    :return: the retry policy used by all API calls
+    """
+    return _POLICY
+
+
+def get_limiter(api_key):
+    """
+    Get the rate limiter of an API key
+    :param api_key: JumpCloud API key
+    :return: a TokenBucket, or None if the policy has no rate limit
+    """
+    policy = _POLICY
+    if not policy.rate:
+        return None
+    with _LOCK:
+        return _LIMITERS.setdefault(api_key, TokenBucket(policy.rate, policy.burst))
+
+
+def parse_retry_after(retry_after):
+    """
+    Parse a `Retry-After` header, given either in seconds or as an HTTP date
+    :return: seconds to wait, or None if the header is missing or invalid
+    """
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def with_retries(request, api_key):
+    """
+    Wrap the `request` method of a generated REST client so that every call is rate limited and retried according to
+    the current policy
+    :param request: `RESTClientObject.request` of `jcapiv1` or `jcapiv2`
+    :param api_key: JumpCloud API key the requests are made with
+    :return: the wrapped method
+    """
+    @functools.wraps(request)
+    def request_with_retries(method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            limiter = get_limiter(api_key)
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                return request(method, url, *args, **kwargs)
+            except Exception as error:  # pylint: disable=broad-except
+                # Both generated packages raise their own ApiException, with the HTTP status and headers
+                policy = get_policy()
+                if not policy.should_retry(method, url, getattr(error, 'status', None), attempt):
+                    raise
+                headers = getattr(error, 'headers', None) or {}
+                time.sleep(policy.delay(attempt, headers.get('Retry-After')))
+                attempt += 1
+    return request_with_retries
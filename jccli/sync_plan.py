@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: jccli.sync_plan.py
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+Work out the changes needed to sync jumpcloud with a data file, and apply them
+
+Local and remote records are matched through hashed indexes (users by username and email, groups by name and type),
+so a diff takes time linear in the number of records. The changes are gathered in a plan, which can be saved, reviewed
+and applied later without fetching the directory again.
+"""
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+
+import jcapiv1
+
+from jccli.errors import JcCliError
+from jccli.helpers import convert_scalar, MAX_WORKERS
+from jccli.jc_api_v2 import BULK_CREATE_FIELDS
+
+PLAN_VERSION = 1
+
+# The group which new users are bound to
+STAFF_GROUP = ('staff', 'user_group')
+# User properties which sync keeps up to date (the password is never returned by the API, so cannot be compared)
+USER_FIELDS = tuple(field for field in jcapiv1.Systemuserput.swagger_types if field != 'password')
+
+
+def group_key(group):
+    """
+    :return: the (name, type) pair identifying a group
+    """
+    return group['name'], group['type']
+
+
+def diff_groups(local_groups, remote_groups):
+    """
+    Compare the groups in a data file with the groups in jumpcloud
+    :param local_groups: groups from the data file, dicts with 'name' and 'type'
+    :param remote_groups: groups from jumpcloud, dicts with 'id', 'name' and 'type'
+    :return: a tuple of the local groups to create and the remote groups to remove
+    """
+    remote_keys = {group_key(group) for group in remote_groups}
+    local_groups_by_key = {group_key(group): group for group in local_groups}
+
+    to_create = [group for key, group in local_groups_by_key.items() if key not in remote_keys]
+    to_remove = [group for group in remote_groups if group_key(group) not in local_groups_by_key]
+    return to_create, to_remove
+
+
+def diff_users(local_users, remote_users):
+    """
+    Compare the users in a data file with the users in jumpcloud. A local user matches a remote user with the same
+    username or the same email.
+    :param local_users: users from the data file, dicts with 'username' and 'email'
+    :param remote_users: users from jumpcloud, dicts with 'id', 'username' and 'email'
+    :return: a tuple of the local users to create and the remote users to remove
+    """
+    remote_usernames = {user['username'] for user in remote_users}
+    remote_emails = {user['email'] for user in remote_users}
+    local_usernames = {user['username'] for user in local_users}
+    local_emails = {user['email'] for user in local_users}
+
+    to_create = []
+    created_usernames = set()
+    for user in local_users:
+        if user['username'] in remote_usernames or user['email'] in remote_emails:
+            continue
+        if user['username'] not in created_usernames:
+            created_usernames.add(user['username'])
+            to_create.append(user)
+
+    to_remove = [user for user in remote_users
+                 if user['username'] not in local_usernames and user['email'] not in local_emails]
+    return to_create, to_remove
+
+
+def diff_user_attributes(local_users, remote_users):
+    """
+    Compare the properties of the users in a data file with those of the matching users in jumpcloud (see
+    `diff_users`). Only the properties in `USER_FIELDS` which the data file sets are compared.
+    :param local_users: users from the data file
+    :param remote_users: users from jumpcloud
+    :return: a list of (remote user, dict of the changed properties) pairs, for the users which differ
+    """
+    remote_users_by_username = {user['username']: user for user in remote_users}
+    remote_users_by_email = {user['email']: user for user in remote_users}
+
+    changed = []
+    seen = set()
+    for user in local_users:
+        remote_user = remote_users_by_username.get(user['username']) or remote_users_by_email.get(user['email'])
+        if remote_user is None or remote_user['id'] in seen:
+            continue
+        seen.add(remote_user['id'])
+        changes = {}
+        for field, value in user.items():
+            if field not in USER_FIELDS:
+                continue
+            value = normalize_value(field, value, remote_user.get(field))
+            # A blank flag or number leaves the property as it is
+            if value is not None and value != remote_user.get(field):
+                changes[field] = value
+        if changes:
+            changed.append((remote_user, changes))
+    return changed
+
+
+def normalize_value(field, value, remote_value=None):
+    """
+    Convert a user property from a data file to the type jumpcloud uses for it: flags and numbers may be written as
+    strings such as "True", "no" or "5001", and an empty string stands for an unset property
+    :param field: the name of the property
+    :param value: the value in the data file
+    :param remote_value: the value in jumpcloud, if any
+    :return: the converted value
+    """
+    swagger_type = jcapiv1.Systemuserput.swagger_types.get(field)
+    if value == '' and (remote_value is None or swagger_type != 'str'):
+        return None
+    return convert_scalar(value, swagger_type)
+
+
+def make_plan(local_groups, local_users, remote_groups, remote_users, remote_members=None, fingerprint=None):
+    # pylint: disable-msg=too-many-locals
+    # pylint: disable-msg=too-many-arguments
+    """
+    Work out every operation needed to sync jumpcloud with a data file. The operations are listed in the order they
+    must run: group changes, user creation and updates, group membership changes, user removal.
+
+    New users are bound to the staff group, if it exists after the group changes. A user group which lists its
+    `members` (by username) in the data file gets exactly those members; the membership of other groups is left alone.
+    :param local_groups: groups from the data file
+    :param local_users: users from the data file
+    :param remote_groups: groups from jumpcloud
+    :param remote_users: users from jumpcloud
+    :param remote_members: the user ids of the members of the remote groups which list their members in the data file,
+                           by group id
+    :param fingerprint: the state fingerprint of jumpcloud when the remote records were fetched
+    :return: a plan, as a dict which can be saved to JSON
+    """
+    added_groups, removed_groups = diff_groups(local_groups, remote_groups)
+    added_users, removed_users = diff_users(local_users, remote_users)
+
+    operations = []
+    for group in added_groups:
+        operations.append({'op': 'create_group', 'name': group['name'], 'type': group['type']})
+    for group in removed_groups:
+        operations.append({'op': 'delete_group', 'id': group['id'], 'name': group['name'], 'type': group['type']})
+
+    for user in added_users:
+        new_user = {
+            'username': user['username'],
+            'email': user['email'],
+            'firstname': user.get('firstname', ''),
+            'lastname': user.get('lastname', '')
+        }
+        for field, value in user.items():
+            if field in USER_FIELDS and field not in new_user:
+                value = normalize_value(field, value)
+                if value is not None:
+                    new_user[field] = value
+        operations.append({'op': 'create_user', 'user': new_user})
+
+    for remote_user, changes in diff_user_attributes(local_users, remote_users):
+        operations.append({'op': 'update_user', 'id': remote_user['id'], 'username': remote_user['username'],
+                           'changes': changes})
+
+    remote_groups_by_key = {group_key(group): group for group in remote_groups}
+    members_groups = [group for group in local_groups if 'members' in group]
+
+    staff_group = next((group for group in local_groups if group_key(group) == STAFF_GROUP), None)
+    if staff_group is not None and 'members' not in staff_group:
+        staff_group_id = remote_groups_by_key[STAFF_GROUP]['id'] if STAFF_GROUP in remote_groups_by_key else None
+        for user in added_users:
+            operations.append(membership_operation('bind_user', user['username'], None, STAFF_GROUP, staff_group_id))
+
+    operations.extend(diff_members(members_groups, remote_groups_by_key, remote_users, added_users, removed_users,
+                                   remote_members or {}))
+
+    for user in removed_users:
+        operations.append({'op': 'delete_user', 'id': user['id'], 'username': user['username']})
+
+    return {
+        'version': PLAN_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'fingerprint': fingerprint,
+        'operations': operations
+    }
+
+
+def diff_members(groups, remote_groups_by_key, remote_users, added_users, removed_users, remote_members):
+    # pylint: disable-msg=too-many-arguments
+    """
+    Work out the bind and unbind operations which give each group exactly the members listed in the data file
+    :param groups: groups from the data file which list their `members`
+    :param remote_groups_by_key: groups from jumpcloud, by (name, type)
+    :param remote_users: users from jumpcloud
+    :param added_users: users which will be created
+    :param removed_users: users which will be deleted, and so leave their groups anyway
+    :param remote_members: the user ids of the members of remote groups, by group id
+    :return: a list of operations
+    """
+    user_ids = {user['username']: user['id'] for user in remote_users}
+    usernames = {user['id']: user['username'] for user in remote_users}
+    user_ids.update((user['username'], None) for user in added_users)
+    removed_ids = {user['id'] for user in removed_users}
+
+    operations = []
+    for group in groups:
+        if group['type'] != 'user_group':
+            raise ValueError(f"{group['name']}: only user groups can list members")
+        remote_group = remote_groups_by_key.get(group_key(group))
+        group_id = remote_group['id'] if remote_group is not None else None
+        current = remote_members.get(group_id, []) if group_id is not None else []
+        current_ids = set(current)
+
+        wanted_ids = set()
+        for username in dict.fromkeys(group['members']):
+            if username not in user_ids:
+                raise ValueError(f"{group['name']}: unknown member {username}")
+            user_id = user_ids[username]
+            wanted_ids.add(user_id)
+            if user_id is None or user_id not in current_ids:
+                operations.append(membership_operation('bind_user', username, user_id, group_key(group), group_id))
+
+        for user_id in current:
+            if user_id not in wanted_ids and user_id not in removed_ids:
+                operations.append(membership_operation('unbind_user', usernames.get(user_id, user_id), user_id,
+                                                       group_key(group), group_id))
+    return operations
+
+
+def membership_operation(kind, username, user_id, key, group_id):
+    """
+    :return: a 'bind_user' or 'unbind_user' plan operation
+    """
+    return {
+        'op': kind,
+        'username': username,
+        'user_id': user_id,
+        'group_name': key[0],
+        'group_type': key[1],
+        'group_id': group_id
+    }
+
+
+def get_fingerprint(api1, api2):
+    """
+    Get a cheap fingerprint of the state of jumpcloud, to tell whether a plan is still fresh without fetching the
+    whole directory
+    :param api1: a `JumpcloudApiV1`
+    :param api2: a `JumpcloudApiV2`
+    :return: a dict with the number of users and groups, each None if the API does not tell
+    """
+    return {'users': api1.count_users(), 'groups': api2.count_groups()}
+
+
+def save_plan(plan, plan_file):
+    """
+    Write a plan as JSON
+    :param plan: the plan
+    :param plan_file: a writable text file
+    """
+    json.dump(plan, plan_file, indent=2)
+    plan_file.write('\n')
+
+
+def load_plan(plan_file):
+    """
+    Read a plan written by `save_plan`
+    :param plan_file: a readable text file
+    :return: the plan
+    """
+    plan = json.load(plan_file)
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+        raise ValueError("not a sync plan, or a plan made by another version of jccli")
+    return plan
+
+
+def describe(operation):
+    """
+    :return: a one-line, human readable description of a plan operation
+    """
+    kind = operation['op']
+    if kind == 'create_group':
+        return f"create {' '.join(operation['type'].split('_'))}: {operation['name']}"
+    if kind == 'delete_group':
+        return f"remove {' '.join(operation['type'].split('_'))}: {operation['name']}"
+    if kind == 'create_user':
+        return f"create user: {operation['user']['username']}"
+    if kind == 'update_user':
+        return f"update user: {operation['username']} ({', '.join(sorted(operation['changes']))})"
+    if kind == 'bind_user':
+        return f"bind user {operation['username']} to {' '.join(operation['group_type'].split('_'))}: " \
+               f"{operation['group_name']}"
+    if kind == 'unbind_user':
+        return f"unbind user {operation['username']} from {' '.join(operation['group_type'].split('_'))}: " \
+               f"{operation['group_name']}"
+    if kind == 'delete_user':
+        return f"remove user: {operation['username']}"
+    raise ValueError(f"unknown sync operation: {kind}")
+
+
+def apply_plan(plan, api1, api2, echo=print, max_workers=MAX_WORKERS, journal=None):
+    # pylint: disable-msg=too-many-arguments
+    """
+    Run the operations of a plan, `max_workers` at a time. An operation only starts once the operations it depends on
+    have finished: users are bound to a group after the user and the group are created. Several user creations are done
+    with one bulk job. Operations which depend on a failed operation are skipped.
+    :param plan: the plan
+    :param api1: a `JumpcloudApiV1`
+    :param api2: a `JumpcloudApiV2`
+    :param echo: called with the description of each operation, in plan order, as the operations finish
+    :param max_workers: maximum number of operations to run concurrently
+    :param journal: a `jccli.journal.SyncJournal` to record the applied operations in; operations it has already
+                    recorded are not run again
+    :return: a list with, for each operation, a dict with the 'operation', its 'status' ('finished', 'failed' or
+             'skipped') and 'status_msg'
+    """
+    operations = plan['operations']
+    applied = journal.applied if journal is not None else {}
+    user_ids = {}
+    group_ids = {}
+    results = [None] * len(operations)
+    for index, details in applied.items():
+        operation = operations[index]
+        if operation['op'] == 'create_user':
+            user_ids[operation['user']['username']] = details['id']
+        elif operation['op'] == 'create_group':
+            group_ids[group_key(operation)] = details['id']
+        results[index] = {'operation': operation, 'status': 'finished', 'status_msg': "already applied"}
+
+    def create_group(index):
+        operation = operations[index]
+        response = api2.create_group(operation['name'], operation['type'])
+        group_ids[(operation['name'], operation['type'])] = response.id
+        return {index: None}
+
+    def create_users(indexes):
+        # Users with properties a bulk job cannot set are created one request per user, as is a lone user
+        bulk_indexes = [index for index in indexes
+                        if all(field in BULK_CREATE_FIELDS for field in operations[index]['user'])]
+        if len(bulk_indexes) < 2:
+            bulk_indexes = []
+        single_indexes = [index for index in indexes if index not in bulk_indexes]
+        results = {}
+        if bulk_indexes:
+            bulk_results = api1.fill_user_ids(api2.bulk_create_users([operations[index]['user']
+                                                                     for index in bulk_indexes]))
+            results.update(zip(bulk_indexes, bulk_results))
+        if single_indexes:
+            results.update(zip(single_indexes, api1.create_users([operations[index]['user']
+                                                                  for index in single_indexes])))
+        errors = {index: "the user was not created" for index in indexes}
+        for index, result in results.items():
+            user_ids[result['username']] = result.get('id')
+            errors[index] = None if result.get('id') else result.get('status_msg') or "the user was not created"
+        return errors
+
+    def bind_user(index):
+        operation = operations[index]
+        user_id = operation['user_id'] or user_ids.get(operation['username'])
+        group_id = operation['group_id'] or group_ids.get((operation['group_name'], operation['group_type']))
+        if not user_id or not group_id:
+            return {index: "unknown user or group id"}
+        api2.bind_user_to_group(user_id, group_id)
+        return {index: None}
+
+    def update_user(index):
+        operation = operations[index]
+        api1.set_user(operation['username'], operation['changes'], user_id=operation['id'])
+        return {index: None}
+
+    def unbind_user(index):
+        operation = operations[index]
+        api2.unbind_user_from_group(operation['user_id'], operation['group_id'])
+        return {index: None}
+
+    def delete_group(index):
+        api2.delete_group(operations[index]['id'], operations[index]['type'])
+        return {index: None}
+
+    def delete_user(index):
+        api1.delete_user(operations[index]['username'], user_id=operations[index]['id'])
+        return {index: None}
+
+    # Split the operations into tasks, and work out which operations each task must wait for. A task waits for the
+    # operations themselves rather than the tasks holding them, so that one user failing to be created does not hold
+    # back the binds of the users created along with it
+    tasks = []
+    task_of_operation = {}
+    creation_of_user = {}
+    creation_of_group = {}
+    creations = [index for index, operation in enumerate(operations)
+                 if operation['op'] == 'create_user' and index not in applied]
+    if creations:
+        task_of_operation.update((index, len(tasks)) for index in creations)
+        creation_of_user.update((operations[index]['user']['username'], index) for index in creations)
+        tasks.append((creations, functools.partial(create_users, creations), set()))
+    for index, operation in enumerate(operations):
+        kind = operation['op']
+        if index in applied or kind == 'create_user':
+            continue
+        task_of_operation[index] = len(tasks)
+        if kind == 'create_group':
+            creation_of_group[group_key(operation)] = index
+            tasks.append(([index], functools.partial(create_group, index), set()))
+        elif kind == 'delete_group':
+            tasks.append(([index], functools.partial(delete_group, index), set()))
+        elif kind == 'delete_user':
+            tasks.append(([index], functools.partial(delete_user, index), set()))
+        elif kind == 'update_user':
+            tasks.append(([index], functools.partial(update_user, index), set()))
+        elif kind == 'unbind_user':
+            tasks.append(([index], functools.partial(unbind_user, index), set()))
+        elif kind == 'bind_user':
+            depends_on = set()
+            if operation['username'] in creation_of_user:
+                depends_on.add(creation_of_user[operation['username']])
+            if (operation['group_name'], operation['group_type']) in creation_of_group:
+                depends_on.add(creation_of_group[(operation['group_name'], operation['group_type'])])
+            tasks.append(([index], functools.partial(bind_user, index), depends_on))
+        else:
+            raise ValueError(f"unknown sync operation: {kind}")
+
+    def run(task):
+        indexes, function, _ = tasks[task]
+        try:
+            return function()
+        except (JcCliError, ValueError) as error:
+            return {index: str(error) for index in indexes}
+
+    finished = set()
+    waiting = set(range(len(tasks)))
+    running = {}
+    echoed = 0
+
+    def finish(task, errors):
+        finished.add(task)
+        for index, error in errors.items():
+            results[index] = {
+                'operation': operations[index],
+                'status': 'finished' if error is None else 'failed',
+                'status_msg': error
+            }
+            if error is None and journal is not None:
+                journal.record(index, **applied_details(operations[index], user_ids, group_ids))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            # Start the tasks whose dependencies are done, and skip those with a failed dependency
+            for task in sorted(waiting):
+                depends_on = tasks[task][2]
+                if not all(task_of_operation[dependency] in finished for dependency in depends_on):
+                    continue
+                waiting.discard(task)
+                if all(results[dependency]['status'] == 'finished' for dependency in depends_on):
+                    running[executor.submit(run, task)] = task
+                else:
+                    finished.add(task)
+                    for index in tasks[task][0]:
+                        results[index] = {'operation': operations[index], 'status': 'skipped',
+                                          'status_msg': "an operation it depends on failed"}
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result())
+            echoed = echo_results(results, echoed, echo)
+
+    echo_results(results, echoed, echo)
+    return results
+
+
+def echo_results(results, echoed, echo):
+    """
+    Echo the results of the operations of a plan in plan order, so that the output does not depend on which operations
+    finish first
+    :param results: the results of `apply_plan` so far, None for operations which have not finished
+    :param echoed: the number of results already echoed
+    :param echo: called with the description of each result
+    :return: the number of results echoed now
+    """
+    while echoed < len(results) and results[echoed] is not None:
+        echo(describe_result(results[echoed]))
+        echoed += 1
+    return echoed
+
+
+def describe_result(result):
+    """
+    :return: a one-line, human readable description of the result of a plan operation
+    """
+    description = describe(result['operation'])
+    if result['status'] == 'failed':
+        return f"{description} (failed: {result['status_msg']})"
+    if result['status'] == 'skipped':
+        return f"{description} (skipped: {result['status_msg']})"
+    if result['status_msg']:
+        return f"{description} ({result['status_msg']})"
+    return description
+
+
+def applied_details(operation, user_ids, group_ids):
+    """
+    :return: what later operations need to know about an applied operation: the id of what it created, if anything
+    """
+    if operation['op'] == 'create_user':
+        return {'id': user_ids[operation['user']['username']]}
+    if operation['op'] == 'create_group':
+        return {'id': group_ids[group_key(operation)]}
+    return {}
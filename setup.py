@@ -48,6 +48,13 @@ install_requirements = [
     "PyYaml>=5.1,<6.0"
 ]
 
+extras_requirements = {
+    # AsyncJumpcloudApi
+    "async": ["aiohttp>=3.6,<4"],
+    # Faster JSON decoding for raw API responses
+    "fast": ["orjson>=3.0"],
+}
+
 setup(
     name='jccli',
     description="A Jumpcloud command line client",
@@ -59,6 +66,7 @@ setup(
     version=version,
     python_requires=">=3",
     install_requires=install_requirements,
+    extras_require=extras_requirements,
     entry_points={
         "console_scripts": [
             'jccli = jccli.cli:cli'
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_cache
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+This is the test module for the project's cache module.
+"""
+# fmt: off
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+# fmt: on
+from mock import MagicMock, patch
+from jccli.cache import DirectoryCache, UserIndex, cache_path
+
+
+class TestCache:
+    def setup_method(self, test_method):
+        pass
+
+    def teardown_method(self, test_method):
+        pass
+
+    def test_directory_cache_empty(self, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        assert cache.get_records('users') is None
+
+    def test_directory_cache_records(self, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        cache.set_records('users', [{'id': '1', 'username': 'dave'}, {'id': '2', 'username': 'mary'}])
+        cache.put_records('users', [{'id': '2', 'username': 'mary2'}, {'id': '3', 'username': 'zekun'}])
+        cache.delete_records('users', ['1'])
+        assert DirectoryCache(cache.path).get_records('users') == [
+            {'id': '2', 'username': 'mary2'}, {'id': '3', 'username': 'zekun'}
+        ]
+
+    def test_user_index(self):
+        index = UserIndex()
+        index.load([{'id': '1', 'username': 'dave'}])
+        index.add({'id': '1', 'username': 'david'})
+        assert index.id_for_username('dave') is None
+        assert index.id_for_username('david') == '1'
+        index.remove('1')
+        assert index.id_for_username('david') is None
+
+    def test_directory_cache_ttl(self, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'), ttl=60)
+        cache.set_records('users', [{'id': '1', 'username': 'dave'}])
+        assert cache.get_records('users') == [{'id': '1', 'username': 'dave'}]
+        with patch('jccli.cache.time.time', return_value=time.time() + 61):
+            assert cache.get_records('users') is None
+            assert cache.find_records('users', username='dave') is None
+
+    def test_directory_cache_find_records(self, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        assert cache.find_records('users', username='dave') is None
+        cache.set_records('users', [{'id': '1', 'username': 'dave'}, {'id': '2', 'username': 'mary'}])
+        assert cache.find_records('users', username='mary') == [{'id': '2', 'username': 'mary'}]
+        assert cache.find_records('users', id='1') == [{'id': '1', 'username': 'dave'}]
+        assert cache.find_records('users', username='zekun') == []
+        cache.forget('users')
+        assert cache.get_records('users') is None
+
+    def test_directory_cache_merge_records(self, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'), ttl=60)
+        assert cache.get_snapshot_ids('users') is None
+        cache.set_records('users', [{'id': '1', 'username': 'dave'}, {'id': '2', 'username': 'mary'}])
+        with patch('jccli.cache.time.time', return_value=time.time() + 61):
+            # The ids of an expired snapshot are still known, to refresh it incrementally
+            ids, refreshed_at = cache.get_snapshot_ids('users')
+            assert ids == {'1', '2'}
+            cache.merge_records('users', [{'id': '3', 'username': 'zekun'}], {'1'}, time.time())
+            # Records merged into a snapshot do not renew it: it still expires with its last full refresh
+            assert cache.get_records('users') is None
+        assert cache.get_snapshot_ids('users')[1] > refreshed_at
+        assert cache.get_records('users') == [{'id': '2', 'username': 'mary'}, {'id': '3', 'username': 'zekun'}]
+        cache.set_records('users', [])
+        with patch('jccli.cache.time.time', return_value=time.time() + 59):
+            assert cache.get_records('users') == []
+
+    def test_directory_cache_without_full_refresh_time(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite')
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute('CREATE TABLE snapshots (kind TEXT PRIMARY KEY, refreshed_at REAL NOT NULL)')
+            connection.execute('INSERT INTO snapshots (kind, refreshed_at) VALUES (?, ?)', ('users', time.time()))
+        connection.close()
+        # A snapshot of an older cache cannot tell when it was last fully refreshed, so it has expired
+        cache = DirectoryCache(path, ttl=60)
+        assert cache.get_records('users') is None
+        assert cache.get_snapshot_ids('users')[0] == set()
+
+    def test_directory_cache_stale_while_revalidate(self, tmp_path):
+        on_stale = MagicMock()
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'), ttl=60, max_age=3600, on_stale=on_stale)
+        cache.set_records('users', [{'id': '1', 'username': 'dave'}])
+        assert cache.get_records('users') == [{'id': '1', 'username': 'dave'}]
+        on_stale.assert_not_called()
+        with patch('jccli.cache.time.time', return_value=time.time() + 61):
+            assert cache.get_records('users') == [{'id': '1', 'username': 'dave'}]
+            assert cache.find_records('users', username='dave') == [{'id': '1', 'username': 'dave'}]
+        on_stale.assert_called_once_with('users')
+        # Past the maximum age, the snapshot is not used at all
+        with patch('jccli.cache.time.time', return_value=time.time() + 3601):
+            assert cache.get_records('users') is None
+
+    def test_directory_cache_kinds(self, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        for kind in ('users', 'group_members/1', 'group_members/2'):
+            cache.set_records(kind, [])
+        assert cache.get_kinds('group_members/') == ['group_members/1', 'group_members/2']
+        assert len(cache.get_kinds()) == 3
+
+    def test_directory_cache_single_refresher(self, tmp_path):
+        path = str(tmp_path / 'cache.sqlite')
+        refreshes = []
+
+        def get_users():
+            # Each caller has a cache of its own, as separate processes would
+            cache = DirectoryCache(path, ttl=60)
+
+            def refresh():
+                refreshes.append(1)
+                time.sleep(0.2)
+                cache.set_records('users', [{'id': '1', 'username': 'dave'}])
+                return [{'id': '1', 'username': 'dave'}]
+
+            return cache.get_or_refresh('users', refresh)
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda _: get_users(), range(10)))
+        assert len(refreshes) == 1
+        assert all(users == [{'id': '1', 'username': 'dave'}] for users, _ in results)
+        assert [refreshed for _, refreshed in results].count(True) == 1
+
+    def test_cache_path(self):
+        path = cache_path('/cache', 'DEFAULT', 'secret-key')
+        assert path.startswith('/cache/DEFAULT-')
+        assert 'secret-key' not in path
+        assert path != cache_path('/cache', 'DEFAULT', 'other-key')
@@ -10,18 +10,27 @@ module.
 """
 # fmt: off
 import json
+import shutil
+import tempfile
 import pytest
+import jcapiv1
 from jcapiv1 import Systemuserslist, Systemuser, System, Systemslist
 from jcapiv2 import Group, GraphConnection, GraphObject
 import jccli.cli as cli
 
 # fmt: on
 from click.testing import CliRunner, Result
+import mock
 from mock import patch
 from unittest.mock import patch as unittest_patch
+from jccli import sync_plan
+from jccli.cache import DirectoryCache, cache_path, reset_indexes
+from jccli.cli.sync import journal_path
+from jccli.errors import JcApiException
 from jccli.helpers import PAGE_LIMIT
 from jccli.jc_api_v1 import JumpcloudApiV1
 from jccli.jc_api_v2 import JumpcloudApiV2
+from jccli.journal import SyncJournal
 
 
 MOCK_USER_GROUPS = [Group(id=str(i), name='group-%d' % (i,), type='user_group') for i in range(2*PAGE_LIMIT+2)]
@@ -39,6 +48,12 @@ def mock_search_users(self, content_type, accept, body, **kwargs):
     return Systemuserslist(results=MOCK_USERS_LIST[skip:skip+limit], total_count=len(MOCK_USERS_LIST))
 
 
+def mock_get_user(self, id, content_type, accept, **kwargs):
+    """Mock of SystemusersApi.systemusers_get()
+    """
+    return next(user for user in MOCK_USERS_LIST if user.id == id)
+
+
 def mock_search_systems(self, content_type, accept, body, **kwargs):
     """Mock of SearchApi.search_systems_post()
     """
@@ -48,25 +63,31 @@ def mock_search_systems(self, content_type, accept, body, **kwargs):
 
 
 def mock_groups_list(self, content_type, accept, limit, skip, filter, **kwargs):
-    """Mock of groups_api.groups_list(), used for testing pagination
+    """Mock of groups_api.groups_list_with_http_info(), used for testing pagination
     """
-    return MOCK_USER_GROUPS[skip:skip+limit]
+    return MOCK_USER_GROUPS[skip:skip+limit], 200, {'x-total-count': str(len(MOCK_USER_GROUPS))}
 
 
 def mock_list_user_group_members(self, content_type, accept, group_id, limit, skip, **kwargs):
-    """Mock of user_groups_api.graph_user_group_members_list(), used for testing pagination.
-    (Pretends that all users are members of this group)
+    """Mock of user_groups_api.graph_user_group_members_list_with_http_info(), used for testing pagination.
+    (Pretends that all users are members of this group, and sends no total count header)
     """
     assert group_id == MOCK_GROUP_ID
-    return [GraphConnection(to=GraphObject(id=user.id, type='user')) for user in MOCK_USERS_LIST[skip:skip+limit]]
+    results = [GraphConnection(to=GraphObject(id=user.id, type='user')) for user in MOCK_USERS_LIST[skip:skip+limit]]
+    return results, 200, {}
 
 
 class TestCli:
     def setup_method(self, test_method):
-        pass
+        # Keep the local directory cache of each test apart
+        reset_indexes()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_dir_patch = unittest_patch('jccli.cli.CACHE_DIR', self.cache_dir)
+        self.cache_dir_patch.start()
 
     def teardown_method(self, test_method):
-        pass
+        self.cache_dir_patch.stop()
+        shutil.rmtree(self.cache_dir)
 
     @patch.object(JumpcloudApiV2,'create_group')
     def test_create_group_type_user(self, mock_create_group):
@@ -241,7 +262,7 @@ class TestCli:
         observed_response = json.loads(result.output)
         assert observed_response == response, "Failed to update user"
 
-    @unittest_patch('jcapiv2.api.groups_api.GroupsApi.groups_list', new=mock_groups_list)
+    @unittest_patch('jcapiv2.api.groups_api.GroupsApi.groups_list_with_http_info', new=mock_groups_list)
     def test_group_pagination(self):
         """Test that list-groups can handle pagination
         """
@@ -303,7 +324,9 @@ class TestCli:
         assert observed_response == [system.to_dict() for system in MOCK_SYSTEMS_LIST]
 
     @unittest_patch('jcapiv1.api.search_api.SearchApi.search_systemusers_post', new=mock_search_users)
-    @unittest_patch('jcapiv2.api.user_groups_api.UserGroupsApi.graph_user_group_members_list', new=mock_list_user_group_members)
+    @unittest_patch('jcapiv1.api.systemusers_api.SystemusersApi.systemusers_get', new=mock_get_user)
+    @unittest_patch('jcapiv2.api.user_groups_api.UserGroupsApi.graph_user_group_members_list_with_http_info',
+                    new=mock_list_user_group_members)
     @patch('jccli.jc_api_v2.JumpcloudApiV2.get_group')
     def test_group_users_pagination(self, mock_get_group):
         """Test that list-systems can handle pagination
@@ -326,3 +349,278 @@ class TestCli:
             raise result.exception
         observed_response = json.loads(result.output)
         assert observed_response == [user.to_dict() for user in MOCK_USERS_LIST]
+
+    @patch.object(JumpcloudApiV1, 'create_users')
+    @patch.object(JumpcloudApiV1, 'fill_user_ids')
+    @patch.object(JumpcloudApiV2, 'bulk_create_users')
+    def test_create_users_bulk(self, mock_bulk_create_users, mock_fill_user_ids, mock_create_users):
+        mock_fill_user_ids.side_effect = lambda users: users
+        mock_bulk_create_users.return_value = [{'username': 'dave', 'id': '1', 'status': 'finished'}]
+        mock_create_users.return_value = [{'username': 'mary', 'id': '2', 'status': 'finished'}]
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open('users.json', 'w') as data_file:
+                json.dump({'users': [{'username': 'dave', 'email': 'dave@fakesite.org', 'lastname': 'Smith'},
+                                     {'username': 'mary', 'email': 'mary@fakesite.org', 'sudo': 'True'}]}, data_file)
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'user', 'create-bulk', '--data',
+                                             'users.json'])
+        assert result.exit_code == 0
+        # The bulk job cannot set sudo, so that user is created on its own
+        assert [user['username'] for user in mock_bulk_create_users.call_args[0][0]] == ['dave']
+        assert mock_create_users.call_args[0][0] == [{'username': 'mary', 'email': 'mary@fakesite.org',
+                                                      'sudo': 'True'}]
+        assert [user['username'] for user in json.loads(result.output)] == ['dave', 'mary']
+
+        # A user which failed to be created makes the command fail
+        mock_create_users.return_value = [{'username': 'mary', 'id': None, 'status': 'failed', 'status_msg': 'boom'}]
+        with runner.isolated_filesystem():
+            with open('users.json', 'w') as data_file:
+                json.dump({'users': [{'username': 'dave', 'email': 'dave@fakesite.org', 'lastname': 'Smith'},
+                                     {'username': 'mary', 'email': 'mary@fakesite.org', 'sudo': 'True'}]}, data_file)
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'user', 'create-bulk', '--data',
+                                             'users.json'])
+        assert result.exit_code == 1
+        assert [user['status'] for user in json.loads(result.output)] == ['finished', 'failed']
+
+    @patch.object(JumpcloudApiV1, 'set_users')
+    @patch.object(JumpcloudApiV2, 'bulk_update_users')
+    @patch.object(JumpcloudApiV1, 'get_user_id')
+    def test_set_users_bulk(self, mock_get_user_id, mock_bulk_update_users, mock_set_users):
+        mock_get_user_id.side_effect = lambda username: {'dave': '1', 'mary': '2'}[username]
+        mock_bulk_update_users.return_value = [
+            {'username': 'dave', 'id': '1', 'status': 'finished', 'status_msg': None}
+        ]
+        mock_set_users.return_value = [
+            {'username': 'mary', 'id': '2', 'status': 'finished', 'status_msg': None}
+        ]
+        runner: CliRunner = CliRunner()
+        result: Result = runner.invoke(
+            cli.cli,
+            ['--key', 'ASDFfakekey1234', 'user', 'set-bulk', '-'],
+            input=json.dumps({'dave': {'lastname': 'Smith'}, 'mary': {'sudo': True}})
+        )
+        assert result.exit_code == 0
+        assert mock_bulk_update_users.call_args[0][0] == [
+            {'id': '1', 'username': 'dave', 'changes': {'lastname': 'Smith'}}
+        ]
+        assert mock_set_users.call_args[0][0] == {'mary': {'sudo': True}}
+        assert [user['username'] for user in json.loads(result.output)] == ['dave', 'mary']
+
+    @patch.object(JumpcloudApiV1, 'delete_user')
+    @patch.object(JumpcloudApiV1, 'create_user')
+    @patch.object(JumpcloudApiV1, 'search_users')
+    @patch.object(JumpcloudApiV1, 'count_users')
+    @patch.object(JumpcloudApiV2, 'get_groups')
+    @patch.object(JumpcloudApiV2, 'count_groups')
+    def test_sync_plan_and_apply(self, mock_count_groups, mock_get_groups, mock_count_users, mock_search_users,
+                                 mock_create_user, mock_delete_user):
+        mock_count_groups.return_value = 4
+        mock_get_groups.return_value = [{'id': str(i), 'name': name, 'type': type} for i, (name, type) in enumerate(
+            [('admins', 'user_group'), ('guests', 'user_group'), ('app1', 'system_group'), ('app2', 'system_group')])]
+        mock_count_users.return_value = 2
+        mock_search_users.return_value = [
+            {'id': '1', 'username': 'jctester1', 'email': 'jc.tester1@sagebase.org', 'firstname': 'JC',
+             'lastname': 'Tester1'},
+            {'id': '2', 'username': 'olduser', 'email': 'old@sagebase.org'},
+        ]
+        mock_create_user.return_value = {'id': '3', 'username': 'jctester2'}
+
+        runner = CliRunner(mix_stderr=False)
+        with runner.isolated_filesystem() as directory, unittest_patch('jccli.cli.sync.CACHE_DIR', directory):
+            with open('data.json', 'w') as data_file:
+                json.dump({
+                    'groups': [{'name': name, 'type': type} for name, type in [
+                        ('admins', 'user_group'), ('guests', 'user_group'), ('app1', 'system_group'),
+                        ('app2', 'system_group')]],
+                    'users': [
+                        {'email': 'jc.tester1@sagebase.org', 'firstname': 'JC', 'lastname': 'Tester1',
+                         'username': 'jctester1'},
+                        {'email': 'jc.tester2@sagebase.com', 'firstname': 'JC', 'lastname': 'Tester2',
+                         'username': 'jctester2'},
+                    ]
+                }, data_file)
+
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'plan', '--data', 'data.json',
+                                             '--out', 'plan.json'])
+            assert result.exit_code == 0
+            assert result.stderr.splitlines() == ['create user: jctester2', 'remove user: olduser']
+            mock_create_user.assert_not_called()
+
+            mock_search_users.reset_mock()
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'apply', 'plan.json', '--yes'])
+            assert result.exit_code == 0
+            assert result.output.splitlines() == ['create user: jctester2', 'remove user: olduser']
+            mock_search_users.assert_not_called()
+            mock_create_user.assert_called_once()
+            mock_delete_user.assert_called_once_with('olduser', user_id='2')
+
+            # The plan is stale once jumpcloud has changed
+            mock_count_users.return_value = 3
+            mock_create_user.reset_mock()
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'apply', 'plan.json', '--yes'])
+            assert result.exit_code == 1
+            mock_create_user.assert_not_called()
+
+            # Nor is a plan applied when the number of groups is unknown, unless forced
+            mock_count_users.return_value = 2
+            mock_count_groups.return_value = None
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'apply', 'plan.json', '--yes'])
+            assert result.exit_code == 1
+            assert 'the number of groups is unknown' in result.stderr
+            mock_create_user.assert_not_called()
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'apply', 'plan.json', '--yes',
+                                             '--force'])
+            assert result.exit_code == 0
+            mock_create_user.assert_called_once()
+
+    @patch.object(JumpcloudApiV1, 'delete_user')
+    @patch.object(JumpcloudApiV1, 'search_users')
+    @patch.object(JumpcloudApiV2, 'get_groups')
+    def test_sync_resume(self, mock_get_groups, mock_search_users, mock_delete_user):
+        mock_get_groups.return_value = []
+        mock_search_users.return_value = [
+            {'id': str(i), 'username': 'user%d' % (i,), 'email': 'user%d@sagebase.org' % (i,)} for i in range(3)
+        ]
+        mock_delete_user.side_effect = [None, JcApiException("boom"), None]
+
+        runner = CliRunner()
+        with runner.isolated_filesystem() as directory, unittest_patch('jccli.cli.sync.CACHE_DIR', directory):
+            with open('data.json', 'w') as data_file:
+                json.dump({'groups': [], 'users': []}, data_file)
+
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', '--data', 'data.json', '--yes'])
+            assert result.exit_code == 1
+            assert mock_delete_user.call_count == 3
+
+            mock_search_users.reset_mock()
+            mock_delete_user.reset_mock(side_effect=True)
+            # A dry run only shows what is left to do
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', '--data', 'data.json', '--dry-run',
+                                             '--resume'])
+            assert result.exit_code == 0
+            assert result.output == "remove user: user1\n"
+            mock_delete_user.assert_not_called()
+
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', '--data', 'data.json', '--yes',
+                                             '--resume'])
+            assert result.exit_code == 0
+            mock_search_users.assert_not_called()
+            mock_delete_user.assert_called_once_with('user1', user_id='1')
+
+            # The journal is gone once the sync is complete
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', '--data', 'data.json', '--yes',
+                                             '--resume'])
+            assert result.exit_code == 1
+
+    @patch.object(JumpcloudApiV1, 'delete_user')
+    def test_sync_apply_resume_confirms(self, mock_delete_user):
+        runner = CliRunner()
+        with runner.isolated_filesystem() as directory, unittest_patch('jccli.cli.sync.CACHE_DIR', directory):
+            plan = sync_plan.make_plan([], [], [], [{'id': '1', 'username': 'olduser', 'email': 'old@sagebase.org'}])
+            with open('plan.json', 'w') as plan_file:
+                sync_plan.save_plan(plan, plan_file)
+            ctx = mock.Mock(obj={'key': 'ASDFfakekey1234'})
+            SyncJournal.start(journal_path(ctx, 'plan.json'), plan).close()
+
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'apply', 'plan.json', '--resume'],
+                                   input='n\n')
+            assert result.exit_code == 1
+            assert result.output.startswith('remove user: olduser\n')
+            mock_delete_user.assert_not_called()
+
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'sync', 'apply', 'plan.json', '--resume'],
+                                   input='y\n')
+            assert result.exit_code == 0
+            mock_delete_user.assert_called_once_with('olduser', user_id='1')
+
+    @patch.object(JumpcloudApiV1, 'search_users')
+    def test_user_get_from_cache(self, mock_search_users):
+        # Fill the cache of the default profile with the whole directory
+        mock_search_users.return_value = [{'id': '1', 'username': 'dave', 'email': 'dave@sagebase.org'}]
+        cache = DirectoryCache(cache_path(self.cache_dir, 'DEFAULT', 'ASDFfakekey1234'))
+        JumpcloudApiV1('ASDFfakekey1234', cache=cache).refresh_user_index()
+
+        runner = CliRunner()
+        with patch.object(jcapiv1.SystemusersApi, 'systemusers_list') as mock_systemusers_list:
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'user', 'get', '--username', 'dave'])
+            assert result.exit_code == 0
+            assert json.loads(result.output)['id'] == '1'
+            mock_systemusers_list.assert_not_called()
+
+            # Without the cache, or with an expired cache, the API is asked
+            mock_systemusers_list.return_value = Systemuserslist(results=[Systemuser(id='1', username='dave')])
+            for options in (['--no-cache'], ['--refresh'], ['--cache-ttl', '0']):
+                result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234'] + options +
+                                       ['user', 'get', '--username', 'dave'])
+                assert result.exit_code == 0
+            assert mock_systemusers_list.call_count == 3
+
+    @patch.object(JumpcloudApiV2, 'refresh_cache')
+    @patch.object(JumpcloudApiV1, 'refresh_cache')
+    def test_cache_refresh(self, mock_refresh_cache, mock_refresh_cache_v2):
+        mock_refresh_cache.return_value = {
+            'users': {'fetched': 2, 'removed': 1, 'full': False},
+            'systems': {'fetched': 3, 'removed': 0, 'full': True}
+        }
+        mock_refresh_cache_v2.return_value = {'groups': {'fetched': 1, 'removed': 0, 'full': True}}
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'cache', 'refresh', '--full'])
+        assert result.exit_code == 0
+        assert result.output == ("users: 2 fetched, 1 removed\n"
+                                 "systems: 3 fetched, 0 removed (full refresh)\n"
+                                 "groups: 1 fetched, 0 removed (full refresh)\n")
+        mock_refresh_cache.assert_called_once_with(full=True)
+
+        result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', '--no-cache', 'cache', 'refresh'])
+        assert result.exit_code == 1
+
+    @patch('subprocess.Popen')
+    @patch.object(JumpcloudApiV1, 'search_users')
+    def test_user_get_from_stale_cache(self, mock_search_users, mock_popen):
+        mock_search_users.return_value = [{'id': '1', 'username': 'dave', 'email': 'dave@sagebase.org'}]
+        cache = DirectoryCache(cache_path(self.cache_dir, 'DEFAULT', 'ASDFfakekey1234'))
+        JumpcloudApiV1('ASDFfakekey1234', cache=cache).refresh_user_index()
+
+        runner = CliRunner()
+        with patch.object(jcapiv1.SystemusersApi, 'systemusers_list') as mock_systemusers_list:
+            # The expired cache is answered from, and refreshed by a detached `jccli cache refresh`
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', '--cache-ttl', '0', '--cache-max-age', '3600',
+                                             'user', 'get', '--username', 'dave'])
+            assert result.exit_code == 0
+            assert json.loads(result.output)['id'] == '1'
+            mock_systemusers_list.assert_not_called()
+        mock_popen.assert_called_once()
+        assert mock_popen.call_args[0][0][-3:] == ['cache', 'refresh', '--if-stale']
+        assert mock_popen.call_args[1]['env']['JC_API_KEY'] == 'ASDFfakekey1234'
+        assert 'ASDFfakekey1234' not in mock_popen.call_args[0][0]
+
+    @patch.object(JumpcloudApiV1, 'refresh_cache')
+    def test_cache_refresh_if_stale(self, mock_refresh_cache):
+        cache = DirectoryCache(cache_path(self.cache_dir, 'DEFAULT', 'ASDFfakekey1234'))
+        cache.set_records('users', [])
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', 'cache', 'refresh', '--if-stale'])
+        assert result.exit_code == 0
+        assert result.output == "the cache is fresh\n"
+
+        # Only one refresh runs at a time
+        with cache.refresh_lock('directory'):
+            result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', '--cache-ttl', '0',
+                                             'cache', 'refresh', '--if-stale'])
+        assert result.exit_code == 0
+        assert result.output == "another refresh is running\n"
+        mock_refresh_cache.assert_not_called()
+
+    @patch.object(JumpcloudApiV2, 'refresh_cache')
+    @patch.object(JumpcloudApiV1, 'refresh_cache')
+    def test_cache_refresh_if_stale_is_full(self, mock_refresh_cache, mock_refresh_cache_v2):
+        mock_refresh_cache.return_value = {'users': {'fetched': 1, 'removed': 0, 'full': True}}
+        mock_refresh_cache_v2.return_value = {}
+        cache = DirectoryCache(cache_path(self.cache_dir, 'DEFAULT', 'ASDFfakekey1234'))
+        cache.set_records('users', [])
+        runner = CliRunner()
+        # An expired cache is fetched in full, since an incremental refresh would not renew it
+        result = runner.invoke(cli.cli, ['--key', 'ASDFfakekey1234', '--cache-ttl', '0',
+                                         'cache', 'refresh', '--if-stale'])
+        assert result.exit_code == 0
+        mock_refresh_cache.assert_called_once_with(full=True)
@@ -8,7 +8,10 @@
 This is the test module for the jccli helpers module.
 """
 # fmt: off
+import json
+import os
 import pytest
+from mock import patch
 
 # fmt: on
 import jccli.helpers as jccli_helpers
@@ -52,6 +55,57 @@ class TestHelpers:
         users = jccli_helpers.get_groups_from_file(TEST_DATA_PATH+"test_data_no_groups.json")
         assert (len(users) == 0), "Invalid number of groups"
 
+    def test_load_data_file(self):
+        data = jccli_helpers.load_data_file(TEST_DATA_PATH+"test_data.yaml")
+        assert data['users'] == jccli_helpers.load_data_file(TEST_DATA_PATH+"test_data.json")['users']
+
+    @pytest.mark.parametrize('data_file', ["test_data.csv", "test_data.jsonl"])
+    def test_load_data_file_records(self, data_file):
+        expected = jccli_helpers.load_data_file(TEST_DATA_PATH+"test_data.json")
+        expected['groups'][0]['members'] = ['jctester1', 'jctester2']
+        assert jccli_helpers.load_data_file(TEST_DATA_PATH+data_file) == expected
+
+    def test_iter_data_records_invalid(self):
+        with pytest.raises(ValueError):
+            list(jccli_helpers.iter_data_records(['{"email": "jc.tester1@sagebase.org"}\n'], '.jsonl'))
+        with pytest.raises(ValueError):
+            list(jccli_helpers.iter_data_records(['kind,username\n', 'system,app1\n'], '.csv'))
+
+    def test_load_data_file_cache(self, tmp_path):
+        data_file = str(tmp_path / 'data.yaml')
+        with open(data_file, 'w') as file:
+            file.write("users:\n  - username: dave\n")
+        cache_dir = str(tmp_path / 'cache')
+
+        with patch.object(jccli_helpers.yaml, 'load', wraps=jccli_helpers.yaml.load) as mock_load:
+            assert jccli_helpers.load_data_file(data_file, cache_dir=cache_dir) == {'users': [{'username': 'dave'}]}
+            assert jccli_helpers.load_data_file(data_file, cache_dir=cache_dir) == {'users': [{'username': 'dave'}]}
+            # A new modification time with the same content still hits the cache
+            os.utime(data_file, ns=(0, 0))
+            assert jccli_helpers.load_data_file(data_file, cache_dir=cache_dir) == {'users': [{'username': 'dave'}]}
+            assert mock_load.call_count == 1
+
+            with open(data_file, 'w') as file:
+                file.write("users:\n  - username: mary\n")
+            assert jccli_helpers.load_data_file(data_file, cache_dir=cache_dir) == {'users': [{'username': 'mary'}]}
+            assert mock_load.call_count == 2
+
+    def test_load_data_file_not_a_mapping(self, tmp_path):
+        data_file = str(tmp_path / 'data.json')
+        with open(data_file, 'w') as file:
+            file.write('[]')
+        with pytest.raises(ValueError):
+            jccli_helpers.load_data_file(data_file)
+
+    def test_file_lock(self, tmp_path):
+        path = str(tmp_path / 'locks' / 'test.lock')
+        with jccli_helpers.file_lock(path) as locked:
+            assert locked
+            with jccli_helpers.file_lock(path, blocking=False) as locked_again:
+                assert not locked_again
+        with jccli_helpers.file_lock(path, blocking=False) as locked:
+            assert locked
+
     def test_get_user_from_term_valid_json(self):
         user = jccli_helpers.get_user_from_term("{\"email\": \"jc.tester1@sagebase.org\", \"username\": \"jctester1\"}")
         assert (user['email'] == "jc.tester1@sagebase.org" and
@@ -65,3 +119,73 @@ class TestHelpers:
     def test_make_query_filter(self):
         filter = {'field1': 'value1', 'field2': 'value2'}
         assert jccli_helpers.make_query_filter(filter) == {'and': [{'field1': 'value1'}, {'field2': 'value2'}]}
+
+    def test_convert_scalar(self):
+        assert jccli_helpers.convert_scalar('True', 'bool') is True
+        assert jccli_helpers.convert_scalar('no', 'bool') is False
+        assert jccli_helpers.convert_scalar(' 5001 ', 'int') == 5001
+        assert jccli_helpers.convert_scalar(5001, 'int') == 5001
+        assert jccli_helpers.convert_scalar('5001', 'str') == '5001'
+        with pytest.raises(ValueError):
+            jccli_helpers.convert_scalar('many', 'int')
+
+    def test_get_pages(self):
+        records = [{'id': str(i)} for i in range(2 * jccli_helpers.PAGE_LIMIT + 5)]
+
+        def fetch_page(skip):
+            return records[skip:skip + jccli_helpers.PAGE_LIMIT], len(records)
+
+        assert jccli_helpers.get_pages(fetch_page, max_workers=4) == records
+
+    def test_get_pages_short_first_page(self):
+        records = [{'id': str(i)} for i in range(25)]
+
+        def fetch_page(skip):
+            return records[skip:skip + 10], len(records)
+
+        assert jccli_helpers.get_pages(fetch_page) == records
+
+    def test_get_pages_unknown_total(self):
+        records = [{'id': str(i)} for i in range(3 * jccli_helpers.PAGE_LIMIT + 7)]
+        requested_skips = []
+
+        def fetch_page(skip):
+            requested_skips.append(skip)
+            return records[skip:skip + jccli_helpers.PAGE_LIMIT], None
+
+        assert jccli_helpers.get_pages(fetch_page, max_workers=2) == records
+        assert max(requested_skips) <= 4 * jccli_helpers.PAGE_LIMIT, "at most one window past the last page"
+
+    def test_get_pages_unknown_total_single_page(self):
+        requested_skips = []
+
+        def fetch_page(skip):
+            requested_skips.append(skip)
+            return [{'id': '1'}], None
+
+        assert jccli_helpers.get_pages(fetch_page) == [{'id': '1'}]
+        assert requested_skips == [0]
+
+    def test_get_pages_no_results(self):
+        assert jccli_helpers.get_pages(lambda skip: ([], 0)) == []
+
+    def test_unique_by_id(self):
+        records = [{'id': '1'}, {'id': '2'}, {'id': '1'}, {'id': '3'}]
+        assert list(jccli_helpers.unique_by_id(records)) == [{'id': '1'}, {'id': '2'}, {'id': '3'}]
+
+    def test_iter_pages_stops_early(self):
+        requested_skips = []
+
+        def fetch_page(skip):
+            requested_skips.append(skip)
+            return [{'id': str(skip)}] * jccli_helpers.PAGE_LIMIT, 100 * jccli_helpers.PAGE_LIMIT
+
+        pages = jccli_helpers.iter_pages(fetch_page, max_workers=2)
+        next(pages)
+        next(pages)
+        pages.close()
+        assert len(requested_skips) <= 4, "only a window of pages should be fetched ahead of the consumer"
+
+    def test_iter_json_list(self):
+        for items in ([], [{'a': 1}], [{'a': [1, 2], 'b': {'c': None}}, 'x', 3]):
+            assert ''.join(jccli_helpers.iter_json_list(iter(items))) == json.dumps(items, indent=2)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_jc_api_async
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+This is the test module for the project's asyncio JC API module.
+"""
+# fmt: off
+import asyncio
+import json
+import pytest
+from contextlib import asynccontextmanager
+
+# fmt: on
+from mock import patch
+from jccli.errors import SystemUserNotFoundError
+from jccli.helpers import PAGE_LIMIT
+from jccli.jc_api_async import AsyncJumpcloudApi, V1_URL, V2_URL
+
+
+MOCK_USERS = [{'_id': str(i), 'username': 'user-%d' % (i,)} for i in range(5 * PAGE_LIMIT + 3)]
+
+
+class MockResponse:
+    def __init__(self, data, status=200):
+        self.status = status
+        self.headers = {}
+        self._data = data
+
+    async def read(self):
+        return json.dumps(self._data).encode()
+
+
+class MockSession:
+    """Stand-in for the aiohttp session, which also records how many requests were in flight at once
+    """
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @asynccontextmanager
+    async def request(self, method, url, json=None, params=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        yield self.respond(method, url, json, params)
+
+    def respond(self, method, url, body, params):
+        if url == V1_URL + '/search/systemusers':
+            users = MOCK_USERS
+            if body['filter']:
+                users = [user for user in users if user['username'] == body['filter']['and'][0]['username']]
+            return MockResponse({'results': users[body['skip']:body['skip'] + body['limit']],
+                                 'totalCount': len(users)})
+        if url == V2_URL + '/usergroups/group-1/members':
+            members = [{'to': {'id': user['_id'], 'type': 'user'}} for user in MOCK_USERS]
+            return MockResponse(members[params['skip']:params['skip'] + params['limit']])
+        if method == 'POST' and url == V1_URL + '/systemusers':
+            return MockResponse(dict(body, _id='new'))
+        if url.startswith(V1_URL + '/systemusers/'):
+            user_id = url.rsplit('/', 1)[1]
+            users = [user for user in MOCK_USERS if user['_id'] == user_id]
+            return MockResponse(users[0] if users else {'message': 'Not Found'}, 200 if users else 404)
+        raise AssertionError('unexpected request %s %s' % (method, url))
+
+
+class TestJcApiAsync:
+    def setup_method(self, test_method):
+        pass
+
+    def teardown_method(self, test_method):
+        pass
+
+    def test_search_users(self):
+        session = MockSession()
+        api = AsyncJumpcloudApi("1234", max_concurrency=2)
+        with patch.object(api, '_get_session', return_value=session):
+            users = asyncio.run(api.search_users())
+        assert [user['id'] for user in users] == [user['_id'] for user in MOCK_USERS]
+        assert session.max_in_flight == 2
+
+    def test_get_user_id(self):
+        api = AsyncJumpcloudApi("1234")
+        with patch.object(api, '_get_session', return_value=MockSession()):
+            assert asyncio.run(api.get_user_id('user-5')) == '5'
+        api = AsyncJumpcloudApi("1234")
+        with patch.object(api, '_get_session', return_value=MockSession()):
+            with pytest.raises(SystemUserNotFoundError):
+                asyncio.run(api.get_user_id('foo'))
+
+    def test_retrieve_users(self):
+        api = AsyncJumpcloudApi("1234")
+        with patch.object(api, '_get_session', return_value=MockSession()):
+            users = asyncio.run(api.retrieve_users(['3', 'missing', '1']))
+        assert [user['username'] for user in users] == ['user-3', 'user-1']
+
+    def test_list_group_users(self):
+        api = AsyncJumpcloudApi("1234")
+        with patch.object(api, '_get_session', return_value=MockSession()):
+            user_ids = asyncio.run(api.list_group_users('group-1'))
+        assert user_ids == [user['_id'] for user in MOCK_USERS]
+
+    def test_create_user(self):
+        api = AsyncJumpcloudApi("1234")
+        with patch.object(api, '_get_session', return_value=MockSession()):
+            # Flags and numbers are taken as they are or as strings, like by the synchronous client
+            user = asyncio.run(api.create_user({'username': 'new', 'email': 'new@example.org', 'sudo': True,
+                                                'passwordless_sudo': 'yes', 'unix_uid': '5001'}))
+        assert user['id'] == 'new'
+        assert (user['sudo'], user['passwordless_sudo'], user['allow_public_key']) == (True, True, True)
+        assert user['unix_uid'] == 5001
+
+    def test_create_group_invalid_group(self):
+        api = AsyncJumpcloudApi("1234")
+        with pytest.raises(ValueError):
+            asyncio.run(api.create_group("name", "invalid"))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_jc_api_client
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+This is the test module for the project's shared API client module.
+"""
+# fmt: off
+import jcapiv1
+import jcapiv2
+
+# fmt: on
+from jccli import jc_api_client
+from jccli.jc_api_v1 import JumpcloudApiV1
+from jccli.jc_api_v2 import JumpcloudApiV2
+
+
+class TestJcApiClient:
+    def setup_method(self, test_method):
+        jc_api_client.reset_api_clients()
+
+    def teardown_method(self, test_method):
+        jc_api_client.set_max_pool_size(jc_api_client.MAX_POOL_SIZE)
+
+    def test_api_client_shared_between_wrappers(self):
+        api1 = JumpcloudApiV1("1234")
+        other_api1 = JumpcloudApiV1("1234")
+        assert api1.search_api.api_client is api1.system_users_api.api_client
+        assert api1.search_api.api_client is other_api1.systems_api.api_client
+
+    def test_api_client_per_key(self):
+        assert jc_api_client.get_api_client(jcapiv1, "1234") is not jc_api_client.get_api_client(jcapiv1, "5678")
+
+    def test_pool_manager_shared_between_api_versions(self):
+        api1 = JumpcloudApiV1("1234")
+        api2 = JumpcloudApiV2("1234")
+        assert api1.search_api.api_client.rest_client.pool_manager is \
+            api2.groups_api.api_client.rest_client.pool_manager
+
+    def test_set_max_pool_size(self):
+        jc_api_client.set_max_pool_size(64)
+        api_client = jc_api_client.get_api_client(jcapiv2, "1234")
+        assert api_client.configuration.connection_pool_maxsize == 64
@@ -8,20 +8,24 @@
 This is the test module for the project's JC API V1 module.
 """
 # fmt: off
+import json
+import time
 import pytest
 import jcapiv1
 
 # fmt: on
-from jcapiv1 import Systemuserreturn, Systemuserslist
+from jcapiv1 import Systemslist, Systemuserreturn, Systemuserslist
+from jcapiv1.rest import ApiException
 from mock import MagicMock, patch, sentinel
+from jccli.cache import DirectoryCache, reset_indexes
 from jccli.jc_api_v1 import JumpcloudApiV1
-from jccli.errors import SystemUserNotFoundError
+from jccli.errors import JcApiException, SystemUserNotFoundError
 from unit_tests.utils import ObjectView
 
 class TestJcApiV1:
 
     def setup_method(self, test_method):
-        pass
+        reset_indexes()
 
     def teardown_method(self, test_method):
         pass
@@ -262,3 +266,204 @@ class TestJcApiV1:
         api1 = JumpcloudApiV1("1234")
         with pytest.raises(SystemUserNotFoundError):
             api1.delete_user("foo")
+
+    @patch.object(JumpcloudApiV1, 'search_users')
+    def test_get_user_id_uses_index(self, mock_search_users):
+        mock_search_users.return_value = [
+            {'id': '1', 'username': 'dave', 'email': 'dave@fakesite.org'},
+            {'id': '2', 'username': 'mary', 'email': 'mary@fakesite.org'}
+        ]
+        api1 = JumpcloudApiV1("1234")
+        assert api1.get_user_id('dave') == '1'
+        assert JumpcloudApiV1("1234").get_user_id('mary') == '2'
+        assert mock_search_users.call_count == 1, "the directory should only be fetched once per process"
+
+    @patch.object(jcapiv1.SystemusersApi, 'systemusers_delete')
+    @patch.object(jcapiv1.SystemusersApi, 'systemusers_post')
+    @patch.object(JumpcloudApiV1, 'search_users')
+    def test_index_follows_create_and_delete(self, mock_search_users, mock_systemusers_post,
+                                             mock_systemusers_delete):
+        mock_search_users.return_value = [{'id': '1', 'username': 'dave', 'email': 'dave@fakesite.org'}]
+        mock_systemusers_post.return_value = Systemuserreturn(id='2', username='mary', email='mary@fakesite.org')
+        api1 = JumpcloudApiV1("1234")
+        api1.get_user_id('dave')
+        api1.create_user({'username': 'mary', 'email': 'mary@fakesite.org'})
+        assert api1.get_user_id('mary') == '2'
+        api1.delete_user('dave')
+        with pytest.raises(SystemUserNotFoundError):
+            api1.get_user_id('dave')
+        assert mock_search_users.call_count == 1
+
+    @patch.object(jcapiv1.SystemusersApi, 'systemusers_post')
+    def test_create_user_flags(self, mock_systemusers_post):
+        mock_systemusers_post.return_value = Systemuserreturn(id='1', username='dave', email='dave@fakesite.org')
+        api1 = JumpcloudApiV1("1234")
+        api1.create_user({'username': 'dave', 'email': 'dave@fakesite.org', 'sudo': 'True', 'allow_public_key': False,
+                          'account_locked': 'no'})
+        body = mock_systemusers_post.call_args[1]['body']
+        assert body.sudo is True
+        assert body.allow_public_key is False
+        assert body.account_locked is False
+        assert body.ldap_binding_user is False
+        assert body.firstname == ''
+
+    @patch.object(JumpcloudApiV1, 'create_user')
+    def test_create_users(self, mock_create_user):
+        def create_user(user):
+            if user['username'] != 'dave':
+                raise JcApiException("email already in use")
+            return {'id': '1'}
+
+        mock_create_user.side_effect = create_user
+        api1 = JumpcloudApiV1("1234")
+        results = api1.create_users([{'username': 'dave', 'email': 'dave@fakesite.org'},
+                                     {'username': 'mary', 'email': 'mary@fakesite.org'}])
+        assert [(result['id'], result['status']) for result in results] == [('1', 'finished'), (None, 'failed')]
+
+    @patch.object(JumpcloudApiV1, 'search_users')
+    def test_get_user_id_from_local_cache(self, mock_search_users, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        cache.set_records('users', [{'id': '1', 'username': 'dave', 'email': 'dave@fakesite.org'}])
+        mock_search_users.return_value = [
+            {'id': '1', 'username': 'dave', 'email': 'dave@fakesite.org'},
+            {'id': '2', 'username': 'mary', 'email': 'mary@fakesite.org'}
+        ]
+        api1 = JumpcloudApiV1("1234", cache=cache)
+        assert api1.get_user_id('dave') == '1'
+        assert mock_search_users.call_count == 0
+        # A user missing from the local cache triggers one refresh
+        assert api1.get_user_id('mary') == '2'
+        assert mock_search_users.call_count == 1
+        assert len(cache.get_records('users')) == 2
+
+    @patch.object(JumpcloudApiV1, 'count_users')
+    @patch.object(jcapiv1.SystemusersApi, 'systemusers_get')
+    def test_retrieve_users(self, mock_systemusers_get, mock_count_users):
+        mock_count_users.return_value = 1000
+        users = {
+            '1': Systemuserreturn(id='1', username='dave'),
+            '2': Systemuserreturn(id='2', username='mary')
+        }
+
+        def get_user(id, **kwargs):
+            if id not in users:
+                raise ApiException(status=404, reason='Not Found')
+            return users[id]
+
+        mock_systemusers_get.side_effect = get_user
+        api1 = JumpcloudApiV1("1234")
+        retrieved = api1.retrieve_users(['2', 'missing', '1', '2'])
+        assert retrieved == [users['2'].to_dict(), users['1'].to_dict()]
+        assert mock_systemusers_get.call_count == 3
+
+    @patch.object(JumpcloudApiV1, 'iter_users')
+    @patch.object(JumpcloudApiV1, 'count_users')
+    @patch.object(jcapiv1.SystemusersApi, 'systemusers_get')
+    def test_retrieve_users_by_scan(self, mock_systemusers_get, mock_count_users, mock_iter_users):
+        # Three ids cost more requests than the two pages of a 150 user directory
+        mock_count_users.return_value = 150
+        mock_iter_users.return_value = iter([{'id': str(i), 'username': f"user{i}"} for i in range(150)])
+        api1 = JumpcloudApiV1("1234")
+        retrieved = api1.retrieve_users(['7', 'missing', '3', '7', '120'])
+        assert retrieved == [{'id': '7', 'username': 'user7'}, {'id': '3', 'username': 'user3'},
+                             {'id': '120', 'username': 'user120'}]
+        mock_systemusers_get.assert_not_called()
+
+    @patch.object(jcapiv1.SearchApi, 'search_systemusers_post')
+    def test_fill_user_ids(self, mock_search_systemusers_post, tmp_path):
+        directory = [Systemuserreturn(id=str(i), username='user%d' % (i,)) for i in range(250)]
+
+        def search(content_type, accept, body, **kwargs):
+            usernames = {term['username'] for term in body['filter']['or']}
+            results = [user for user in directory if user.username in usernames]
+            return Systemuserslist(results=results, total_count=len(results))
+
+        mock_search_systemusers_post.side_effect = search
+        api1 = JumpcloudApiV1("1234", cache=DirectoryCache(str(tmp_path / 'cache.sqlite')))
+        users = [{'username': 'user%d' % (i,), 'id': None} for i in range(150)]
+        users.append({'username': 'unknown', 'id': None})
+        users.append({'username': 'user0', 'id': 'known'})
+        api1.fill_user_ids(users)
+        assert [user['id'] for user in users[:150]] == [str(i) for i in range(150)]
+        assert users[150]['id'] is None
+        assert users[151]['id'] == 'known'
+        # Only the missing usernames are searched for, PAGE_LIMIT at a time
+        assert mock_search_systemusers_post.call_count == 2
+        assert api1.user_index.id_for_username('user149') == '149'
+        api1.cache.set_records('users', [])
+        api1.fill_user_ids([{'username': 'user1', 'id': None}])
+        assert api1.cache.find_records('users', username='user1')[0]['id'] == '1'
+
+    @patch.object(jcapiv1.SearchApi, 'search_systems_post')
+    @patch.object(jcapiv1.SearchApi, 'search_systemusers_post')
+    def test_refresh_cache(self, mock_search_systemusers_post, mock_search_systems_post, tmp_path):
+        directory = [Systemuserreturn(id=str(i), username='user%d' % (i,), created='2020-01-01T00:00:00Z')
+                     for i in range(5)]
+
+        def search(content_type, accept, body, **kwargs):
+            results = directory
+            if body['filter']:
+                since = body['filter']['and'][0]['created']['$gt']
+                results = [user for user in directory if user.created > since]
+            return Systemuserslist(results=results[body['skip']:body['skip'] + body['limit']],
+                                   total_count=len(results))
+
+        mock_search_systemusers_post.side_effect = search
+        mock_search_systems_post.return_value = Systemslist(results=[], total_count=0)
+        api1 = JumpcloudApiV1("1234", cache=DirectoryCache(str(tmp_path / 'cache.sqlite')))
+        assert api1.refresh_cache()['users'] == {'fetched': 5, 'removed': 0, 'full': True}
+
+        # Without changes, a refresh searches for new users and counts them
+        mock_search_systemusers_post.reset_mock()
+        assert api1.refresh_cache()['users'] == {'fetched': 0, 'removed': 0, 'full': False}
+        assert mock_search_systemusers_post.call_count == 2
+
+        # A deletion makes the counts differ, so the ids are listed as well
+        del directory[0]
+        directory.append(Systemuserreturn(id='5', username='user5', created=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                                                            time.gmtime())))
+        mock_search_systemusers_post.reset_mock()
+        assert api1.refresh_cache()['users'] == {'fetched': 1, 'removed': 1, 'full': False}
+        assert mock_search_systemusers_post.call_count == 3
+        assert mock_search_systemusers_post.call_args[1]['body']['fields'] == 'id'
+        assert [user['id'] for user in api1.cache.get_records('users')] == ['1', '2', '3', '4', '5']
+
+        # An old user missing from the cache makes the refresh start over
+        directory.append(Systemuserreturn(id='6', username='user6', created='2020-01-01T00:00:00Z'))
+        assert api1.refresh_cache()['users'] == {'fetched': 6, 'removed': 0, 'full': True}
+
+    @patch.object(jcapiv1.SearchApi, 'search_systemusers_post')
+    def test_search_users_raw(self, mock_search_systemusers_post):
+        users = [
+            Systemuserreturn(id='1', username='dave', firstname='David', email='david@david.net'),
+            Systemuserreturn(id='2', username='mary', firstname='Mary', email='mary@david.net')
+        ]
+        body = {
+            'results': [
+                {Systemuserreturn.attribute_map[field]: value for field, value in user.to_dict().items()}
+                for user in users
+            ],
+            'totalCount': len(users)
+        }
+        mock_search_systemusers_post.return_value = MagicMock(data=json.dumps(body).encode())
+
+        api1 = JumpcloudApiV1("fake_key_123")
+        assert api1.search_users(raw=True) == [user.to_dict() for user in users]
+
+        call_args, call_kwargs = mock_search_systemusers_post.call_args
+        assert call_kwargs['_preload_content'] is False
+        mock_search_systemusers_post.return_value.release_conn.assert_called_once()
+
+    @patch.object(JumpcloudApiV1, 'set_user')
+    def test_set_users(self, mock_set_user):
+        def set_user(username, attributes):
+            if username == 'foo':
+                raise SystemUserNotFoundError('No user found for username: foo')
+            return {'id': '1', 'username': username}
+
+        mock_set_user.side_effect = set_user
+        api1 = JumpcloudApiV1("1234")
+        results = api1.set_users({'dave': {'lastname': 'Smith'}, 'foo': {'lastname': 'Bar'}})
+        assert [(result['username'], result['status']) for result in results] == [
+            ('dave', 'finished'), ('foo', 'failed')
+        ]
@@ -8,22 +8,38 @@
 This is the test module for the project's JC API V2 module.
 """
 # fmt: off
+import json
 import pytest
+import jcapiv2
 
 # fmt: on
-from mock import patch
+from jcapiv2 import Group
+from mock import MagicMock, patch
+from jccli.cache import DirectoryCache, reset_indexes
 from jccli.jc_api_v2 import JumpcloudApiV2
 
 
+def mock_groups_list(groups):
+    """Mock of GroupsApi.groups_list() over `groups`, applying 'name:eq:' filters
+    """
+    def groups_list(content_type, accept, filter, limit, skip, **kwargs):
+        results = [Group(**group) for group in groups]
+        for condition in filter:
+            field, _, value = condition.split(':', 2)
+            results = [group for group in results if getattr(group, field) == value]
+        return results[skip:skip+limit]
+    return groups_list
+
+
 class TestJcApiV2:
     def setup_method(self, test_method):
-        pass
+        reset_indexes()
 
     def teardown_method(self, test_method):
         pass
 
-    @patch.object(JumpcloudApiV2, 'get_groups')
-    def test_get_group(self, mock_get_groups):
+    @patch.object(jcapiv2.GroupsApi, 'groups_list')
+    def test_get_group(self, mock_groups_list_method):
         response = [
             {'id': '5aa80b9f232e110d4215e3b7', 'name': 'admin', 'type': 'user_group'},
             {'id': '5b28760145886d16cbfd736a', 'name': 'guests', 'type': 'user_group'},
@@ -31,19 +47,19 @@ class TestJcApiV2:
             {'id': '5c5357e0232e1164e94b2a11', 'name': 'prod', 'type': 'system_group'}
         ]
         api2 = JumpcloudApiV2("1234")
-        mock_get_groups.return_value = response
+        mock_groups_list_method.side_effect = mock_groups_list(response)
         group = api2.get_group("guests", "user_group")
         assert (
              group['id'] == "5b28760145886d16cbfd736a" and group['type'] == "user_group"
         ), "Failed to get group info"
 
-    @patch.object(JumpcloudApiV2, 'get_groups')
-    def test_get_groups_not_found(self, mock_get_groups):
+    @patch.object(jcapiv2.GroupsApi, 'groups_list')
+    def test_get_groups_not_found(self, mock_groups_list_method):
         response = [
             {'id': '5c5357e0232e1164e94b2a11', 'name': 'prod', 'type': 'system_group'},
         ]
         api2 = JumpcloudApiV2("1234")
-        mock_get_groups.return_value = response
+        mock_groups_list_method.side_effect = mock_groups_list(response)
         group = api2.get_group("foo", 'user_group')
         assert (
              group == None
@@ -53,3 +69,146 @@ class TestJcApiV2:
         api2 = JumpcloudApiV2("1234")
         with pytest.raises(ValueError):
             api2.create_group("name", "invalid")
+
+    @patch.object(jcapiv2.GroupsApi, 'groups_list')
+    @patch.object(jcapiv2.GroupsApi, 'groups_list_with_http_info')
+    def test_get_group_after_listing(self, mock_groups_list_with_http_info, mock_groups_list_method):
+        groups = [Group(id='1', name='admin', type='user_group'), Group(id='2', name='dev', type='system_group')]
+        mock_groups_list_with_http_info.return_value = (groups, 200, {'x-total-count': '2'})
+        api2 = JumpcloudApiV2("1234")
+        api2.get_groups()
+        assert api2.get_group('dev', 'system_group')['id'] == '2'
+        assert api2.get_group('dev', 'user_group') is None
+        assert mock_groups_list_method.call_count == 0, "a complete listing should answer every lookup"
+
+    @patch.object(jcapiv2.UserGroupsApi, 'groups_user_delete')
+    @patch.object(jcapiv2.UserGroupsApi, 'groups_user_post')
+    @patch.object(jcapiv2.GroupsApi, 'groups_list')
+    def test_group_index_follows_create_and_delete(self, mock_groups_list_method, mock_groups_user_post,
+                                                   mock_groups_user_delete, tmp_path):
+        mock_groups_user_post.return_value = Group(id='3', name='staff', type='user_group')
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        api2 = JumpcloudApiV2("1234", cache=cache)
+        api2.create_group('staff', 'user_group')
+        assert api2.get_group('staff', 'user_group')['id'] == '3'
+        assert mock_groups_list_method.call_count == 0
+        assert cache.get_records('groups') is None, "a partial index must not be stored as a complete snapshot"
+
+        api2.delete_group('3', 'user_group')
+        mock_groups_list_method.side_effect = mock_groups_list([])
+        assert api2.get_group('staff', 'user_group') is None
+
+    @patch.object(jcapiv2.GroupsApi, 'groups_list_with_http_info')
+    def test_get_groups_raw(self, mock_groups_list_with_http_info):
+        groups = [Group(id='1', name='admin', type='user_group'), Group(id='2', name='dev', type='system_group')]
+        body = [{Group.attribute_map[field]: value for field, value in group.to_dict().items()} for group in groups]
+        mock_groups_list_with_http_info.return_value = (MagicMock(data=json.dumps(body).encode()), 200, {})
+
+        api2 = JumpcloudApiV2("1234")
+        assert api2.get_groups(raw=True) == [group.to_dict() for group in groups]
+
+    @patch('jccli.jc_api_v2.time.sleep')
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'jobs_results')
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'jobs_get')
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'bulk_users_create')
+    def test_bulk_create_users(self, mock_bulk_users_create, mock_jobs_get, mock_jobs_results, mock_sleep):
+        mock_bulk_users_create.return_value = jcapiv2.JobId(job_id='job-1')
+        mock_jobs_get.side_effect = [jcapiv2.JobDetails(id='job-1', status='in progress'),
+                                     jcapiv2.JobDetails(id='job-1', status='finished')]
+        mock_jobs_results.return_value = [
+            jcapiv2.JobWorkresult(status='finished', persisted_fields={'username': 'dave'},
+                                  meta={'systemUser': '1'}),
+            jcapiv2.JobWorkresult(status='failed', status_msg='email already in use',
+                                  persisted_fields={'username': 'mary'}),
+        ]
+        users = [
+            {'username': 'dave', 'email': 'dave@fakesite.org'},
+            {'username': 'mary', 'email': 'mary@fakesite.org'},
+        ]
+        api2 = JumpcloudApiV2("1234")
+        results = api2.bulk_create_users(users)
+
+        assert [result['id'] for result in results] == ['1', None]
+        assert [result['status'] for result in results] == ['finished', 'failed']
+        assert results[1]['status_msg'] == 'email already in use'
+        assert len(mock_bulk_users_create.call_args[1]['body']) == 2
+        assert mock_jobs_get.call_count == 2
+        assert api2.user_index.id_for_username('dave') == '1'
+
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'bulk_users_create')
+    def test_bulk_create_users_unsupported_fields(self, mock_bulk_users_create):
+        api2 = JumpcloudApiV2("1234")
+        with pytest.raises(ValueError):
+            api2.bulk_create_users([{'username': 'dave', 'email': 'dave@fakesite.org', 'sudo': True}])
+        mock_bulk_users_create.assert_not_called()
+
+    @patch('jccli.jc_api_v2.time.sleep')
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'jobs_results')
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'jobs_get')
+    @patch.object(jcapiv2.BulkJobRequestsApi, 'bulk_users_update')
+    def test_bulk_update_users(self, mock_bulk_users_update, mock_jobs_get, mock_jobs_results, mock_sleep, tmp_path):
+        mock_bulk_users_update.return_value = jcapiv2.JobId(job_id='job-1')
+        mock_jobs_get.return_value = jcapiv2.JobDetails(id='job-1', status='finished')
+        mock_jobs_results.return_value = [
+            jcapiv2.JobWorkresult(status='finished', persisted_fields={'id': '1'}),
+            jcapiv2.JobWorkresult(status='failed', persisted_fields={'id': '2'}),
+        ]
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        cache.set_records('users', [{'id': '1', 'username': 'dave'}, {'id': '2', 'username': 'mary'}])
+        api2 = JumpcloudApiV2("1234", cache=cache)
+        api2.user_index.load(cache.get_records('users'))
+        results = api2.bulk_update_users([
+            {'id': '1', 'username': 'dave', 'changes': {'username': 'david'}},
+            {'id': '2', 'username': 'mary', 'changes': {'username': 'maria'}},
+        ])
+
+        assert [result['status'] for result in results] == ['finished', 'failed']
+        assert api2.user_index.id_for_username('david') == '1'
+        assert api2.user_index.id_for_username('dave') is None
+        assert api2.user_index.id_for_username('mary') == '2'
+        # The cached records are out of date, so they are fetched again when next needed
+        assert cache.get_records('users') == []
+
+    @patch.object(JumpcloudApiV2, 'list_group_users')
+    def test_list_groups_users(self, mock_list_group_users):
+        mock_list_group_users.side_effect = lambda group_id, use_cache, max_workers: ['%s-user' % (group_id,)]
+        api2 = JumpcloudApiV2('fake_key_123')
+        assert api2.list_groups_users(['1', '2', '1']) == {'1': ['1-user'], '2': ['2-user']}
+        assert mock_list_group_users.call_count == 2
+        # Groups are listed concurrently, so each one is paged serially to stay within the connection pool
+        mock_list_group_users.assert_called_with('2', use_cache=True, max_workers=1)
+
+    @patch.object(jcapiv2.GraphApi, 'graph_user_group_members_post')
+    @patch.object(JumpcloudApiV2, 'iter_group_members')
+    def test_list_group_users_cache(self, mock_iter_group_members, mock_members_post, tmp_path):
+        mock_iter_group_members.return_value = iter(['1', '2'])
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        api2 = JumpcloudApiV2('fake_key_123', cache=cache)
+        assert api2.list_group_users('g1') == ['1', '2']
+        api2.bind_user_to_group('3', 'g1')
+        api2.unbind_user_from_group('1', 'g1')
+        assert api2.list_group_users('g1') == ['2', '3']
+        assert mock_iter_group_members.call_count == 1
+
+        mock_iter_group_members.return_value = iter(['2'])
+        assert api2.list_group_users('g1', use_cache=False) == ['2']
+
+    @patch.object(JumpcloudApiV2, 'iter_group_members')
+    @patch.object(JumpcloudApiV2, 'get_groups')
+    def test_refresh_cache(self, mock_get_groups, mock_iter_group_members, tmp_path):
+        cache = DirectoryCache(str(tmp_path / 'cache.sqlite'))
+        cache.set_records('groups', [{'id': 'g1'}, {'id': 'g2'}])
+        cache.set_records('group_members/g1', [{'id': '1'}])
+        cache.set_records('group_members/g2', [{'id': '1'}])
+        mock_get_groups.return_value = [{'id': 'g1'}, {'id': 'g3'}]
+        mock_iter_group_members.return_value = iter(['1', '2'])
+
+        api2 = JumpcloudApiV2('fake_key_123', cache=cache)
+        assert api2.refresh_cache() == {
+            'groups': {'fetched': 2, 'removed': 1, 'full': True},
+            'group_members': {'fetched': 1, 'removed': 1, 'full': True}
+        }
+        # Only the members of cached groups which still exist are listed again
+        mock_iter_group_members.assert_called_once_with('g1', max_workers=1)
+        assert cache.get_records('group_members/g1') == [{'id': '1'}, {'id': '2'}]
+        assert cache.get_kinds('group_members/') == ['group_members/g1']
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from jccli.journal import SyncJournal
+
+
+class TestJournal:
+
+    def setup_method(self, test_method):
+        pass
+
+    def teardown_method(self, test_method):
+        pass
+
+    def test_start_and_resume(self, tmp_path):
+        path = str(tmp_path / 'journals' / 'sync.jsonl')
+        plan = {'version': 1, 'operations': [{'op': 'create_group', 'name': 'staff', 'type': 'user_group'}]}
+        journal = SyncJournal.start(path, plan)
+        journal.record(0, id='g1')
+        journal.close()
+
+        journal = SyncJournal.resume(path)
+        assert journal.plan == plan
+        assert journal.applied == {0: {'id': 'g1'}}
+        journal.record(1)
+        journal.close()
+        assert SyncJournal.resume(path).applied == {0: {'id': 'g1'}, 1: {}}
+
+    def test_resume_truncated(self, tmp_path):
+        path = str(tmp_path / 'sync.jsonl')
+        journal = SyncJournal.start(path, {'operations': []})
+        journal.record(0)
+        journal.close()
+        with open(path, 'a') as file:
+            file.write('{"index": 1, "id": "u')
+        journal = SyncJournal.resume(path)
+        assert journal.applied == {0: {}}
+        # The record cut short is dropped, so the next one starts on a line of its own
+        journal.record(1, id='u1')
+        journal.close()
+        assert SyncJournal.resume(path).applied == {0: {}, 1: {'id': 'u1'}}
+
+    def test_locked(self, tmp_path):
+        path = str(tmp_path / 'sync.jsonl')
+        journal = SyncJournal.start(path, {'operations': []})
+        with pytest.raises(ValueError):
+            SyncJournal.start(path, {'operations': []})
+        with pytest.raises(ValueError):
+            SyncJournal.resume(path)
+        journal.close()
+        SyncJournal.resume(path).close()
+
+    def test_resume_invalid(self, tmp_path):
+        path = str(tmp_path / 'sync.jsonl')
+        with open(path, 'w') as file:
+            file.write('not a journal\n')
+        with pytest.raises(ValueError):
+            SyncJournal.resume(path)
+        with pytest.raises(FileNotFoundError):
+            SyncJournal.resume(str(tmp_path / 'missing.jsonl'))
+
+    def test_remove(self, tmp_path):
+        path = str(tmp_path / 'sync.jsonl')
+        SyncJournal.start(path, {'operations': []}).remove()
+        assert not os.path.exists(path)
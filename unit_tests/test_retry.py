@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+.. currentmodule:: test_retry
+.. moduleauthor:: zaro0508 <zaro0508@gmail.com>
+
+This is the test module for the project's retry module.
+"""
+# fmt: off
+import pytest
+
+# fmt: on
+from mock import MagicMock, patch
+from jccli import retry
+
+
+class MockApiException(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(status)
+        self.status = status
+        self.headers = headers
+
+
+class TestRetry:
+    def setup_method(self, test_method):
+        retry.configure()
+
+    def teardown_method(self, test_method):
+        retry.configure()
+
+    def test_should_retry(self):
+        policy = retry.RetryPolicy(max_retries=2)
+        assert policy.should_retry('POST', 'https://x/api/systemusers', 429, 0)
+        assert not policy.should_retry('POST', 'https://x/api/systemusers', 503, 0)
+        assert policy.should_retry('POST', 'https://x/api/search/systemusers', 503, 0)
+        assert policy.should_retry('GET', 'https://x/api/systemusers', 503, 1)
+        assert not policy.should_retry('GET', 'https://x/api/systemusers', 503, 2)
+        assert not policy.should_retry('GET', 'https://x/api/systemusers', 404, 0)
+
+    def test_delay(self):
+        policy = retry.RetryPolicy(backoff_base=1, backoff_max=10)
+        assert 0 <= policy.delay(2) <= 4
+        assert policy.delay(0, retry_after='3') == 3
+        assert policy.delay(0, retry_after='600') == 10
+
+    def test_parse_retry_after(self):
+        assert retry.parse_retry_after(None) is None
+        assert retry.parse_retry_after('2.5') == 2.5
+        assert retry.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        assert retry.parse_retry_after('soon') is None
+
+    def test_token_bucket(self):
+        bucket = retry.TokenBucket(rate=10, burst=2)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+
+    @patch('jccli.retry.time.sleep')
+    def test_with_retries(self, mock_sleep):
+        request = MagicMock(side_effect=[MockApiException(429, {'Retry-After': '1'}), MockApiException(503), 'ok'])
+        assert retry.with_retries(request, '1234')('GET', 'https://x/api/systemusers') == 'ok'
+        assert request.call_count == 3
+        assert mock_sleep.call_args_list[0][0][0] == 1
+
+    @patch('jccli.retry.time.sleep')
+    def test_with_retries_gives_up(self, mock_sleep):
+        retry.configure(max_retries=1)
+        request = MagicMock(side_effect=MockApiException(500))
+        with pytest.raises(MockApiException):
+            retry.with_retries(request, '1234')('GET', 'https://x/api/systemusers')
+        assert request.call_count == 2
+
+    @patch('jccli.retry.time.sleep')
+    def test_with_retries_rate_limit(self, mock_sleep):
+        retry.configure(rate=5, burst=1)
+        request = MagicMock(return_value='ok')
+        wrapped = retry.with_retries(request, '1234')
+        wrapped('GET', 'https://x/api/systemusers')
+        wrapped('GET', 'https://x/api/systemusers')
+        assert mock_sleep.call_args_list[-1][0][0] > 0
@@ -0,0 +1,388 @@
+import io
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from jccli import sync_plan
+from jccli.errors import JcApiException
+from jccli.helpers import iter_data_records
+from jccli.journal import SyncJournal
+
+
+class TestSyncPlan:
+
+    def setup_method(self, test_method):
+        pass
+
+    def teardown_method(self, test_method):
+        pass
+
+    def test_diff_groups(self):
+        local_groups = [
+            {'name': 'staff', 'type': 'user_group'},
+            {'name': 'servers', 'type': 'system_group'},
+            {'name': 'admins', 'type': 'user_group'},
+        ]
+        remote_groups = [
+            {'id': '1', 'name': 'staff', 'type': 'user_group'},
+            {'id': '2', 'name': 'servers', 'type': 'user_group'},
+            {'id': '3', 'name': 'old', 'type': 'system_group'},
+        ]
+        to_create, to_remove = sync_plan.diff_groups(local_groups, remote_groups)
+        assert to_create == [{'name': 'servers', 'type': 'system_group'}, {'name': 'admins', 'type': 'user_group'}]
+        assert [group['id'] for group in to_remove] == ['2', '3']
+
+    def test_diff_users(self):
+        local_users = [
+            {'username': 'jdoe', 'email': 'jdoe@example.org'},
+            {'username': 'renamed', 'email': 'asmith@example.org'},
+            {'username': 'new', 'email': 'new@example.org'},
+            {'username': 'new', 'email': 'new@example.org'},
+        ]
+        remote_users = [
+            {'id': '1', 'username': 'jdoe', 'email': 'jdoe@example.org'},
+            {'id': '2', 'username': 'asmith', 'email': 'asmith@example.org'},
+            {'id': '3', 'username': 'gone', 'email': 'gone@example.org'},
+        ]
+        to_create, to_remove = sync_plan.diff_users(local_users, remote_users)
+        assert to_create == [{'username': 'new', 'email': 'new@example.org'}]
+        assert [user['id'] for user in to_remove] == ['3']
+
+    def test_diff_empty(self):
+        assert sync_plan.diff_users([], []) == ([], [])
+        assert sync_plan.diff_groups([], []) == ([], [])
+
+    def test_make_plan(self):
+        local_groups = [{'name': 'staff', 'type': 'user_group'}]
+        remote_groups = [{'id': 'g1', 'name': 'staff', 'type': 'user_group'},
+                         {'id': 'g2', 'name': 'old', 'type': 'system_group'}]
+        local_users = [{'username': 'new', 'email': 'new@example.org', 'firstname': 'N', 'lastname': 'U'}]
+        remote_users = [{'id': 'u1', 'username': 'gone', 'email': 'gone@example.org'}]
+        plan = sync_plan.make_plan(local_groups, local_users, remote_groups, remote_users,
+                                   fingerprint={'users': 1, 'groups': 2})
+        assert plan['version'] == sync_plan.PLAN_VERSION
+        assert plan['fingerprint'] == {'users': 1, 'groups': 2}
+        assert [sync_plan.describe(operation) for operation in plan['operations']] == [
+            'remove system group: old',
+            'create user: new',
+            'bind user new to user group: staff',
+            'remove user: gone',
+        ]
+        assert plan['operations'][2]['group_id'] == 'g1'
+
+    def test_make_plan_without_staff_group(self):
+        local_users = [{'username': 'new', 'email': 'new@example.org', 'firstname': 'N', 'lastname': 'U'}]
+        plan = sync_plan.make_plan([], local_users, [], [])
+        assert [operation['op'] for operation in plan['operations']] == ['create_user']
+
+    def test_make_plan_from_csv_with_blank_cells(self):
+        lines = ['username,email,firstname,lastname,sudo\n', 'jdoe,jdoe@x.org,Jane,,true\n']
+        local_users = [record for kind, record in iter_data_records(lines, '.csv')]
+        plan = sync_plan.make_plan([], local_users, [], [])
+        assert plan['operations'][0]['user']['firstname'] == 'Jane'
+        assert plan['operations'][0]['user']['lastname'] == ''
+
+    def test_make_plan_from_csv_with_numbers(self):
+        lines = ['username,email,unix_uid,sudo\n', 'jdoe,jdoe@x.org,5001,\n', 'new,new@x.org,5002,yes\n']
+        local_users = [record for kind, record in iter_data_records(lines, '.csv')]
+        remote_users = [{'id': 'u1', 'username': 'jdoe', 'email': 'jdoe@x.org', 'unix_uid': 5001, 'sudo': True}]
+        plan = sync_plan.make_plan([], local_users, [], remote_users)
+        # The uid of jdoe is unchanged and its blank flag left as it is, so only the new user is created
+        assert [operation['op'] for operation in plan['operations']] == ['create_user']
+        assert plan['operations'][0]['user']['unix_uid'] == 5002
+        assert plan['operations'][0]['user']['sudo'] is True
+
+        remote_users[0]['unix_uid'] = 5000
+        plan = sync_plan.make_plan([], local_users, [], remote_users)
+        assert plan['operations'][1] == {'op': 'update_user', 'id': 'u1', 'username': 'jdoe',
+                                         'changes': {'unix_uid': 5001}}
+
+    def test_save_and_load_plan(self):
+        plan = sync_plan.make_plan([{'name': 'staff', 'type': 'user_group'}], [], [], [])
+        plan_file = io.StringIO()
+        sync_plan.save_plan(plan, plan_file)
+        plan_file.seek(0)
+        assert sync_plan.load_plan(plan_file) == plan
+
+        with pytest.raises(ValueError):
+            sync_plan.load_plan(io.StringIO('{"version": 0}'))
+
+    def test_apply_plan(self):
+        local_groups = [{'name': 'staff', 'type': 'user_group'}]
+        local_users = [{'username': 'new', 'email': 'new@example.org', 'firstname': 'N', 'lastname': 'U'}]
+        remote_users = [{'id': 'u1', 'username': 'gone', 'email': 'gone@example.org'}]
+        plan = sync_plan.make_plan(local_groups, local_users, [], remote_users)
+
+        api1 = mock.Mock()
+        api1.create_users.return_value = [{'id': 'u2', 'username': 'new', 'status': 'finished'}]
+        api2 = mock.Mock()
+        api2.create_group.return_value = mock.Mock(id='g1')
+        output = []
+        sync_plan.apply_plan(plan, api1, api2, echo=output.append)
+
+        api2.create_group.assert_called_once_with('staff', 'user_group')
+        api1.create_users.assert_called_once_with([local_users[0]])
+        api2.bind_user_to_group.assert_called_once_with('u2', 'g1')
+        api1.delete_user.assert_called_once_with('gone', user_id='u1')
+        assert output == [
+            'create user group: staff',
+            'create user: new',
+            'bind user new to user group: staff',
+            'remove user: gone',
+        ]
+
+    def test_apply_plan_bulk_creates_users(self):
+        local_users = [{'username': f"user{i}", 'email': f"user{i}@example.org", 'firstname': '', 'lastname': ''}
+                       for i in range(3)]
+        plan = sync_plan.make_plan([], local_users, [], [])
+
+        api1 = mock.Mock()
+        api1.fill_user_ids.side_effect = lambda results: results
+        api2 = mock.Mock()
+        api2.bulk_create_users.return_value = [{'username': user['username'], 'id': str(i)}
+                                               for i, user in enumerate(local_users)]
+        sync_plan.apply_plan(plan, api1, api2, echo=lambda line: None)
+
+        api2.bulk_create_users.assert_called_once_with([operation['user'] for operation in plan['operations']])
+        api1.create_users.assert_not_called()
+
+    def test_apply_plan_creates_users_with_flags(self):
+        local_users = [{'username': f"user{i}", 'email': f"user{i}@example.org", 'firstname': '', 'lastname': ''}
+                       for i in range(3)]
+        local_users[2]['sudo'] = 'True'
+        plan = sync_plan.make_plan([], local_users, [], [])
+        # The flags of new users are applied when they are created, not by a later sync
+        assert plan['operations'][2]['user']['sudo'] is True
+
+        api1 = mock.Mock()
+        api1.fill_user_ids.side_effect = lambda results: results
+        api1.create_users.return_value = [{'username': 'user2', 'id': '2', 'status': 'finished'}]
+        api2 = mock.Mock()
+        api2.bulk_create_users.return_value = [{'username': f"user{i}", 'id': str(i)} for i in range(2)]
+        results = sync_plan.apply_plan(plan, api1, api2, echo=lambda line: None)
+
+        assert [result['status'] for result in results] == ['finished'] * 3
+        # A bulk job cannot set sudo, so that user is created on its own
+        api2.bulk_create_users.assert_called_once_with([plan['operations'][0]['user'], plan['operations'][1]['user']])
+        api1.create_users.assert_called_once_with([plan['operations'][2]['user']])
+
+    def test_apply_plan_runs_independent_operations_concurrently(self):
+        remote_users = [{'id': str(i), 'username': f"user{i}", 'email': f"user{i}@example.org"} for i in range(8)]
+        plan = sync_plan.make_plan([], [], [], remote_users)
+
+        in_flight = []
+        max_in_flight = []
+        lock = threading.Lock()
+
+        def delete_user(username, user_id):
+            with lock:
+                in_flight.append(user_id)
+                max_in_flight.append(len(in_flight))
+            # Later users finish first
+            time.sleep(0.01 * (8 - int(user_id)))
+            with lock:
+                in_flight.remove(user_id)
+
+        api1 = mock.Mock()
+        api1.delete_user.side_effect = delete_user
+        output = []
+        results = sync_plan.apply_plan(plan, api1, mock.Mock(), echo=output.append, max_workers=4)
+
+        assert max(max_in_flight) == 4
+        assert output == [f"remove user: user{i}" for i in range(8)]
+        assert [result['status'] for result in results] == ['finished'] * 8
+
+    def test_apply_plan_waits_for_dependencies(self):
+        local_groups = [{'name': 'staff', 'type': 'user_group'}]
+        local_users = [{'username': 'new', 'email': 'new@example.org', 'firstname': '', 'lastname': ''}]
+        plan = sync_plan.make_plan(local_groups, local_users, [], [])
+        events = []
+
+        def create_group(name, type):
+            time.sleep(0.05)
+            events.append('create_group')
+            return mock.Mock(id='g1')
+
+        def create_users(users):
+            events.append('create_user')
+            return [{'id': 'u1', 'username': user['username'], 'status': 'finished'} for user in users]
+
+        api1 = mock.Mock()
+        api1.create_users.side_effect = create_users
+        api2 = mock.Mock()
+        api2.create_group.side_effect = create_group
+        api2.bind_user_to_group.side_effect = lambda user_id, group_id: events.append('bind_user')
+        sync_plan.apply_plan(plan, api1, api2, echo=lambda line: None)
+
+        assert events == ['create_user', 'create_group', 'bind_user']
+        api2.bind_user_to_group.assert_called_once_with('u1', 'g1')
+
+    def test_apply_plan_skips_operations_after_failure(self):
+        local_groups = [{'name': 'staff', 'type': 'user_group'}]
+        local_users = [{'username': 'new', 'email': 'new@example.org', 'firstname': '', 'lastname': ''}]
+        remote_users = [{'id': 'u1', 'username': 'gone', 'email': 'gone@example.org'}]
+        plan = sync_plan.make_plan(local_groups, local_users, [], remote_users)
+
+        api1 = mock.Mock()
+        api1.create_users.return_value = [{'id': 'u2', 'username': 'new', 'status': 'finished'}]
+        api2 = mock.Mock()
+        api2.create_group.side_effect = JcApiException("boom")
+        output = []
+        results = sync_plan.apply_plan(plan, api1, api2, echo=output.append)
+
+        assert [result['status'] for result in results] == ['failed', 'finished', 'skipped', 'finished']
+        api2.bind_user_to_group.assert_not_called()
+        api1.delete_user.assert_called_once_with('gone', user_id='u1')
+        assert output[0] == 'create user group: staff (failed: boom)'
+        assert output[2].endswith('(skipped: an operation it depends on failed)')
+
+    def test_apply_plan_binds_created_users_when_others_fail(self):
+        local_groups = [{'name': 'staff', 'type': 'user_group'}]
+        local_users = [{'username': username, 'email': f"{username}@example.org", 'firstname': '', 'lastname': '',
+                        'sudo': True} for username in ('a', 'b')]
+        plan = sync_plan.make_plan(local_groups, local_users, [], [])
+
+        api1 = mock.Mock()
+        api1.create_users.return_value = [
+            {'id': 'u1', 'username': 'a', 'status': 'finished'},
+            {'id': None, 'username': 'b', 'status': 'failed', 'status_msg': "boom"},
+        ]
+        api2 = mock.Mock()
+        api2.create_group.return_value = mock.Mock(id='g1')
+        results = sync_plan.apply_plan(plan, api1, api2, echo=lambda line: None)
+
+        statuses = {sync_plan.describe(result['operation']): result['status'] for result in results}
+        assert statuses == {
+            'create user group: staff': 'finished',
+            'create user: a': 'finished',
+            'create user: b': 'failed',
+            'bind user a to user group: staff': 'finished',
+            'bind user b to user group: staff': 'skipped',
+        }
+        api2.bind_user_to_group.assert_called_once_with('u1', 'g1')
+
+    def test_make_plan_with_members(self):
+        local_groups = [
+            {'name': 'staff', 'type': 'user_group', 'members': ['jdoe', 'new']},
+            {'name': 'admins', 'type': 'user_group', 'members': ['asmith']},
+            {'name': 'guests', 'type': 'user_group'},
+        ]
+        remote_groups = [
+            {'id': 'g1', 'name': 'staff', 'type': 'user_group'},
+            {'id': 'g3', 'name': 'guests', 'type': 'user_group'},
+        ]
+        local_users = [
+            {'username': 'jdoe', 'email': 'jdoe@example.org', 'firstname': '', 'lastname': ''},
+            {'username': 'asmith', 'email': 'asmith@example.org', 'firstname': '', 'lastname': ''},
+            {'username': 'new', 'email': 'new@example.org', 'firstname': '', 'lastname': ''},
+        ]
+        remote_users = [
+            {'id': 'u1', 'username': 'jdoe', 'email': 'jdoe@example.org'},
+            {'id': 'u2', 'username': 'asmith', 'email': 'asmith@example.org'},
+            {'id': 'u3', 'username': 'gone', 'email': 'gone@example.org'},
+        ]
+        remote_members = {'g1': ['u1', 'u2', 'u3']}
+        plan = sync_plan.make_plan(local_groups, local_users, remote_groups, remote_users,
+                                   remote_members=remote_members)
+        assert [sync_plan.describe(operation) for operation in plan['operations']] == [
+            'create user group: admins',
+            'create user: new',
+            'bind user new to user group: staff',
+            'unbind user asmith from user group: staff',
+            'bind user asmith to user group: admins',
+            'remove user: gone',
+        ]
+        bind_new, unbind, bind_admin = plan['operations'][2:5]
+        assert (bind_new['user_id'], bind_new['group_id']) == (None, 'g1')
+        assert (unbind['user_id'], unbind['group_id']) == ('u2', 'g1')
+        assert (bind_admin['user_id'], bind_admin['group_id']) == ('u2', None)
+
+    def test_make_plan_with_invalid_members(self):
+        with pytest.raises(ValueError):
+            sync_plan.make_plan([{'name': 'staff', 'type': 'user_group', 'members': ['nobody']}], [], [], [])
+        with pytest.raises(ValueError):
+            sync_plan.make_plan([{'name': 'servers', 'type': 'system_group', 'members': []}], [], [], [])
+
+    def test_apply_plan_membership(self):
+        local_groups = [{'name': 'admins', 'type': 'user_group', 'members': ['jdoe']}]
+        remote_groups = [{'id': 'g1', 'name': 'staff', 'type': 'user_group'}]
+        local_users = [{'username': 'jdoe', 'email': 'jdoe@example.org', 'firstname': '', 'lastname': ''}]
+        remote_users = [{'id': 'u1', 'username': 'jdoe', 'email': 'jdoe@example.org'}]
+        plan = sync_plan.make_plan(local_groups, local_users, remote_groups, remote_users)
+
+        api2 = mock.Mock()
+        api2.create_group.return_value = mock.Mock(id='g2')
+        results = sync_plan.apply_plan(plan, mock.Mock(), api2, echo=lambda line: None)
+        assert [result['status'] for result in results] == ['finished'] * 3
+        api2.delete_group.assert_called_once_with('g1', 'user_group')
+        api2.bind_user_to_group.assert_called_once_with('u1', 'g2')
+
+    def test_diff_user_attributes(self):
+        local_users = [
+            {'username': 'jdoe', 'email': 'jdoe@example.org', 'firstname': 'John', 'lastname': 'Doe', 'sudo': 'True'},
+            {'username': 'asmith', 'email': 'asmith@example.org', 'firstname': 'Ann', 'lastname': '',
+             'sudo': 'false', 'password': 'secret'},
+            {'username': 'renamed', 'email': 'bob@example.org', 'sudo': 'yes'},
+            {'username': 'new', 'email': 'new@example.org', 'firstname': 'New'},
+        ]
+        remote_users = [
+            {'id': 'u1', 'username': 'jdoe', 'email': 'jdoe@example.org', 'firstname': 'Jon', 'lastname': 'Doe',
+             'sudo': False},
+            {'id': 'u2', 'username': 'asmith', 'email': 'asmith@example.org', 'firstname': 'Ann', 'lastname': None,
+             'sudo': False},
+            {'id': 'u3', 'username': 'bob', 'email': 'bob@example.org'},
+        ]
+        changed = sync_plan.diff_user_attributes(local_users, remote_users)
+        assert [(remote_user['id'], changes) for remote_user, changes in changed] == [
+            ('u1', {'firstname': 'John', 'sudo': True}),
+            ('u3', {'username': 'renamed', 'sudo': True}),
+        ]
+
+    def test_apply_plan_updates_users(self):
+        local_users = [{'username': 'jdoe', 'email': 'jdoe@example.org', 'firstname': 'John', 'lastname': 'Doe'}]
+        remote_users = [{'id': 'u1', 'username': 'jdoe', 'email': 'jdoe@example.org', 'firstname': 'Jon',
+                         'lastname': 'Doe'}]
+        plan = sync_plan.make_plan([], local_users, [], remote_users)
+        assert [sync_plan.describe(operation) for operation in plan['operations']] == ['update user: jdoe (firstname)']
+
+        api1 = mock.Mock()
+        sync_plan.apply_plan(plan, api1, mock.Mock(), echo=lambda line: None)
+        api1.set_user.assert_called_once_with('jdoe', {'firstname': 'John'}, user_id='u1')
+
+        # Nothing to do once the user is up to date
+        remote_users[0]['firstname'] = 'John'
+        assert sync_plan.make_plan([], local_users, [], remote_users)['operations'] == []
+
+    def test_apply_plan_resumes_from_journal(self, tmp_path):
+        local_groups = [{'name': 'staff', 'type': 'user_group'}]
+        local_users = [{'username': f"user{i}", 'email': f"user{i}@example.org", 'firstname': '', 'lastname': ''}
+                       for i in range(2)]
+        plan = sync_plan.make_plan(local_groups, local_users, [], [])
+        path = str(tmp_path / 'sync.jsonl')
+
+        # The first run creates the group and the users, and then fails to bind them
+        api1 = mock.Mock()
+        api1.fill_user_ids.side_effect = lambda results: results
+        api2 = mock.Mock()
+        api2.create_group.return_value = mock.Mock(id='g1')
+        api2.bulk_create_users.return_value = [{'username': 'user0', 'id': 'u0'}, {'username': 'user1', 'id': 'u1'}]
+        api2.bind_user_to_group.side_effect = JcApiException("boom")
+        journal = SyncJournal.start(path, plan)
+        results = sync_plan.apply_plan(plan, api1, api2, echo=lambda line: None, journal=journal)
+        journal.close()
+        assert [result['status'] for result in results] == ['finished'] * 3 + ['failed'] * 2
+
+        # The second run only binds them, with the ids recorded by the first run
+        api2 = mock.Mock()
+        journal = SyncJournal.resume(path)
+        output = []
+        results = sync_plan.apply_plan(journal.plan, mock.Mock(), api2, echo=output.append, journal=journal)
+        journal.close()
+        assert [result['status'] for result in results] == ['finished'] * 5
+        api2.create_group.assert_not_called()
+        api2.bulk_create_users.assert_not_called()
+        assert sorted(call[0] for call in api2.bind_user_to_group.call_args_list) == [('u0', 'g1'), ('u1', 'g1')]
+        assert output[0] == 'create user group: staff (already applied)'
+        assert len(SyncJournal.resume(path).applied) == 5